@@ -0,0 +1,8 @@
+"""
+benchmarks of django-charitychecker's update and lookup hot
+paths, run against synthetic IRS Publication 78 releases.
+
+Run them from the repository's root directory with:
+
+    python -m benchmarks.run
+"""
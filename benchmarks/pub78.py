@@ -0,0 +1,213 @@
+"""
+a generator of synthetic, but realistic, IRS Publication 78
+releases, for benchmarking.
+
+A release is a series of lines of the form
+EIN|name|city|state|country|deductability code, sorted by
+EIN, as in the real file. Names are built from the words of
+real nonprofit names with a Zipf distribution, so that a few
+words, like "Foundation", are very common, cities and states
+are skewed in the same way, and a fraction of the lines are
+foreign organizations with the FORGN deductability code.
+Each release after the first is derived from the one before
+it, with a fraction of its nonprofits removed, changed or
+added, as between two real releases.
+"""
+
+import io
+import os
+import random
+import bisect
+import zipfile
+
+# the words nonprofit names are made of, most common first.
+NAME_WORDS = (
+    'Foundation Inc Association Church Of The And Fund Society Club '
+    'Community Friends Center Council School Ministries Education '
+    'Trust American Parent Teacher Organization Baptist Youth '
+    'International Christian Alliance Services Charitable Museum '
+    'Scholarship Historical Library Health Arts League Fellowship '
+    'County Family Animal Rescue Center For Children Memorial '
+    'Saint Mary Lodge Veterans Post Auxiliary Sports Boosters '
+    'Hospital Volunteer Fire Department Conservancy Land Lake '
+    'Watershed Garden Music Theatre Dance Orchestra Choir Heritage '
+    'Research Institute Science Network Coalition Partners Project '
+    'Outreach Mission Gospel Temple Jewish Federation Islamic '
+    'Society Buddhist Hope House Habitat Humanity Food Bank Pantry '
+    'Shelter Homeless Women Men Girls Boys Scouts Little League '
+    'Soccer Hockey Baseball Golf Rotary Lions Kiwanis Elks Order '
+    'Eagles Grange Cemetery Preservation Trail Park Zoo Aquarium '
+    'Symphony Opera Ballet Film Festival Poetry Writers Guild '
+    'Clinic Care Hospice Recovery Autism Cancer Diabetes Heart '
+    'Alzheimers Wildlife Horse Dog Cat Humane Spca Global Relief '
+    'Water Africa Haiti India Mexico Literacy Tutoring Academy '
+    'Montessori Charter Alumni College University Student Chapter '
+    'Pta Pto Band Robotics Math Chess Debate Theater Players Guild '
+    'Corporation Incorporated Ltd Company Of America New England '
+    'Northern Southern Eastern Western Central Valley Mountain River '
+    'Bay Coast Island Hill Springs Grove Oak Pine Maple Cedar Willow'
+).split()
+
+CITIES = (
+    'New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix',
+    'Philadelphia', 'San Antonio', 'San Diego', 'Dallas', 'Austin',
+    'Columbus', 'Charlotte', 'Indianapolis', 'Seattle', 'Denver',
+    'Washington', 'Boston', 'Nashville', 'Portland', 'Memphis',
+    'Louisville', 'Baltimore', 'Milwaukee', 'Albuquerque', 'Tucson',
+    'Fresno', 'Sacramento', 'Atlanta', 'Omaha', 'Raleigh', 'Miami',
+    'Minneapolis', 'Tulsa', 'Cleveland', 'Wichita', 'Arlington',
+    'Springfield', 'Madison', 'Franklin', 'Greenville', 'Bristol',
+    'Clinton', 'Salem', 'Fairview', 'Georgetown', 'Machias', 'Calais',
+    'N Berwick', 'Bangor', 'Burlington')
+
+STATES = (
+    'CA', 'TX', 'NY', 'FL', 'PA', 'IL', 'OH', 'MI', 'NC', 'GA', 'NJ',
+    'VA', 'WA', 'MA', 'MN', 'WI', 'IN', 'MO', 'TN', 'CO', 'MD', 'AZ',
+    'OR', 'KY', 'LA', 'AL', 'SC', 'IA', 'OK', 'CT', 'KS', 'ME', 'UT',
+    'NE', 'AR', 'MS', 'NM', 'WV', 'NH', 'ID', 'NV', 'MT', 'VT', 'HI',
+    'SD', 'ND', 'RI', 'DE', 'AK', 'WY', 'DC', 'PR')
+
+# deductability codes, with roughly their share of real
+# releases.
+CODES = (
+    ('PC', 850), ('PF', 90), ('POF', 20), ('LODGE', 10), ('SO', 10),
+    ('EO', 8), ('GROUP', 5), ('PC,PF', 4), ('UNKWN', 3))
+
+FOREIGN_COUNTRIES = (
+    'United Kingdom', 'Canada', 'Israel', 'Germany', 'France',
+    'Switzerland', 'Mexico', 'Netherlands', 'Ireland', 'Japan')
+
+# the most EINs are spread apart by, so that there's room
+# to add nonprofits between them in later releases.
+EIN_GAP = 400
+
+
+class _Choice(object):
+    """chooses from values at random with the given weights."""
+
+    def __init__(self, values, weights):
+        self.values = values
+        self.totals = list(_accumulate(weights))
+
+    def __call__(self, rnd):
+        return self.values[bisect.bisect(
+            self.totals, rnd.random() * self.totals[-1])]
+
+
+def _accumulate(values):
+    total = 0
+    for value in values:
+        total += value
+        yield total
+
+
+def _zipf(values):
+    """return a _Choice of values with a Zipf distribution."""
+    return _Choice(values, [1.0 / (i + 1) for i in range(len(values))])
+
+
+_word = _zipf(NAME_WORDS)
+_city = _zipf(CITIES)
+_state = _zipf(STATES)
+_code = _Choice([code for code, weight in CODES],
+                [weight for code, weight in CODES])
+
+
+def _nonprofit(rnd, ein, foreign):
+    """return a line for a random nonprofit with the given
+    EIN, a foreign organization if foreign is true.
+    """
+    name = ' '.join(_word(rnd) for i in range(rnd.randint(2, 7)))
+    if foreign:
+        code = 'FORGN' if rnd.random() < 0.9 else 'FORGN,PC'
+        return '%09d|%s|%s||%s|%s\n' % (
+            ein, name, _city(rnd), rnd.choice(FOREIGN_COUNTRIES), code)
+    return '%09d|%s|%s|%s|United States|%s\n' % (
+        ein, name, _city(rnd), _state(rnd), _code(rnd))
+
+
+def generate_release(rows, release=0, churn=0.05, foreign=0.01, seed=0):
+    """return a generator of the lines of a release. The first
+    release, release 0, has rows nonprofits, of which about
+    foreign are foreign organizations, and each release after
+    it is derived from the one before, as described in
+    generate_next_release. The same arguments always give the
+    same lines.
+    """
+    if release > 0:
+        # the releases before are generated again, a line at a
+        # time, rather than held in memory.
+        return generate_next_release(
+            generate_release(rows, release - 1, churn, foreign, seed),
+            churn, foreign, seed + release)
+    return _generate_first_release(rows, foreign, random.Random(seed))
+
+
+def _generate_first_release(rows, foreign, rnd):
+    ein = 10000000
+    for i in xrange(rows):
+        ein += rnd.randint(2, EIN_GAP)
+        yield _nonprofit(rnd, ein, rnd.random() < foreign)
+
+
+def generate_next_release(lines, churn=0.05, foreign=0.01, seed=1):
+    """return a generator of the lines of the release after
+    the one whose lines are given, with about churn of its
+    nonprofits changed: a third of those removed, a third
+    given a new name, city or deductability code, and a third
+    new nonprofits added. Of the new nonprofits, about
+    foreign are foreign organizations.
+    """
+    rnd = random.Random(seed)
+    lines = iter(lines)
+    line = next(lines, None)
+    while line is not None:
+        following = next(lines, None)
+        change = rnd.random()
+        if change < churn / 3:
+            line = None
+        elif change < churn * 2 / 3:
+            values = line.rstrip('\n').split('|')
+            field = rnd.choice((1, 2, 5))
+            if field == 1:
+                values[1] += ' ' + _word(rnd)
+            elif field == 2:
+                values[2] = _city(rnd)
+            elif values[5].startswith('FORGN'):
+                values[5] = 'FORGN,PC' if values[5] == 'FORGN' else 'FORGN'
+            else:
+                values[5] = _code(rnd)
+            line = '|'.join(values) + '\n'
+        if line is not None:
+            yield line
+        if change > 1 - churn / 3:
+            # add a new nonprofit, if there's room for its EIN.
+            ein = int(line.partition('|')[0]) if line else None
+            following_ein = (
+                int(following.partition('|')[0]) if following
+                else 999999999)
+            if ein is not None and following_ein - ein > 1:
+                yield _nonprofit(
+                    rnd, rnd.randint(ein + 1, following_ein - 1),
+                    rnd.random() < foreign)
+        line = following
+
+
+def write_release(path, lines, file_name=None):
+    """write lines to path, zipped up into an archive holding
+    one file named file_name, like the IRS's, if file_name is
+    given, or as plain text otherwise.
+    """
+    if file_name is None:
+        with io.open(path, 'wb') as f:
+            f.writelines(lines)
+        return
+    # zipfile can't write a member a piece at a time, so the
+    # text is written to a temporary file first.
+    text_path = path + '.txt'
+    write_release(text_path, lines)
+    try:
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(text_path, file_name)
+    finally:
+        os.remove(text_path)
@@ -0,0 +1,433 @@
+"""
+runs the benchmarks and records their results.
+
+    python -m benchmarks.run [--sizes 10k,100k] [--output DIR]
+    python -m benchmarks.run --compare OLD.json NEW.json
+
+Each benchmark runs in a fresh process, on a fresh copy of its
+database, so that its peak memory use and timings aren't
+affected by the ones before it. The results of a run are
+written to a JSON file in the output directory named after
+the commit benchmarked, so that runs on different commits can
+be compared.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import datetime
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the number of rows in the first release at each size.
+SIZES = {'10k': 10000, '100k': 100000, '1m': 1000000, '2m': 2000000}
+DEFAULT_SIZES = '10k,100k'
+
+DEFAULT_DATA_DIR = os.path.join(ROOT, 'benchmarks', 'data')
+DEFAULT_OUTPUT_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+# the benchmarks run by default, with their parameters.
+DEFAULT_BENCHMARKS = (
+    ('sync_load', {'engine': 'hash'}),
+    ('sync_resync', {'engine': 'hash'}),
+    ('sync_resync', {'engine': 'merge'}),
+    ('sync_resync', {'engine': 'staging'}),
+    ('sync_resync', {'engine': 'shadow'}),
+    ('verify_nonprofit', {'cached': False}),
+    ('verify_nonprofit', {'cached': True}),
+    ('verify_nonprofits', {'batch': 1000}),
+)
+
+# the name the IRS gives the file in its archive.
+TXT_FILE_NAME = 'data-download-pub78.txt'
+
+# how much a metric has to change by for --compare to flag it.
+SIGNIFICANT_CHANGE = 0.1
+
+_benchmarks = {}
+
+
+def benchmark(function):
+    """register function as the benchmark of its name. It's
+    called with the rows in the first release, the path of the
+    first and second releases' archives and the benchmark's
+    parameters, and returns a dictionary of its metrics.
+    """
+    _benchmarks[function.__name__] = function
+    return function
+
+
+# running benchmarks, in the benchmark's own process
+
+def _peak_memory():
+    """return the peak resident memory of this process, in
+    megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes.
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+class _QueryCounter(object):
+    """counts the statements executed through django, without
+    keeping them as CaptureQueriesContext does, which would
+    inflate the memory use of large updates.
+    """
+
+    def __init__(self):
+        from django.db.backends import util
+        self.count = 0
+        for name in ('execute', 'executemany'):
+            setattr(util.CursorWrapper, name,
+                    self._counted(getattr(util.CursorWrapper, name)))
+
+    def _counted(self, method):
+        def counted(cursor, *args, **kwargs):
+            self.count += 1
+            return method(cursor, *args, **kwargs)
+        return counted
+
+
+def _update(archive, engine):
+    """update the database from archive, a release zipped up
+    like IRS Publication 78, through the same download, unzip
+    and parse path as the real update, and return the
+    counts.
+    """
+    from charitychecker.utilities import update_charitychecker_data
+    return update_charitychecker_data(
+        engine=engine, source='file://' + archive)
+
+
+def _measure_sync(archive, engine):
+    counter = _QueryCounter()
+    memory = _peak_memory()
+    start = time.time()
+    counts = _update(archive, engine)
+    return {
+        'seconds': time.time() - start,
+        'peak_memory_mb': _peak_memory(),
+        'memory_growth_mb': _peak_memory() - memory,
+        'queries': counter.count,
+        'inserted': counts['inserted'],
+        'updated': counts['updated'],
+        'deleted': counts['deleted']}
+
+
+@benchmark
+def sync_load(rows, first, second, engine):
+    """load the first release into an empty table."""
+    return _measure_sync(first, engine)
+
+
+@benchmark
+def sync_resync(rows, first, second, engine):
+    """update a table holding the first release to the
+    second.
+    """
+    return _measure_sync(second, engine)
+
+
+def _sample_eins(count):
+    """return count EINs in the database and count that
+    aren't, at random.
+    """
+    from charitychecker.models import IRSNonprofitData
+    rnd = random.Random(0)
+    eins = list(IRSNonprofitData.objects.values_list('pk', flat=True))
+    hits = rnd.sample(eins, min(count, len(eins)))
+    eins = set(eins)
+    misses = []
+    while len(misses) < count:
+        ein = '%09d' % rnd.randint(0, 999999999)
+        if ein not in eins:
+            misses.append(ein)
+    return hits, misses
+
+
+def _percentiles(timings, prefix):
+    """return the 50th, 90th and 99th percentiles and the
+    maximum of timings, in microseconds.
+    """
+    timings = sorted(timings)
+    metrics = {}
+    for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        metrics['%s_%s_us' % (prefix, name)] = (
+            timings[min(int(len(timings) * fraction), len(timings) - 1)]
+            * 1e6)
+    metrics['%s_max_us' % prefix] = timings[-1] * 1e6
+    return metrics
+
+
+@benchmark
+def verify_nonprofit(rows, first, second, cached, lookups=2000):
+    """verify EINs that are in the table and EINs that
+    aren't, one at a time, with the lookup cache emptied
+    before each lookup, or filled beforehand if cached.
+    """
+    from charitychecker.models import IRSNonprofitData
+    from charitychecker.caching import lookup_cache
+    hits, misses = _sample_eins(lookups // 2)
+    if cached:
+        for ein in hits + misses:
+            IRSNonprofitData.verify_nonprofit(ein)
+    counter = _QueryCounter()
+    metrics = {}
+    for prefix, eins in (('hit', hits), ('miss', misses)):
+        timings = []
+        for ein in eins:
+            if not cached:
+                lookup_cache.clear()
+            start = time.time()
+            IRSNonprofitData.verify_nonprofit(ein)
+            timings.append(time.time() - start)
+        metrics.update(_percentiles(timings, prefix))
+    queries = counter.count
+    metrics['queries_per_lookup'] = float(queries) / (len(hits) + len(misses))
+    return metrics
+
+
+@benchmark
+def verify_nonprofits(rows, first, second, batch, batches=20):
+    """verify batches of batch EINs, half of them in the
+    table, at once, with the lookup cache emptied before each
+    batch.
+    """
+    from charitychecker.models import IRSNonprofitData
+    from charitychecker.caching import lookup_cache
+    hits, misses = _sample_eins(batch // 2 * batches)
+    counter = _QueryCounter()
+    timings = []
+    for i in range(batches):
+        eins = (hits[i * batch // 2:(i + 1) * batch // 2] +
+                misses[i * batch // 2:(i + 1) * batch // 2])
+        lookup_cache.clear()
+        start = time.time()
+        IRSNonprofitData.verify_nonprofits([(ein,) for ein in eins])
+        timings.append(time.time() - start)
+    metrics = _percentiles(timings, 'batch')
+    metrics['per_ein_us'] = sum(timings) / (batches * batch) * 1e6
+    metrics['queries_per_batch'] = float(counter.count) / batches
+    return metrics
+
+
+def _run_child(options, args):
+    """run the benchmark named by args[0], with the
+    parameters in args[1] as JSON, and print its metrics as
+    JSON.
+    """
+    name, params = args[0], json.loads(args[1])
+    rows = int(options.rows)
+    first, second = _release_paths(options.data_dir, rows)
+    from django.core.management import call_command
+    if options.template:
+        shutil.copy(options.template, options.database)
+    else:
+        call_command('syncdb', interactive=False, verbosity=0)
+    metrics = _benchmarks[name](rows, first, second, **params)
+    sys.stdout.write(json.dumps(metrics) + '\n')
+
+
+# preparing the data and running the benchmarks, in the
+# main process
+
+def _release_paths(data_dir, rows):
+    return tuple(
+        os.path.join(data_dir, 'pub78-%d-%d.zip' % (rows, release))
+        for release in (0, 1))
+
+
+def _prepare(data_dir, rows, churn, foreign):
+    """write the first two releases of rows rows, and a
+    database holding the first, to data_dir, unless they're
+    there already, and return the database's path.
+    """
+    from benchmarks.pub78 import generate_release, write_release
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    for release, path in enumerate(_release_paths(data_dir, rows)):
+        if not os.path.exists(path):
+            print "generating release %d of %d rows" % (release, rows)
+            write_release(
+                path + '.part',
+                generate_release(rows, release, churn, foreign),
+                TXT_FILE_NAME)
+            os.rename(path + '.part', path)
+    template = os.path.join(data_dir, 'loaded-%d.sqlite3' % rows)
+    if not os.path.exists(template):
+        print "loading release 0 of %d rows" % rows
+        _spawn(data_dir, rows, 'sync_load', {'engine': 'hash'},
+               template + '.part')
+        os.rename(template + '.part', template)
+    return template
+
+
+def _spawn(data_dir, rows, name, params, database, template=None):
+    """run a benchmark in a new process on database, a copy of
+    template if given, and return its metrics.
+    """
+    environment = dict(
+        os.environ, DJANGO_SETTINGS_MODULE='benchmarks.settings',
+        CHARITYCHECKER_BENCHMARK_DATABASE=database,
+        PYTHONPATH=os.pathsep.join(
+            [ROOT] + filter(None, [os.environ.get('PYTHONPATH')])))
+    command = [
+        sys.executable, '-m', 'benchmarks.run', '--child',
+        '--rows', str(rows), '--data-dir', data_dir,
+        '--database', database, name, json.dumps(params)]
+    if template is not None:
+        command[-2:-2] = ['--template', template]
+    output = subprocess.check_output(command, env=environment, cwd=ROOT)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _commit():
+    """return the abbreviated hash of the commit checked out,
+    followed by "-dirty" if it has uncommitted changes.
+    """
+    def git(*args):
+        return subprocess.check_output(('git',) + args, cwd=ROOT).strip()
+    try:
+        commit = git('rev-parse', '--short', 'HEAD')
+        if git('status', '--porcelain', '--untracked-files=no'):
+            commit += '-dirty'
+        return commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(sizes, data_dir, output_dir, churn, foreign,
+        benchmarks=DEFAULT_BENCHMARKS):
+    """run benchmarks at each of sizes, numbers of rows,
+    write the results to output_dir and return the path
+    they're written to.
+    """
+    results = {
+        'commit': _commit(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'churn': churn,
+        'foreign': foreign,
+        'results': []}
+    work_dir = tempfile.mkdtemp()
+    try:
+        for rows in sizes:
+            template = _prepare(data_dir, rows, churn, foreign)
+            for name, params in benchmarks:
+                database = os.path.join(work_dir, 'benchmark.sqlite3')
+                metrics = _spawn(
+                    data_dir, rows, name, params, database,
+                    None if name == 'sync_load' else template)
+                os.remove(database)
+                params = dict(params, rows=rows)
+                print "%s %s: %s" % (name, _describe(params), ', '.join(
+                    '%s %.4g' % item for item in sorted(metrics.items())))
+                results['results'].append(
+                    {'benchmark': name, 'params': params,
+                     'metrics': metrics})
+    finally:
+        shutil.rmtree(work_dir)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    path = os.path.join(output_dir, '%s.json' % results['commit'])
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return path
+
+
+def _describe(params):
+    return ' '.join('%s=%s' % item for item in sorted(params.items()))
+
+
+def compare(old_path, new_path):
+    """print how each metric changed between the results in
+    old_path and new_path, flagging changes of more than
+    SIGNIFICANT_CHANGE.
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_results = dict(
+        ((result['benchmark'], _describe(result['params'])),
+         result['metrics'])
+        for result in old['results'])
+    print "%s -> %s" % (old['commit'], new['commit'])
+    for result in new['results']:
+        key = (result['benchmark'], _describe(result['params']))
+        if key not in old_results:
+            continue
+        print "%s %s" % key
+        for metric, value in sorted(result['metrics'].items()):
+            old_value = old_results[key].get(metric)
+            if old_value is None:
+                continue
+            if old_value:
+                ratio = float(value) / old_value
+            else:
+                ratio = float('inf') if value else 1.0
+            flag = ''
+            if abs(ratio - 1) > SIGNIFICANT_CHANGE:
+                flag = '  better' if ratio < 1 else '  WORSE'
+                if metric in ('inserted', 'updated', 'deleted'):
+                    flag = '  changed'
+            print "    %-22s %12.4g %12.4g %7.2fx%s" % (
+                metric, old_value, value, ratio, flag)
+
+
+def main(argv):
+    parser = OptionParser(usage=__doc__.strip())
+    parser.add_option(
+        '--sizes', default=DEFAULT_SIZES,
+        help=("the sizes of the first release to benchmark, from %s. "
+              "Defaults to %s." % (
+                  ', '.join(sorted(SIZES, key=SIZES.get)), DEFAULT_SIZES)))
+    parser.add_option(
+        '--churn', type='float', default=0.05,
+        help="the fraction of nonprofits changed between releases.")
+    parser.add_option(
+        '--foreign', type='float', default=0.01,
+        help="the fraction of nonprofits that are foreign.")
+    parser.add_option(
+        '--data-dir', default=DEFAULT_DATA_DIR,
+        help="where the generated releases and databases are kept.")
+    parser.add_option(
+        '--output', default=DEFAULT_OUTPUT_DIR,
+        help="where the results are written.")
+    parser.add_option(
+        '--compare', action='store_true',
+        help="compare the two results files given.")
+    # used to run each benchmark in its own process.
+    parser.add_option('--child', action='store_true')
+    parser.add_option('--rows')
+    parser.add_option('--database')
+    parser.add_option('--template')
+    options, args = parser.parse_args(argv)
+    if options.child:
+        _run_child(options, args)
+    elif options.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two results files")
+        compare(*args)
+    else:
+        try:
+            sizes = [SIZES[size] for size in options.sizes.split(',')]
+        except KeyError as e:
+            parser.error("unknown size: %s" % e)
+        path = run(sizes, options.data_dir, options.output,
+                   options.churn, options.foreign)
+        print "results written to %s" % path
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,23 @@
+"""
+django settings for the benchmarks. Each benchmark runs in its
+own process on its own SQLite database, named by the
+CHARITYCHECKER_BENCHMARK_DATABASE environment variable.
+"""
+
+import os
+
+SECRET_KEY = 'charitychecker-benchmarks'
+
+INSTALLED_APPS = (
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'charitychecker',
+)
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get(
+            'CHARITYCHECKER_BENCHMARK_DATABASE', 'benchmark.sqlite3'),
+    }
+}
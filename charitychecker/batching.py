@@ -0,0 +1,245 @@
+"""
+batching of nonprofit lookups made concurrently, so that
+many lookups are answered by one query.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db import connections, close_old_connections
+
+# Global Variables
+#
+# these can be overridden in settings.py
+
+# the default number of seconds a lookup waits for others to
+# batch it with, set CHARITYCHECKER_BATCH_WINDOW to change it.
+DEFAULT_BATCH_WINDOW = 0.002
+
+# End Global Variables
+
+# the most EINs looked up in one batch, one query's worth
+# under SQLite's limit of 999 query parameters.
+MAX_BATCH_SIZE = 900
+
+
+class LookupFuture(object):
+    """the result of a lookup that may not have finished
+    yet, in the style of concurrent.futures' Future.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    @classmethod
+    def resolved(cls, result):
+        """return a future that has already finished with
+        result.
+        """
+        future = cls()
+        future.set_result(result)
+        return future
+
+    def done(self):
+        """return whether the lookup has finished."""
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """wait up to timeout seconds, or forever if timeout
+        is None, for the lookup to finish and return its
+        result, raising the exception it raised, if any.
+        Raises RuntimeError if the lookup doesn't finish in
+        time.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("the lookup didn't finish in time")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """wait like result, then return the exception the
+        lookup raised, or None.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("the lookup didn't finish in time")
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """call callback with the future once the lookup has
+        finished, straight away if it already has. Callbacks
+        run in the thread that finished the lookup, so code
+        running an event loop should use them to hand the
+        result over to the loop's own thread.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def then(self, function):
+        """return a future of function called with this
+        future's result.
+        """
+        future = LookupFuture()
+
+        def callback(done):
+            try:
+                result = function(done.result())
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        self.add_done_callback(callback)
+        return future
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def gather(futures):
+    """return a LookupFuture of a list of the results of
+    futures, which fails with the first exception any of them
+    raises.
+    """
+    futures = list(futures)
+    gathered = LookupFuture()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def callback(future):
+        if future.exception() is not None:
+            if not gathered.done():
+                gathered.set_exception(future.exception())
+            return
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished and not gathered.done():
+            gathered.set_result([future.result() for future in futures])
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(callback)
+    return gathered
+
+
+class LookupBatcher(object):
+    """looks EINs up in batches on a background thread.
+
+    Each EIN submitted waits up to window seconds for others
+    to be submitted, and then every EIN waiting, up to
+    max_batch_size of them, is looked up at once by calling
+    load with a list of them, which returns a dictionary
+    mapping the EINs found to their data. An EIN submitted
+    again while it's waiting or being looked up shares the
+    first lookup's future rather than being looked up twice.
+    """
+
+    def __init__(self, load, window=DEFAULT_BATCH_WINDOW,
+                 max_batch_size=MAX_BATCH_SIZE):
+        self.load = load
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Condition(threading.Lock())
+        # the futures of EINs waiting to be looked up, in the
+        # order they were submitted, and of those being looked
+        # up now.
+        self._waiting = OrderedDict()
+        self._loading = {}
+        self._thread = None
+        self.batches = 0
+
+    def submit(self, ein):
+        """return a LookupFuture of the data of the nonprofit
+        with the given EIN, or None if there is no such
+        nonprofit.
+        """
+        with self._lock:
+            future = self._waiting.get(ein) or self._loading.get(ein)
+            if future is None:
+                future = self._waiting[ein] = LookupFuture()
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run)
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._lock.notify()
+            return future
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._waiting:
+                    self._lock.wait()
+            # give other lookups the window to arrive, unless a
+            # full batch is already waiting.
+            deadline = time.time() + self.window
+            with self._lock:
+                while (len(self._waiting) < self.max_batch_size and
+                       time.time() < deadline):
+                    self._lock.wait(deadline - time.time())
+                batch = []
+                while self._waiting and len(batch) < self.max_batch_size:
+                    ein, future = self._waiting.popitem(last=False)
+                    self._loading[ein] = future
+                    batch.append(ein)
+            self._load_batch(batch)
+
+    def _load_batch(self, eins):
+        try:
+            # the thread lives as long as the process, so drop
+            # its connection once it's broken or too old, as
+            # django does at the end of each request.
+            close_old_connections()
+            found = self.load(eins)
+        except Exception as e:
+            found, exception = {}, e
+            # the connection may be broken, so don't reuse it.
+            for connection in connections.all():
+                connection.close()
+        else:
+            exception = None
+        self.batches += 1
+        with self._lock:
+            futures = [(ein, self._loading.pop(ein)) for ein in eins]
+        for ein, future in futures:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(found.get(ein))
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_lookup_batcher(model):
+    """return the LookupBatcher of model, an IRSNonprofitData-
+    like model, which looks nonprofits up through model's
+    _get_many_nonprofit_data.
+    """
+    with _batchers_lock:
+        if model not in _batchers:
+            _batchers[model] = LookupBatcher(
+                model._get_many_nonprofit_data,
+                getattr(settings, 'CHARITYCHECKER_BATCH_WINDOW',
+                        DEFAULT_BATCH_WINDOW))
+        return _batchers[model]
@@ -0,0 +1,215 @@
+"""
+a Bloom filter of every EIN in the nonprofit data, for
+answering lookups of EINs that aren't in it without the
+database.
+"""
+
+import copy
+import math
+import time
+import struct
+import hashlib
+import logging
+from django.conf import settings
+from .snapshot import CHECK_INTERVAL, FileHolder, replace_atomically
+
+# Global Variables
+#
+# these can be overridden in settings.py
+
+# the path IRSNonprofitData's Bloom filter is written to after
+# every update and checked before looking EINs up, set
+# CHARITYCHECKER_BLOOM_FILTER_PATH to turn the filter on.
+DEFAULT_BLOOM_FILTER_PATH = None
+
+# the default rate of false positives, EINs the filter can't
+# rule out even though they aren't in the data, set
+# CHARITYCHECKER_BLOOM_FILTER_ERROR_RATE to change it.
+DEFAULT_BLOOM_FILTER_ERROR_RATE = 0.01
+
+# End Global Variables
+
+logger = logging.getLogger(__name__)
+
+# the Bloom filter file format. A header of the magic string,
+# the number of bits and hash functions, the number of EINs
+# added and the error rate the filter was sized for, followed
+# by the bits.
+MAGIC = 'CCBLOOM1'
+_HEADER = struct.Struct('<8sQIId')
+_HASHES = struct.Struct('<QQ')
+
+# the number of rows read from the database at a time while
+# building a filter.
+BUILD_CHUNK_SIZE = 10000
+
+
+class BloomFilter(object):
+    """a Bloom filter of EINs. Testing whether an EIN is in the
+    filter never gives a false negative, and gives a false
+    positive for about error_rate of the EINs that weren't
+    added.
+    """
+
+    def __init__(self, capacity, error_rate=DEFAULT_BLOOM_FILTER_ERROR_RATE):
+        """make an empty filter sized to hold capacity EINs
+        with the given error rate.
+        """
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(
+            int(round(float(self.size) / capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, ein):
+        # the positions of ein's bits, from two hashes combined
+        # as in Kirsch and Mitzenmacher's "Less Hashing, Same
+        # Performance".
+        if isinstance(ein, unicode):
+            ein = ein.encode('utf-8')
+        first, second = _HASHES.unpack(hashlib.md5(ein).digest())
+        return [(first + i * second) % self.size
+                for i in range(self.hash_count)]
+
+    def add(self, ein):
+        """add ein to the filter."""
+        bits = self._bits
+        for position in self._positions(ein):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, ein):
+        bits = self._bits
+        for position in self._positions(ein):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def copy(self):
+        """return a copy of the filter."""
+        bloom_filter = copy.copy(self)
+        bloom_filter._bits = bytearray(self._bits)
+        return bloom_filter
+
+    def estimated_error_rate(self):
+        """return the expected rate of false positives, given
+        how many of the filter's bits are set.
+        """
+        set_bits = sum(bin(byte).count('1') for byte in self._bits)
+        return (float(set_bits) / self.size) ** self.hash_count
+
+    def write(self, path):
+        """write the filter to path, replacing any old filter
+        atomically.
+        """
+        with replace_atomically(path) as f:
+            f.write(_HEADER.pack(
+                MAGIC, self.size, self.hash_count, self.count,
+                self.error_rate))
+            f.write(self._bits)
+
+    @classmethod
+    def load(cls, path):
+        """return the filter written to path."""
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+            bits = bytearray(f.read())
+        magic, size, hash_count, count, error_rate = _HEADER.unpack(header)
+        if magic != MAGIC or len(bits) != (size + 7) // 8:
+            raise ValueError("%s is not a charitychecker Bloom filter" % path)
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.size = size
+        bloom_filter.hash_count = hash_count
+        bloom_filter.count = count
+        bloom_filter.error_rate = error_rate
+        bloom_filter._bits = bits
+        return bloom_filter
+
+    @classmethod
+    def from_model(cls, model, error_rate=DEFAULT_BLOOM_FILTER_ERROR_RATE,
+                   using=None):
+        """build a filter of every EIN in model, an
+        IRSNonprofitData-like model, read from the database
+        BUILD_CHUNK_SIZE rows at a time.
+        """
+        queryset = model._default_manager.using(using).order_by('pk')
+        bloom_filter = cls(queryset.count(), error_rate)
+        last = None
+        while True:
+            chunk = queryset if last is None else queryset.filter(
+                pk__gt=last)
+            chunk = list(chunk.values_list('pk', flat=True)[:BUILD_CHUNK_SIZE])
+            for ein in chunk:
+                bloom_filter.add(ein)
+            if len(chunk) < BUILD_CHUNK_SIZE:
+                return bloom_filter
+            last = chunk[-1]
+
+
+def get_bloom_filter_path():
+    """return the path of the Bloom filter file, or None if
+    the filter isn't turned on.
+    """
+    return getattr(
+        settings, 'CHARITYCHECKER_BLOOM_FILTER_PATH',
+        DEFAULT_BLOOM_FILTER_PATH)
+
+
+def write_model_bloom_filter(model, path, using=None):
+    """build a Bloom filter of every EIN in model with the
+    CHARITYCHECKER_BLOOM_FILTER_ERROR_RATE, write it to path,
+    and return it.
+    """
+    bloom_filter = BloomFilter.from_model(
+        model, getattr(settings, 'CHARITYCHECKER_BLOOM_FILTER_ERROR_RATE',
+                       DEFAULT_BLOOM_FILTER_ERROR_RATE),
+        using)
+    bloom_filter.write(path)
+    logger.info(
+        "wrote a Bloom filter of %d EINs to %s: %d bytes, %d hash "
+        "functions, estimated false positive rate %.4f",
+        bloom_filter.count, path, len(bloom_filter._bits),
+        bloom_filter.hash_count, bloom_filter.estimated_error_rate())
+    return bloom_filter
+
+
+class PendingBloomFilter(object):
+    """a copy of bloom_filter, the filter at path, that the
+    EINs an update is about to commit are added to, so that it
+    can be written over the filter before they are committed.
+    Readers then never rule out EINs that are in the database,
+    even before the filter is rebuilt after the update.
+    """
+
+    def __init__(self, bloom_filter, path):
+        self.bloom_filter = bloom_filter.copy()
+        self.path = path
+
+    def add(self, ein):
+        self.bloom_filter.add(ein)
+
+    def prepare(self):
+        """write the filter over the old one, and wait until
+        every reader has had to check for it.
+        """
+        self.bloom_filter.write(self.path)
+        time.sleep(CHECK_INTERVAL)
+
+
+_holder = FileHolder(BloomFilter.load)
+
+
+def get_bloom_filter():
+    """return the BloomFilter at CHARITYCHECKER_BLOOM_FILTER_PATH,
+    loading it on first use, or None if the filter isn't
+    turned on or hasn't been written yet.
+    """
+    path = get_bloom_filter_path()
+    if path is None:
+        return None
+    return _holder.get(path)
@@ -0,0 +1,242 @@
+"""
+caching for the nonprofit lookups made by the
+django-charitychecker module.
+"""
+
+import threading
+import time
+import urllib
+import uuid
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.utils.encoding import force_text
+
+# Global Variables
+#
+# these can be overridden in settings.py
+
+# the default maximum number of EINs kept in each process's
+# lookup cache, set CHARITYCHECKER_LOOKUP_CACHE_SIZE to
+# change it, or to 0 to turn the lookup cache off.
+DEFAULT_LOOKUP_CACHE_SIZE = 10000
+
+# the default number of seconds before a cached lookup
+# expires, set CHARITYCHECKER_LOOKUP_CACHE_TTL to change it,
+# or to None so that lookups never expire. Cached lookups are
+# always dropped when the data is updated in the same
+# process, so this only bounds how stale other processes'
+# caches can get after an update.
+DEFAULT_LOOKUP_CACHE_TTL = 60 * 60
+
+# the alias, from CACHES, of the django cache that lookups
+# are shared between processes through, set
+# CHARITYCHECKER_SHARED_CACHE to turn the shared cache on.
+DEFAULT_SHARED_CACHE = None
+
+# the number of seconds lookups stay in the shared cache,
+# set CHARITYCHECKER_SHARED_CACHE_TIMEOUT to change it from
+# the django cache's own default timeout.
+DEFAULT_SHARED_CACHE_TIMEOUT = DEFAULT_TIMEOUT
+
+# End Global Variables
+
+# the generation of the nonprofit data, bumped every time
+# the data is updated so that cached lookups from earlier
+# generations are ignored.
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def get_generation():
+    """return the current generation of the nonprofit data."""
+    return _generation
+
+
+def bump_generation():
+    """start a new generation of the nonprofit data,
+    invalidating everything cached before now.
+    """
+    global _generation
+    with _generation_lock:
+        _generation += 1
+
+
+class LRUCache(object):
+    """a thread-safe, bounded, least recently used cache
+    whose entries expire after ttl seconds and whenever the
+    data's generation changes.
+
+    The cache keeps count of its hits, misses (including
+    lookups of expired or invalidated entries) and evictions
+    (entries dropped to make room for new ones), which are
+    reported by stats.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self._lock = threading.Lock()
+        self.configure(maxsize, ttl)
+
+    def configure(self, maxsize, ttl=None):
+        """empty the cache, reset its counters, and set its
+        maximum size and time to live. A maxsize of 0 turns
+        the cache off.
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._entries = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get(self, key, default=None):
+        """return the value cached for key, or default if
+        there is no current value for key.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                generation, expires, value = entry
+                if generation == _generation and (
+                    expires is None or expires > time.time()):
+                    # re-insert the entry as the most recently used
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, generation=None):
+        """cache value for key, evicting the least recently
+        used entry if the cache is full. Pass the generation
+        the value was read in, from get_generation, so that
+        values read just before an update are not cached as
+        current.
+        """
+        if not self.maxsize:
+            return
+        if generation is None:
+            generation = _generation
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (generation, expires, value)
+
+    def clear(self):
+        """remove every entry from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """return a dictionary of the cache's hit, miss and
+        eviction counts, current size and maximum size.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# the cache in front of IRSNonprofitData's lookups, mapping
+# EINs to their data, or to None for EINs not in the data.
+lookup_cache = LRUCache(
+    maxsize=getattr(
+        settings, 'CHARITYCHECKER_LOOKUP_CACHE_SIZE',
+        DEFAULT_LOOKUP_CACHE_SIZE),
+    ttl=getattr(
+        settings, 'CHARITYCHECKER_LOOKUP_CACHE_TTL',
+        DEFAULT_LOOKUP_CACHE_TTL))
+
+
+class SharedLookupCache(object):
+    """nonprofit lookups cached in one of django's caches, so
+    that they are shared by every process using that cache.
+
+    Keys are namespaced by a dataset version stored in the
+    cache itself. Publishing a new version, as happens after
+    every update of the data, moves every process on to a
+    fresh namespace at once, leaving the old lookups to
+    expire.
+    """
+
+    VERSION_KEY = 'charitychecker:version'
+
+    def __init__(self, cache, timeout=DEFAULT_TIMEOUT):
+        self.cache = cache
+        self.timeout = timeout
+
+    def get_version(self):
+        """return the current dataset version, starting a
+        new one if the cache doesn't have one.
+        """
+        version = self.cache.get(self.VERSION_KEY)
+        if version is None:
+            # another process may start one at the same time,
+            # so only add ours if there still isn't one.
+            self.cache.add(self.VERSION_KEY, uuid.uuid4().hex, None)
+            version = self.cache.get(self.VERSION_KEY)
+        return version
+
+    def publish_version(self):
+        """start a new dataset version, invalidating every
+        lookup cached before now.
+        """
+        self.cache.set(self.VERSION_KEY, uuid.uuid4().hex, None)
+
+    def _make_key(self, version, ein):
+        # quote EINs so that user input can't produce keys
+        # memcached would reject. quote only takes bytes.
+        return 'charitychecker:%s:%s' % (
+            version, urllib.quote(force_text(ein).encode('utf-8')))
+
+    def get_many(self, eins, version):
+        """return a dictionary mapping each of the given EINs
+        cached under version to its cached value.
+        """
+        keys = dict((self._make_key(version, ein), ein) for ein in eins)
+        return dict(
+            # empty tuples stand in for None, which django's
+            # caches can't tell apart from a missing key.
+            (keys[key], value or None)
+            for key, value in self.cache.get_many(keys.keys()).items())
+
+    def set_many(self, values, version):
+        """cache the values in values, a dictionary mapping
+        EINs to values, under version.
+        """
+        self.cache.set_many(
+            dict((self._make_key(version, ein),
+                  () if value is None else value)
+                 for ein, value in values.items()),
+            self.timeout)
+
+
+_shared_caches = {}
+
+
+def get_shared_cache():
+    """return the SharedLookupCache for the django cache named
+    by CHARITYCHECKER_SHARED_CACHE, or None if lookups aren't
+    shared between processes.
+    """
+    alias = getattr(
+        settings, 'CHARITYCHECKER_SHARED_CACHE', DEFAULT_SHARED_CACHE)
+    if alias is None:
+        return None
+    if alias not in _shared_caches:
+        _shared_caches[alias] = SharedLookupCache(
+            get_cache(alias),
+            getattr(settings, 'CHARITYCHECKER_SHARED_CACHE_TIMEOUT',
+                    DEFAULT_SHARED_CACHE_TIMEOUT))
+    return _shared_caches[alias]
@@ -0,0 +1,315 @@
+"""
+a compact, read-only, in-memory index of the nonprofit
+data, for verifying nonprofits without the database.
+"""
+
+import re
+import time
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from django.conf import settings
+from django.db import connections
+from django.utils.encoding import force_text
+from .caching import get_generation, DEFAULT_LOOKUP_CACHE_TTL
+
+# Global Variables
+#
+# these can be overridden in settings.py
+
+# whether IRSNonprofitData looks nonprofits up in an in-memory
+# NonprofitIndex instead of the database, set
+# CHARITYCHECKER_INDEX to True to turn the index on.
+DEFAULT_INDEX = False
+
+# End Global Variables
+
+# the number of rows read from the database at a time while
+# building an index.
+BUILD_CHUNK_SIZE = 10000
+
+# the seconds before a rebuild of the index that failed is
+# tried again, while the old index keeps answering lookups.
+REBUILD_RETRY_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+# EINs that can be stored as integers in the index; any
+# others are kept in a dictionary on the side.
+_EIN_RE = re.compile(r'[0-9]{9}\Z')
+
+
+def _text(value):
+    """return value as unicode, as the database returns it."""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _intern(value, ids, table):
+    """return the position of value in table, adding it to
+    table, and ids, a dictionary of the positions, if it is
+    new.
+    """
+    position = ids.get(value)
+    if position is None:
+        position = ids[value] = len(table)
+        table.append(value)
+    return position
+
+
+class NonprofitIndex(object):
+    """an immutable index of nonprofits, answering the same
+    questions as IRSNonprofitData's lookup methods.
+
+    EINs are kept as a sorted array of integers and looked up
+    with a binary search. Names are kept in one UTF-8 string
+    with an array of offsets into it, and cities and each
+    distinct combination of state, country and deductability
+    code are interned, so that each nonprofit takes up about
+    the length of its name plus a dozen bytes.
+    """
+
+    def __init__(self, rows):
+        """build the index from rows, tuples of the form
+        (ein, name, city, state, country, deductability_code).
+        If an EIN appears more than once, its first row wins.
+        """
+        eins = array('i')
+        names = []
+        name_offsets = array('I', [0])
+        city_ids = array('I')
+        tail_ids = array('I')
+        cities, city_positions = [], {}
+        tails, tail_positions = [], {}
+        self._others = {}
+        is_sorted = True
+        offset = 0
+        for ein, name, city, state, country, code in rows:
+            if not _EIN_RE.match(ein):
+                self._others.setdefault(ein, tuple(
+                    _text(value)
+                    for value in (name, city, state, country, code)))
+                continue
+            key = int(ein)
+            if eins and key <= eins[-1]:
+                is_sorted = False
+            eins.append(key)
+            name = _text(name).encode('utf-8')
+            names.append(name)
+            offset += len(name)
+            name_offsets.append(offset)
+            city_ids.append(
+                _intern(_text(city), city_positions, cities))
+            tail_ids.append(_intern(
+                (_text(state), _text(country), _text(code)),
+                tail_positions, tails))
+        self._names = ''.join(names)
+        del names
+        if not is_sorted:
+            eins, name_offsets, city_ids, tail_ids = self._sort(
+                eins, name_offsets, city_ids, tail_ids)
+        self._eins = eins
+        self._name_offsets = name_offsets
+        self._city_ids = city_ids
+        self._tail_ids = tail_ids
+        self._cities = cities
+        self._tails = tails
+
+    def _sort(self, eins, name_offsets, city_ids, tail_ids):
+        # put every array in EIN order, dropping repeated EINs,
+        # and rebuild the names to match.
+        order = sorted(range(len(eins)), key=eins.__getitem__)
+        sorted_eins = array('i')
+        sorted_offsets = array('I', [0])
+        sorted_city_ids = array('I')
+        sorted_tail_ids = array('I')
+        names = []
+        offset = 0
+        for i in order:
+            if sorted_eins and sorted_eins[-1] == eins[i]:
+                continue
+            sorted_eins.append(eins[i])
+            name = self._names[name_offsets[i]:name_offsets[i + 1]]
+            names.append(name)
+            offset += len(name)
+            sorted_offsets.append(offset)
+            sorted_city_ids.append(city_ids[i])
+            sorted_tail_ids.append(tail_ids[i])
+        self._names = ''.join(names)
+        return sorted_eins, sorted_offsets, sorted_city_ids, sorted_tail_ids
+
+    @classmethod
+    def from_model(cls, model, using=None):
+        """build an index of every row of model, an
+        IRSNonprofitData-like model, read from the database
+        BUILD_CHUNK_SIZE rows at a time.
+        """
+        def rows():
+            queryset = model._default_manager.using(using).order_by('pk')
+            last = None
+            while True:
+                chunk = queryset if last is None else queryset.filter(
+                    pk__gt=last)
+                chunk = list(chunk.values_list(
+                    'ein', 'name', 'city', 'state', 'country',
+                    'deductability_code')[:BUILD_CHUNK_SIZE])
+                for row in chunk:
+                    yield row
+                if len(chunk) < BUILD_CHUNK_SIZE:
+                    return
+                last = chunk[-1][0]
+        return cls(rows())
+
+    def get(self, ein):
+        """return a tuple of the name, city, state, country and
+        deductability code of the nonprofit with the given EIN,
+        or None if there is no such nonprofit.
+        """
+        ein = force_text(ein)
+        if not _EIN_RE.match(ein):
+            return self._others.get(ein)
+        key = int(ein)
+        i = bisect_left(self._eins, key)
+        if i == len(self._eins) or self._eins[i] != key:
+            return None
+        return (
+            self._names[
+                self._name_offsets[i]:self._name_offsets[i + 1]
+            ].decode('utf-8'),
+            self._cities[self._city_ids[i]]) + self._tails[self._tail_ids[i]]
+
+    def __contains__(self, ein):
+        return self.get(ein) is not None
+
+    def __len__(self):
+        return len(self._eins) + len(self._others)
+
+    def memory_usage(self):
+        """return roughly how many bytes the index takes up,
+        not counting the interned cities and tails, which are
+        shared by many nonprofits.
+        """
+        return (
+            len(self._names) +
+            sum(data.itemsize * len(data) for data in (
+                self._eins, self._name_offsets,
+                self._city_ids, self._tail_ids)))
+
+
+class _IndexHolder(object):
+    """holds the process's current NonprofitIndex, building it
+    on first use and rebuilding it when it goes stale.
+
+    When the data is updated in this process, bumping the
+    lookup cache's generation, the index is rebuilt by the
+    next lookup, which waits for it, so that lookups never
+    see the data from before the update. When the index is
+    older than the lookup cache's time to live, so that
+    updates made by other processes are picked up, it is
+    rebuilt in the background while the old index keeps
+    answering lookups. A background rebuild that fails is
+    logged and tried again REBUILD_RETRY_INTERVAL seconds
+    later.
+
+    Indexes are built by calling build with the model.
+    """
+
+    def __init__(self, build=NonprofitIndex.from_model):
+        self.build = build
+        self._lock = threading.Lock()
+        self._index = None
+        self._generation = None
+        self._expires = None
+        self._rebuilding = False
+        self._thread = None
+
+    def get(self, model):
+        """return the current index of model."""
+        index = self._index
+        if (index is not None and
+            self._generation == get_generation() and
+            (self._expires is None or time.time() < self._expires)):
+            # the common case, answered without taking the lock.
+            return index
+        with self._lock:
+            if self._index is None or self._generation != get_generation():
+                self._build(model)
+                return self._index
+            index = self._index
+            rebuild = not self._rebuilding
+            self._rebuilding = True
+        if rebuild:
+            self._start_rebuild(model)
+        return index
+
+    def clear(self):
+        """drop the current index."""
+        with self._lock:
+            self._index = None
+
+    def _set_index(self, index, generation):
+        ttl = getattr(settings, 'CHARITYCHECKER_LOOKUP_CACHE_TTL',
+                      DEFAULT_LOOKUP_CACHE_TTL)
+        self._expires = None if ttl is None else time.time() + ttl
+        self._generation = generation
+        self._index = index
+
+    def _build(self, model):
+        generation = get_generation()
+        self._set_index(self.build(model), generation)
+
+    def _start_rebuild(self, model):
+        self._thread = threading.Thread(
+            target=self._rebuild_in_background, args=(model,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _rebuild_in_background(self, model):
+        try:
+            self._rebuild(model)
+        finally:
+            # don't leave this thread's connections open.
+            for connection in connections.all():
+                connection.close()
+
+    def _rebuild(self, model):
+        try:
+            stale_index = self._index
+            generation = get_generation()
+            try:
+                index = self.build(model)
+            except Exception:
+                logger.exception(
+                    "couldn't rebuild the nonprofit index, trying "
+                    "again in %d seconds", REBUILD_RETRY_INTERVAL)
+                with self._lock:
+                    self._expires = time.time() + REBUILD_RETRY_INTERVAL
+                return
+            with self._lock:
+                # unless the index was cleared, and maybe built
+                # afresh, in the meantime.
+                if self._index is stale_index:
+                    self._set_index(index, generation)
+        finally:
+            self._rebuilding = False
+
+
+_holder = _IndexHolder()
+
+
+def get_index(model):
+    """return the current NonprofitIndex of model, or None if
+    CHARITYCHECKER_INDEX isn't turned on.
+    """
+    if not getattr(settings, 'CHARITYCHECKER_INDEX', DEFAULT_INDEX):
+        return None
+    return _holder.get(model)
+
+
+def clear_index():
+    """drop the current NonprofitIndex, so that it is rebuilt
+    on next use.
+    """
+    _holder.clear()
@@ -0,0 +1,274 @@
+"""
+instrumentation of the updates made by the
+django-charitychecker module: how long each stage of an
+update takes, how many queries it makes, and how many rows
+and bytes it goes through.
+"""
+
+import time
+import socket
+import logging
+import threading
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_by_path
+
+# Global Variables
+#
+# these can be overridden in settings.py
+
+# the dotted path of the class every update's metrics are
+# reported to, as described in get_metrics_sink, set
+# CHARITYCHECKER_METRICS_SINK to turn reporting on, for
+# example to 'charitychecker.metrics.StatsdSink'.
+DEFAULT_METRICS_SINK = None
+
+# the address of the statsd server StatsdSink sends metrics
+# to, set CHARITYCHECKER_STATSD_HOST and
+# CHARITYCHECKER_STATSD_PORT to change it.
+DEFAULT_STATSD_HOST = 'localhost'
+DEFAULT_STATSD_PORT = 8125
+
+# End Global Variables
+
+logger = logging.getLogger(__name__)
+
+# the prefix of the names of the metrics sent to sinks.
+METRICS_PREFIX = 'charitychecker.update'
+
+# the number of items timed at once by UpdateMetrics.timed,
+# so that the cost of timing is spread over many of them.
+TIMED_CHUNK_SIZE = 1000
+
+_local = threading.local()
+
+
+class Timer(object):
+    """the time taken by a stage of an update and the number
+    of queries made during it, added up over every time the
+    timer is entered.
+    """
+
+    def __init__(self, name, metrics):
+        self.name = name
+        self.seconds = 0.0
+        self.queries = 0
+        self._metrics = metrics
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        self._metrics._running.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._metrics._running.remove(self)
+        self.seconds += time.time() - self._start
+
+    def stats(self):
+        """return the timer's totals as a dictionary."""
+        return {'stage': self.name, 'seconds': self.seconds,
+                'queries': self.queries}
+
+
+class UpdateMetrics(object):
+    """the timers and counters of an update.
+
+    Timers are named after the stages of the update they
+    time: 'download', 'read' (unzipping, normalizing and
+    converting the data), 'load' (reading the rows already in
+    the database), 'stage' (loading the data into the staging
+    or shadow engine's table), 'insert', 'update' and 'delete'
+    (writing the changes), 'diff' and 'swap' (comparing the
+    shadow engine's table with the table and swapping them),
+    'dataset_updating' (preparing the signal's watchers),
+    'dataset_updated' (the receivers of the signal) and
+    'total'. While measure_queries is active,
+    every query made through the database using is counted
+    against the timers running at the time.
+    """
+
+    def __init__(self):
+        self.timers = OrderedDict()
+        self.counters = OrderedDict()
+        self._running = []
+
+    def timer(self, name):
+        """return the Timer named name, creating it if this is
+        its first use.
+        """
+        if name not in self.timers:
+            self.timers[name] = Timer(name, self)
+        return self.timers[name]
+
+    def incr(self, name, value=1):
+        """add value to the counter named name."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def timed(self, name, iterable, counter=None):
+        """return a generator of the items of iterable,
+        counting the time taken to produce them on the timer
+        named name, and the items themselves on the counter
+        named counter, if given.
+        """
+        timer = self.timer(name)
+        iterator = iter(iterable)
+        while True:
+            with timer:
+                chunk = list(itertools.islice(iterator, TIMED_CHUNK_SIZE))
+            if counter is not None:
+                self.incr(counter, len(chunk))
+            for item in chunk:
+                yield item
+            if len(chunk) < TIMED_CHUNK_SIZE:
+                return
+
+    @contextmanager
+    def measure_queries(self, using):
+        """count the queries made through the database using
+        while active, by handing out cursors that count them.
+        """
+        connection = connections[using]
+        # cursor is replaced on the connection itself, which
+        # django keeps per thread, rather than on its class.
+        replaced = connection.__dict__.get('cursor')
+        cursor = connection.cursor
+
+        def counting_cursor(*args, **kwargs):
+            return _CountingCursor(cursor(*args, **kwargs), self)
+        connection.cursor = counting_cursor
+        try:
+            yield
+        finally:
+            if replaced is None:
+                del connection.cursor
+            else:
+                connection.cursor = replaced
+
+    @contextmanager
+    def activate(self):
+        """make these the metrics current_metrics returns, on
+        this thread, while active.
+        """
+        previous = getattr(_local, 'metrics', None)
+        _local.metrics = self
+        try:
+            yield self
+        finally:
+            _local.metrics = previous
+
+    def _count_query(self):
+        for timer in self._running:
+            timer.queries += 1
+
+    def summary(self):
+        """return the metrics as a dictionary of 'stages', a
+        list of each timer's stats in the order they were
+        first used, and 'counters'.
+        """
+        return {
+            'stages': [timer.stats() for timer in self.timers.values()],
+            'counters': dict(self.counters)}
+
+    def report(self, sink):
+        """send the metrics to sink."""
+        for timer in self.timers.values():
+            sink.timing('%s.seconds' % timer.name, timer.seconds)
+            sink.incr('%s.queries' % timer.name, timer.queries)
+        for name, value in self.counters.items():
+            sink.incr(name, value)
+
+
+class _CountingCursor(object):
+    """a database cursor that counts the queries made with it
+    in metrics.
+    """
+
+    def __init__(self, cursor, metrics):
+        self.cursor = cursor
+        self.metrics = metrics
+
+    def execute(self, *args, **kwargs):
+        self.metrics._count_query()
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.metrics._count_query()
+        return self.cursor.executemany(*args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        self.metrics._count_query()
+        return self.cursor.copy_expert(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def current_metrics():
+    """return the UpdateMetrics of the update running on this
+    thread, or, if there isn't one, metrics nobody will see,
+    so that the parts of an update can always be measured.
+    """
+    metrics = getattr(_local, 'metrics', None)
+    return UpdateMetrics() if metrics is None else metrics
+
+
+class LoggingSink(object):
+    """a metrics sink that logs every metric."""
+
+    def timing(self, name, seconds):
+        logger.info("%s.%s: %.3fs", METRICS_PREFIX, name, seconds)
+
+    def incr(self, name, value=1):
+        logger.info("%s.%s: %d", METRICS_PREFIX, name, value)
+
+
+class StatsdSink(object):
+    """a metrics sink that sends every metric to a statsd
+    server over UDP, at host and port, defaulting to the
+    CHARITYCHECKER_STATSD_HOST and CHARITYCHECKER_STATSD_PORT
+    settings. Metrics that can't be sent are dropped, as
+    statsd's are.
+    """
+
+    def __init__(self, host=None, port=None, prefix=METRICS_PREFIX):
+        if host is None:
+            host = getattr(settings, 'CHARITYCHECKER_STATSD_HOST',
+                           DEFAULT_STATSD_HOST)
+        if port is None:
+            port = getattr(settings, 'CHARITYCHECKER_STATSD_PORT',
+                           DEFAULT_STATSD_PORT)
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, seconds):
+        self._send('%s.%s:%d|ms' % (self.prefix, name, seconds * 1000))
+
+    def incr(self, name, value=1):
+        self._send('%s.%s:%d|c' % (self.prefix, name, value))
+
+    def _send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error as e:
+            logger.debug("couldn't send %r to statsd: %s", data, e)
+
+
+def get_metrics_sink():
+    """return a new instance of the class named by the
+    CHARITYCHECKER_METRICS_SINK setting, or None if it isn't
+    set. A sink is any object with timing(name, seconds) and
+    incr(name, value) methods.
+    """
+    path = getattr(settings, 'CHARITYCHECKER_METRICS_SINK',
+                   DEFAULT_METRICS_SINK)
+    if path is None:
+        return None
+    return import_by_path(path)()
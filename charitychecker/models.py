@@ -1,4 +1,44 @@
-from django.db import models
+import sys
+import logging
+import functools
+from django.db import models, router
+from django.db.models.signals import post_syncdb
+from django.dispatch import receiver
+from django.utils.encoding import force_text
+from .caching import (
+    lookup_cache, get_generation, bump_generation, get_shared_cache)
+from .batching import LookupFuture, gather, get_lookup_batcher
+from .bloom import (
+    PendingBloomFilter, get_bloom_filter, get_bloom_filter_path,
+    write_model_bloom_filter)
+from .index import get_index
+from .search import (
+    DEFAULT_SEARCH_LIMIT, NORMALIZED_NAME_LENGTH, create_search_index,
+    rebuild_search_index, search_eins,
+    normalize_name, name_similarity, best_name_similarity,
+    nearby_normalized_names)
+from .snapshot import get_snapshot, get_snapshot_path, write_model_snapshot
+from .signals import dataset_updated, dataset_updating
+
+# the fields, after the EIN, that verify_nonprofit and
+# get_deductability_code compare against, in the same order
+# as the columns of IRS Publication 78.
+LOOKUP_FIELDS = (
+    'name', 'city', 'state', 'country', 'deductability_code')
+
+# the number of EINs looked up per query by the batch
+# methods, kept under SQLite's limit of 999 query parameters.
+BATCH_QUERY_SIZE = 900
+
+# the most nonprofits a fuzzy match without an EIN compares
+# names with.
+FUZZY_MATCH_CANDIDATES = 1000
+
+# marks EINs missing from the lookup cache, as opposed to
+# EINs cached as not being in the database.
+_NOT_CACHED = object()
+
+logger = logging.getLogger(__name__)
 
 
 class IRSNonprofitData(models.Model):
@@ -18,6 +58,11 @@ class IRSNonprofitData(models.Model):
         max_length=50, editable=False)
     deductability_code = models.CharField(
         max_length=5, editable=False)
+    # the name normalized by normalize_name, for finding
+    # nonprofits by a name that's written differently.
+    normalized_name = models.CharField(
+        max_length=NORMALIZED_NAME_LENGTH, db_index=True, editable=False,
+        default='')
 
     class Meta:
         verbose_name = "IRS nonprofit datum"
@@ -36,29 +81,54 @@ class IRSNonprofitData(models.Model):
     def __str__(self):
         return str(unicode(self))
 
+    def save(self, *args, **kwargs):
+        # updates of the data fill normalized_name in
+        # themselves, but rows saved any other way, such as
+        # through the admin, need it too.
+        self.normalized_name = normalize_name(self.name)
+        super(IRSNonprofitData, self).save(*args, **kwargs)
+
     @classmethod
     def verify_nonprofit(
         cls, ein, name=None, city=None, state=None,
-        country=None, deductability_code=None):
+        country=None, deductability_code=None, match='exact'):
         """return true if there is a nonprofit in the
         charitychecker database with information matching
         the information provided to the function as
         arguments, return false otherwise.
+
+        With match='fuzzy', name only has to be similar to the
+        nonprofit's name, and how similar, from 0 to 1, is
+        returned instead, or 0 if no nonprofit matches the
+        other arguments. ein may then be None, to find the
+        nonprofit by name, as described in _fuzzy_match.
         """
-        try:
-            nonprofit = cls.objects.get(pk=ein)
-        except(cls.DoesNotExist):
-            return False
-        nonprofit_verified = True
-        for attr_name, arg_value in [
-            ('name', name), ('city', city),
-            ('state', state), ('country', country),
-            ('deductability_code', deductability_code)]:
-            if arg_value != None:
-                nonprofit_verified = (
-                    nonprofit_verified and
-                    arg_value == getattr(nonprofit, attr_name))
-        return nonprofit_verified
+        values = (city, state, country, deductability_code)
+        if match == 'fuzzy':
+            return cls._fuzzy_match(ein, name, values)
+        if match != 'exact':
+            raise ValueError("unknown match: %r" % (match,))
+        return _matches(cls._get_nonprofit_data(ein), (name,) + values)
+
+    @classmethod
+    def verify_nonprofits(cls, nonprofits, chunk_size=None):
+        """verify many nonprofits at once, returning a list
+        of booleans in the same order as nonprofits.
+
+        Each nonprofit is either a tuple of the form
+        (ein, name, city, state, country, deductability_code),
+        where trailing values may be left off, or a dictionary
+        of keyword arguments to verify_nonprofit. Matching works
+        exactly as in verify_nonprofit, but the nonprofits are
+        looked up with one query per chunk_size EINs rather
+        than one query each.
+        """
+        queries = [_as_query(nonprofit) for nonprofit in nonprofits]
+        nonprofit_data = cls._get_many_nonprofit_data(
+            set(ein for ein, values in queries), chunk_size)
+        return [
+            _matches(nonprofit_data.get(ein), values)
+            for ein, values in queries]
 
     @classmethod
     def get_deductability_code(
@@ -70,20 +140,325 @@ class IRSNonprofitData(models.Model):
         nonprofit's deductability code, otherwise return the
         empty string.
         """
-        try:
-            nonprofit = cls.objects.get(pk=ein)
-        except(cls.DoesNotExist):
-            return ''
-        nonprofit_verified = True
-        for attr_name, arg_value in [
-            ('name', name), ('city', city),
-            ('state', state), ('country', country)]:
-            if arg_value != None:
-                nonprofit_verified = (
-                    nonprofit_verified and
-                    arg_value == getattr(nonprofit, attr_name))
-        if nonprofit_verified:
-            return nonprofit.deductability_code
+        nonprofit_data = cls._get_nonprofit_data(ein)
+        if _matches(nonprofit_data, (name, city, state, country)):
+            return nonprofit_data[-1]
         else:
             return ''
 
+    # asynchronous methods
+
+    @classmethod
+    def averify_nonprofit(
+        cls, ein, name=None, city=None, state=None,
+        country=None, deductability_code=None):
+        """like verify_nonprofit, but return a LookupFuture of
+        the answer straight away. Lookups that aren't cached
+        are made on a background thread, where lookups made at
+        about the same time, from any thread, are batched into
+        one query.
+        """
+        return cls._aget_nonprofit_data(ein).then(
+            lambda nonprofit_data: _matches(
+                nonprofit_data,
+                (name, city, state, country, deductability_code)))
+
+    @classmethod
+    def aget_deductability_code(
+        cls, ein, name=None, city=None, state=None,
+        country=None):
+        """like get_deductability_code, but return a
+        LookupFuture of the answer, as averify_nonprofit does.
+        """
+        def get_deductability_code(nonprofit_data):
+            if _matches(nonprofit_data, (name, city, state, country)):
+                return nonprofit_data[-1]
+            return ''
+        return cls._aget_nonprofit_data(ein).then(get_deductability_code)
+
+    @classmethod
+    def averify_nonprofits(cls, nonprofits):
+        """like verify_nonprofits, but return a LookupFuture of
+        the answers, as averify_nonprofit does.
+        """
+        queries = [_as_query(nonprofit) for nonprofit in nonprofits]
+        eins = list(set(ein for ein, values in queries))
+
+        def verify_nonprofits(results):
+            nonprofit_data = dict(zip(eins, results))
+            return [
+                _matches(nonprofit_data[ein], values)
+                for ein, values in queries]
+        return gather(
+            cls._aget_nonprofit_data(ein) for ein in eins
+        ).then(verify_nonprofits)
+
+    @classmethod
+    def search(cls, name, state=None, limit=DEFAULT_SEARCH_LIMIT):
+        """return a list of up to limit nonprofits, in state if
+        it's given, whose names have a word beginning with each
+        word of name, best matches first.
+        """
+        eins = search_eins(cls, name, state, limit)
+        nonprofits = cls.objects.in_bulk(eins)
+        return [nonprofits[ein] for ein in eins if ein in nonprofits]
+
+    # data access methods
+
+    @classmethod
+    def _aget_nonprofit_data(cls, ein):
+        """return a LookupFuture of what _get_nonprofit_data
+        returns, answered straight away from the snapshot,
+        index or lookup cache if possible, or otherwise by the
+        model's LookupBatcher.
+        """
+        ein = _as_ein(ein)
+        local_data = _get_local_data(cls)
+        if local_data is not None:
+            return LookupFuture.resolved(local_data.get(ein))
+        nonprofit_data = lookup_cache.get(ein, _NOT_CACHED)
+        if nonprofit_data is not _NOT_CACHED:
+            return LookupFuture.resolved(nonprofit_data)
+        return get_lookup_batcher(cls).submit(ein)
+
+    @classmethod
+    def _fuzzy_match(cls, ein, name, values):
+        """return the similarity of name to the name of the
+        best matching nonprofit with the given EIN, whose other
+        LOOKUP_FIELDS agree with values.
+
+        Without an EIN, the nonprofits considered are up to
+        FUZZY_MATCH_CANDIDATES of those whose normalized names
+        start with the first word of name's, and are nearest to
+        it in sorted order, found with one query through the
+        index of normalized names.
+        """
+        if ein is not None:
+            nonprofit_data = cls._get_nonprofit_data(ein)
+            if not _matches(nonprofit_data, (None,) + values):
+                return 0.0
+            if name is None:
+                return 1.0
+            return name_similarity(
+                normalize_name(name), normalize_name(nonprofit_data[0]))
+        if name is None:
+            raise ValueError("a fuzzy match needs an EIN or a name")
+        normalized_name = normalize_name(name)
+        if not normalized_name:
+            return 0.0
+        return best_name_similarity(
+            normalized_name, nearby_normalized_names(
+                cls, normalized_name,
+                dict((field, value) for field, value in
+                     zip(LOOKUP_FIELDS[1:], values) if value is not None),
+                FUZZY_MATCH_CANDIDATES))
+
+    @classmethod
+    def _get_nonprofit_data(cls, ein):
+        """return a tuple of the LOOKUP_FIELDS values for the
+        nonprofit with the given EIN, or None if there is no
+        such nonprofit. Goes through the snapshot or in-memory
+        index, if either is turned on, or otherwise the lookup
+        caches.
+        """
+        ein = _as_ein(ein)
+        local_data = _get_local_data(cls)
+        if local_data is not None:
+            return local_data.get(ein)
+        nonprofit_data = lookup_cache.get(ein, _NOT_CACHED)
+        if nonprofit_data is _NOT_CACHED:
+            nonprofit_data = cls._load_nonprofit_data([ein]).get(ein)
+        return nonprofit_data
+
+    @classmethod
+    def _get_many_nonprofit_data(cls, eins, chunk_size=None):
+        """return a dictionary mapping each of the given EINs
+        that is in the database to a tuple of its LOOKUP_FIELDS
+        values. Goes through the snapshot or in-memory index, if
+        either is turned on, or otherwise the lookup caches.
+        The EINs are converted to text, as the keys are.
+        """
+        eins = set(_as_ein(ein) for ein in eins)
+        local_data = _get_local_data(cls)
+        if local_data is not None:
+            found = ((ein, local_data.get(ein)) for ein in eins)
+            return dict(
+                (ein, values) for ein, values in found
+                if values is not None)
+        nonprofit_data = {}
+        uncached_eins = []
+        for ein in eins:
+            values = lookup_cache.get(ein, _NOT_CACHED)
+            if values is _NOT_CACHED:
+                uncached_eins.append(ein)
+            elif values is not None:
+                nonprofit_data[ein] = values
+        nonprofit_data.update(
+            cls._load_nonprofit_data(uncached_eins, chunk_size))
+        return nonprofit_data
+
+    @classmethod
+    def _load_nonprofit_data(cls, eins, chunk_size=None):
+        """return a dictionary mapping each of the given EINs
+        that is in the database to a tuple of its LOOKUP_FIELDS
+        values, trying the shared cache, if there is one, before
+        querying the database chunk_size EINs at a time. Stores
+        what it finds in the caches. EINs the Bloom filter, if
+        it's turned on, rules out are never looked up.
+        """
+        chunk_size = chunk_size or BATCH_QUERY_SIZE
+        generation = get_generation()
+        bloom_filter = get_bloom_filter()
+        if bloom_filter is not None:
+            eins = [ein for ein in eins if ein in bloom_filter]
+        loaded = {}
+        shared_cache = get_shared_cache()
+        if shared_cache is not None and eins:
+            version = shared_cache.get_version()
+            loaded.update(shared_cache.get_many(eins, version))
+            eins = [ein for ein in eins if ein not in loaded]
+        queried = {}
+        for i in range(0, len(eins), chunk_size):
+            chunk = eins[i:i + chunk_size]
+            found = dict(
+                (values[0], values[1:])
+                for values in cls.objects.filter(
+                    pk__in=chunk).values_list('ein', *LOOKUP_FIELDS))
+            for ein in chunk:
+                queried[ein] = found.get(ein)
+        if shared_cache is not None and queried:
+            shared_cache.set_many(queried, version)
+        loaded.update(queried)
+        for ein, values in loaded.items():
+            lookup_cache.set(ein, values, generation)
+        return dict(
+            (ein, values) for ein, values in loaded.items()
+            if values is not None)
+
+
+@receiver(dataset_updated, sender=IRSNonprofitData)
+def _invalidate_lookup_caches(sender, **kwargs):
+    """drop every cached lookup once the nonprofit data
+    has been updated.
+    """
+    bump_generation()
+    shared_cache = get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.publish_version()
+
+
+def _logging_errors(function):
+    """wrap function, a dataset_updated receiver that brings
+    files or indexes up-to-date with the data, so that its
+    errors are logged rather than raised from an update that
+    has already been committed.
+    """
+    @functools.wraps(function)
+    def wrapper(sender, **kwargs):
+        try:
+            function(sender, **kwargs)
+        except Exception:
+            logger.exception(
+                "%s failed after the data was updated", function.__name__)
+    return wrapper
+
+
+@receiver(dataset_updating, sender=IRSNonprofitData)
+def _extend_bloom_filter(sender, **kwargs):
+    """return a PendingBloomFilter for an update of the
+    nonprofit data, if the Bloom filter is turned on, so that
+    EINs the update inserts are added to the filter before
+    they're committed.
+    """
+    bloom_filter = get_bloom_filter()
+    if bloom_filter is not None:
+        return PendingBloomFilter(bloom_filter, get_bloom_filter_path())
+
+
+@receiver(dataset_updated, sender=IRSNonprofitData)
+@_logging_errors
+def _write_snapshot(sender, using=None, **kwargs):
+    """write a new snapshot file, from the database that was
+    updated, once the nonprofit data has been updated, if the
+    snapshot is turned on.
+    """
+    path = get_snapshot_path()
+    if path is not None:
+        write_model_snapshot(sender, path, using)
+
+
+@receiver(dataset_updated, sender=IRSNonprofitData)
+@_logging_errors
+def _write_bloom_filter(sender, using=None, **kwargs):
+    """write a new Bloom filter file, from the database that
+    was updated, once the nonprofit data has been updated, if
+    the filter is turned on.
+    """
+    path = get_bloom_filter_path()
+    if path is not None:
+        write_model_bloom_filter(sender, path, using)
+
+
+@receiver(dataset_updated, sender=IRSNonprofitData)
+@_logging_errors
+def _rebuild_search_index(sender, using=None, **kwargs):
+    """bring the search index of the database that was
+    updated up-to-date once the nonprofit data has been
+    updated.
+    """
+    rebuild_search_index(sender, using)
+
+
+@receiver(post_syncdb, sender=sys.modules[__name__])
+def _create_search_index(sender, db, **kwargs):
+    """create the search index when syncdb is run."""
+    if router.allow_syncdb(db, IRSNonprofitData):
+        create_search_index(IRSNonprofitData, db)
+
+
+def _get_local_data(model):
+    """return the Snapshot, or failing that the
+    NonprofitIndex, to look nonprofits up in instead of the
+    database, or None if neither is turned on.
+    """
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot
+    return get_index(model)
+
+
+def _as_ein(ein):
+    """return ein as text, as the database would compare it
+    with the EIN column, so that EINs given as integers or
+    bytes are found in the caches and local data too.
+    """
+    return force_text(ein)
+
+
+def _as_query(nonprofit):
+    """convert a nonprofit passed to verify_nonprofits into
+    a pair of its EIN, as text, and a tuple of the values to
+    match against LOOKUP_FIELDS, using None for missing
+    values.
+    """
+    if isinstance(nonprofit, dict):
+        return (_as_ein(nonprofit['ein']),
+                tuple(nonprofit.get(attr_name)
+                      for attr_name in LOOKUP_FIELDS))
+    values = tuple(nonprofit[1:])
+    return (_as_ein(nonprofit[0]),
+            values + (None,) * (len(LOOKUP_FIELDS) - len(values)))
+
+
+def _matches(nonprofit_data, values):
+    """return true if nonprofit_data, a tuple of LOOKUP_FIELDS
+    values, is not None and agrees with every value in values
+    that is not None, otherwise return false. values may leave
+    off trailing fields.
+    """
+    if nonprofit_data is None:
+        return False
+    for arg_value, attr_value in zip(values, nonprofit_data):
+        if arg_value is not None and arg_value != attr_value:
+            return False
+    return True
@@ -0,0 +1,374 @@
+"""
+searching the nonprofit data by name, through a full text
+index on SQLite and a trigram index on PostgreSQL, and
+matching names fuzzily.
+"""
+
+import re
+import string
+import difflib
+import logging
+import unicodedata
+from django.db import connections, router, transaction, DatabaseError
+
+# the default maximum number of nonprofits a search returns.
+DEFAULT_SEARCH_LIMIT = 20
+
+# the most matching nonprofits a search ranks; when more names
+# match, the RANK_CANDIDATES the database ranks best are
+# ranked again, and the best of those returned.
+RANK_CANDIDATES = 1000
+
+logger = logging.getLogger(__name__)
+
+# the words of a search, which each have to begin a word of a
+# nonprofit's name for it to match.
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# whether each database, by alias, has a search index.
+_has_search_index = {}
+
+# abbreviations spelled out, and words left out, by
+# normalize_name.
+NAME_ABBREVIATIONS = {
+    '&': 'and', 'amer': 'american', 'assn': 'association',
+    'assoc': 'association', 'bros': 'brothers', 'centre': 'center',
+    'ctr': 'center', 'cty': 'county', 'dept': 'department',
+    'fdn': 'foundation', 'fndn': 'foundation', 'ft': 'fort',
+    'hosp': 'hospital', 'intl': 'international', 'mt': 'mount',
+    'natl': 'national', 'soc': 'society', 'st': 'saint',
+    'univ': 'university'}
+NAME_STOP_WORDS = frozenset([
+    'co', 'corp', 'corporation', 'inc', 'incorporated', 'llc', 'ltd',
+    'the'])
+
+# the length of IRSNonprofitData's normalized_name column.
+NORMALIZED_NAME_LENGTH = 100
+
+# lower cases letters and turns everything but letters,
+# digits and "&" into spaces, with str.translate, which is
+# twice as fast as finding the words with a regex.
+_NAME_CHARACTERS = ''.join(
+    character.lower()
+    if character in string.ascii_letters + string.digits + '&' else ' '
+    for character in map(chr, range(256)))
+_NON_ASCII_RE = re.compile(r'[^\x00-\x7f]')
+
+
+def _search_table(model, connection):
+    """return the quoted name of model's full text search table."""
+    return connection.ops.quote_name(model._meta.db_table + '_search')
+
+
+def _search_index(model, connection):
+    """return the quoted name of model's trigram index."""
+    return connection.ops.quote_name(model._meta.db_table + '_name_trgm')
+
+
+def create_search_index(model, using=None):
+    """create the search index of model, an IRSNonprofitData-
+    like model, if the database supports one and it doesn't
+    exist yet, and return whether the database now has one.
+
+    On SQLite the index is an FTS5 table of the EINs and
+    names, which is filled from model's table and has to be
+    rebuilt, with rebuild_search_index, whenever the data
+    changes. On PostgreSQL it's a pg_trgm index on the name
+    column, which the database keeps up-to-date itself. Other
+    databases have no search index.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    try:
+        with transaction.atomic(using=using):
+            cursor = connection.cursor()
+            if connection.vendor == 'sqlite':
+                if (model._meta.db_table + '_search' not in
+                        connection.introspection.table_names()):
+                    _create_search_table(model, connection)
+            elif connection.vendor == 'postgresql':
+                cursor.execute(
+                    'SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                    [model._meta.db_table + '_name_trgm'])
+                if cursor.fetchone() is None:
+                    cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                    cursor.execute(
+                        'CREATE INDEX %s ON %s USING gin (%s gin_trgm_ops)'
+                        % (_search_index(model, connection),
+                           qn(model._meta.db_table), qn('name')))
+            else:
+                _has_search_index[using] = False
+                return False
+    except DatabaseError as e:
+        logger.warning(
+            "couldn't create the nonprofit search index, searches "
+            "will scan the whole table: %s", e)
+        _has_search_index[using] = False
+        return False
+    _has_search_index[using] = True
+    return True
+
+
+def _create_search_table(model, connection):
+    # create the full text search table, with prefix indexes
+    # for words' first two and three letters, and copy every
+    # EIN and name into it.
+    qn = connection.ops.quote_name
+    search_table = _search_table(model, connection)
+    cursor = connection.cursor()
+    cursor.execute(
+        "CREATE VIRTUAL TABLE %s USING fts5("
+        "ein UNINDEXED, name, prefix='2 3')" % search_table)
+    cursor.execute(
+        'INSERT INTO %s (ein, name) SELECT %s, %s FROM %s' % (
+            search_table, qn(model._meta.pk.column), qn('name'),
+            qn(model._meta.db_table)))
+
+
+def rebuild_search_index(model, using=None):
+    """bring model's search index up-to-date with its table,
+    which only needs doing on SQLite.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or not has_search_index(model, using):
+        return
+    # dropping and refilling the table is about twice as fast
+    # as deleting every row from it.
+    with transaction.atomic(using=using):
+        connection.cursor().execute(
+            'DROP TABLE %s' % _search_table(model, connection))
+        _create_search_table(model, connection)
+
+
+def index_shadow_table(model, table, using=None):
+    """give table, a copy of model's table that is about to
+    replace it, the search index model's table has, and
+    return the statements that give the index its proper name
+    once table has replaced model's table. Only PostgreSQL's
+    index is kept on the table itself, so there's nothing to
+    do elsewhere.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    if (connection.vendor != 'postgresql' or
+            not has_search_index(model, using)):
+        return []
+    qn = connection.ops.quote_name
+    index = qn(table + '_name_trgm')
+    connection.cursor().execute(
+        'CREATE INDEX %s ON %s USING gin (%s gin_trgm_ops)' % (
+            index, qn(table), qn('name')))
+    return ['ALTER INDEX %s RENAME TO %s' % (
+        index, _search_index(model, connection))]
+
+
+def has_search_index(model, using=None):
+    """return whether the database has a search index of
+    model.
+    """
+    using = using or router.db_for_read(model)
+    if using not in _has_search_index:
+        connection = connections[using]
+        if connection.vendor == 'sqlite':
+            _has_search_index[using] = (
+                model._meta.db_table + '_search' in
+                connection.introspection.table_names())
+        elif connection.vendor == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute(
+                'SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                [model._meta.db_table + '_name_trgm'])
+            _has_search_index[using] = cursor.fetchone() is not None
+        else:
+            _has_search_index[using] = False
+    return _has_search_index[using]
+
+
+def search_eins(model, name, state=None, limit=DEFAULT_SEARCH_LIMIT,
+                using=None):
+    """return a list of the EINs of up to limit nonprofits of
+    model, an IRSNonprofitData-like model, in state, if it's
+    given, whose names have a word beginning with each word of
+    name, best matches first.
+
+    Matching ignores case, and on SQLite accents too. Names
+    with fewer words, and then shorter names, are the better
+    matches. Without a search index, the whole table is
+    scanned for names containing each word, which is much
+    slower.
+    """
+    words = _WORD_RE.findall(name.lower())
+    if not words:
+        return []
+    using = using or router.db_for_read(model)
+    connection = connections[using]
+    if has_search_index(model, using):
+        candidates = _search_candidates(
+            model, connection, words, state)
+    else:
+        queryset = model._default_manager.using(using)
+        for word in words:
+            queryset = queryset.filter(name__icontains=word)
+        if state is not None:
+            queryset = queryset.filter(state=state)
+        candidates = queryset.values_list('pk', 'name')[:RANK_CANDIDATES]
+    candidates = sorted(candidates, key=lambda (ein, name): (
+        len(_WORD_RE.findall(name)), len(name), name))
+    return [ein for ein, name in candidates[:limit]]
+
+
+def _search_candidates(model, connection, words, state):
+    # the EINs and names of up to RANK_CANDIDATES nonprofits
+    # matching words, found through the search index, best
+    # first by the index's own rank: bm25 on SQLite, which
+    # favours short names, and trigram similarity to the
+    # search on PostgreSQL. Ranking every match in Python takes
+    # over a second for the commonest words.
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    if connection.vendor == 'sqlite':
+        search_table = _search_table(model, connection)
+        sql = (
+            'SELECT %s.ein, %s.name FROM %s JOIN %s ON %s.%s = %s.ein '
+            'WHERE %s MATCH %%s' % (
+                search_table, search_table, search_table, table, table,
+                qn(model._meta.pk.column), search_table, search_table))
+        params = [' '.join('"%s"*' % word for word in words)]
+        order_by = 'bm25(%s)' % search_table
+        order_params = []
+    else:
+        # \m anchors each word at the start of a word, and the
+        # trigram index finds the names that can match.
+        sql = 'SELECT %s, %s FROM %s WHERE %s' % (
+            qn(model._meta.pk.column), qn('name'), table,
+            ' AND '.join(['%s ~* %%s' % qn('name')] * len(words)))
+        params = [r'\m' + word for word in words]
+        order_by = 'similarity(%s, %%s) DESC' % qn('name')
+        order_params = [' '.join(words)]
+    if state is not None:
+        sql += ' AND %s.%s = %%s' % (table, qn('state'))
+        params.append(state)
+    sql += ' ORDER BY %s LIMIT %d' % (order_by, RANK_CANDIDATES)
+    cursor = connection.cursor()
+    cursor.execute(sql, params + order_params)
+    return cursor.fetchall()
+
+
+def normalize_name(name):
+    """return name normalized for comparing with other names:
+    lower case, without accents and punctuation, with common
+    abbreviations spelled out, such as "st" as "saint", and
+    without words like "the" and "inc", which names are as
+    often written without.
+    """
+    if isinstance(name, unicode) or _NON_ASCII_RE.search(name):
+        if isinstance(name, str):
+            name = name.decode('utf-8', 'replace')
+        # split accented letters into the letter and the
+        # accent, and drop the accent.
+        name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore')
+    words = name.translate(_NAME_CHARACTERS).replace('&', ' & ').split()
+    return ' '.join([
+        word for word in map(NAME_ABBREVIATIONS.get, words, words)
+        if word not in NAME_STOP_WORDS
+    ])[:NORMALIZED_NAME_LENGTH]
+
+
+def name_similarity(normalized_name, other_normalized_name):
+    """return how similar two names, normalized by
+    normalize_name, are, from 0 for nothing in common to 1
+    for the same name. Names are compared both as they are
+    and with their words sorted, so that the same words in a
+    different order still score highly.
+    """
+    return best_name_similarity(normalized_name, [other_normalized_name])
+
+
+def best_name_similarity(normalized_name, other_normalized_names):
+    """return the highest name_similarity of normalized_name
+    to any of other_normalized_names, or 0 if there are none.
+    """
+    best = 0.0
+    matcher = difflib.SequenceMatcher(None, '', normalized_name)
+    sorted_matcher = difflib.SequenceMatcher(
+        None, '', ' '.join(sorted(normalized_name.split())))
+    for other in other_normalized_names:
+        if other == normalized_name:
+            return 1.0
+        matcher.set_seq1(other)
+        # quick_ratio, which only counts the letters the names
+        # share, is an upper bound of both ratios, and much
+        # faster, so most names are ruled out with it alone.
+        if matcher.quick_ratio() <= best:
+            continue
+        sorted_matcher.set_seq1(' '.join(sorted(other.split())))
+        best = max(best, matcher.ratio(), sorted_matcher.ratio())
+    return best
+
+
+def nearby_normalized_names(model, normalized_name, filters=None,
+                            limit=1000, using=None):
+    """return a list of up to limit normalized names of
+    nonprofits of model, an IRSNonprofitData-like model, that
+    start with the same word as normalized_name and are
+    nearest to it in sorted order, so those sharing the
+    longest beginning with it, half from before it and half
+    from after. filters is a dictionary of other fields the
+    nonprofits must equal.
+
+    The names are found with one query, of two range scans of
+    the normalized_name index.
+    """
+    using = using or router.db_for_read(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    first_word = normalized_name.split(' ', 1)[0]
+    conditions, params = [], []
+    for field, value in sorted((filters or {}).items()):
+        conditions.append(
+            '%s = %%s' % qn(model._meta.get_field(field).column))
+        params.append(value)
+    column = qn(model._meta.get_field('normalized_name').column)
+    select = 'SELECT %s FROM %s WHERE ' % (column, qn(model._meta.db_table))
+    before_sql = select + ' AND '.join(
+        conditions + ['%s >= %%s' % column, '%s < %%s' % column])
+    before_params = params + [first_word, normalized_name]
+    after_params = params + [normalized_name]
+    # every name starting with first_word sorts before the next
+    # prefix of the same length, whatever the collation.
+    next_prefix = _next_prefix(first_word)
+    if next_prefix is None:
+        after_sql = select + ' AND '.join(
+            conditions + ['%s >= %%s' % column])
+    else:
+        after_sql = before_sql
+        after_params.append(next_prefix)
+    half = limit // 2
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT * FROM (%s ORDER BY %s LIMIT %d) AS after_name '
+        'UNION ALL '
+        'SELECT * FROM (%s ORDER BY %s DESC LIMIT %d) AS before_name' % (
+            after_sql, column, limit - half, before_sql, column, half),
+        after_params + before_params)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _next_prefix(word):
+    """return the least string that sorts after every string
+    starting with word, a word of a name normalized by
+    normalize_name, which is made of digits and lower case
+    letters, or None if nothing does.
+
+    Unlike word followed by "~", which is only after every
+    letter, digit and space under byte-wise collations, it
+    holds under the locale collations PostgreSQL databases
+    usually have, which ignore punctuation and spaces.
+    """
+    word = word.rstrip('z')
+    if not word:
+        return None
+    last = word[-1]
+    return word[:-1] + ('a' if last == '9' else chr(ord(last) + 1))
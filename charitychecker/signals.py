@@ -0,0 +1,29 @@
+"""
+signals sent by the django-charitychecker module.
+"""
+
+from django.dispatch import Signal
+
+# sent by update_database_from_file and apply_delta once the
+# transaction updating a model's data has committed, with
+# that model as the sender, delta, the path of the delta of
+# the changes or None, and using, the alias of the database
+# that was updated.
+dataset_updated = Signal()
+
+# sent by update_database_from_file and apply_delta as an
+# update of a model's data begins, with that model as the
+# sender and using, the alias of the database being
+# updated. A receiver may return a watcher: an object whose
+# add method is called with the primary key of every row the
+# update may insert or keep, and whose prepare method is
+# called once they have all been added, before the update
+# is committed.
+dataset_updating = Signal()
+
+# sent by update_database_from_file once an update is over,
+# whether it succeeded, failed or found the data unchanged,
+# with the model as the sender, metrics, the
+# charitychecker.metrics.UpdateMetrics of the update, and
+# dry_run, true if the update was only a dry run.
+update_measured = Signal()
@@ -0,0 +1,319 @@
+"""
+a read-only, memory-mapped snapshot file of the nonprofit
+data, shared through the page cache by every process that
+reads it.
+"""
+
+import os
+import mmap
+import itertools
+import time
+import shutil
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+from array import array
+from bisect import bisect_right
+from django.conf import settings
+from .caching import get_generation
+
+# Global Variables
+#
+# these can be overridden in settings.py
+
+# the path IRSNonprofitData's snapshot file is written to after
+# every update and looked nonprofits up in, set
+# CHARITYCHECKER_SNAPSHOT_PATH to turn the snapshot on.
+DEFAULT_SNAPSHOT_PATH = None
+
+# End Global Variables
+
+# how often, in seconds, readers check whether the snapshot
+# file has been replaced.
+CHECK_INTERVAL = 1
+
+# the snapshot file format. A header of the magic string, the
+# number of nonprofits and the width of their EINs, then each
+# nonprofit's EIN, padded with null bytes to the same width,
+# in sorted order, then the offset of each nonprofit's record
+# in the data that follows, and one more offset to the end of
+# the data, and finally the records, the UTF-8 names, cities,
+# states, countries and deductability codes separated by
+# SEPARATOR.
+MAGIC = 'CCSNAP1\0'
+SEPARATOR = '\x1f'
+_HEADER = struct.Struct('<8sII')
+_OFFSET = struct.Struct('<I')
+_OFFSET_PAIR = struct.Struct('<II')
+
+# every how many EINs one is kept in memory, to narrow down
+# each binary search before it reaches the file.
+_FENCE_SPACING = 64
+
+
+def _text(value):
+    """return value, converted to text if it isn't a string,
+    such as an integer EIN, as UTF-8 encoded bytes.
+    """
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+@contextmanager
+def replace_atomically(path):
+    """a context manager yielding a file, opened for writing
+    in binary mode, that replaces the file at path once the
+    block exits without an error.
+
+    The file is a temporary file next to path, which is
+    flushed to disk and then renamed over path, so readers see
+    either the old file or the new one, never a partly written
+    one. If the block raises an exception, the temporary file
+    is removed and path is left alone.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary_path = tempfile.mkstemp(
+        prefix='.%s-' % os.path.basename(path), suffix='.part',
+        dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        # make the file readable by the other processes.
+        os.chmod(temporary_path, 0o644)
+        os.rename(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def write_snapshot(path, rows, ein_width=9):
+    """write a snapshot of rows, tuples of the form (ein,
+    name, city, state, country, deductability_code), to path.
+
+    Rows are written fastest sorted by the UTF-8 bytes of
+    their EINs, but are sorted here if they aren't, as when
+    the database's collation orders EINs differently. The
+    snapshot replaces any old one at path atomically (see
+    replace_atomically). Raises ValueError if an EIN is
+    repeated or longer than ein_width.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    eins = []
+    offsets = array('I', [0])
+    with replace_atomically(path) as snapshot:
+        with tempfile.TemporaryFile(dir=directory) as data:
+            is_sorted = True
+            for row in rows:
+                ein = _text(row[0])
+                if len(ein) > ein_width:
+                    raise ValueError("EIN %r is too long" % (ein,))
+                ein = ein.ljust(ein_width, '\0')
+                if eins and ein <= eins[-1]:
+                    is_sorted = False
+                eins.append(ein)
+                data.write(SEPARATOR.join(
+                    _text(value) for value in row[1:]))
+                offsets.append(data.tell())
+            order = None
+            if not is_sorted:
+                # sort the EINs, and then copy the records into
+                # the snapshot in the same order.
+                order = sorted(xrange(len(eins)), key=eins.__getitem__)
+                eins = [eins[i] for i in order]
+                record_offsets = offsets
+                offsets = array('I', [0])
+                for i in order:
+                    offsets.append(offsets[-1] + record_offsets[i + 1] -
+                                   record_offsets[i])
+            for ein, next_ein in itertools.izip(
+                    eins, itertools.islice(eins, 1, None)):
+                if ein == next_ein:
+                    raise ValueError(
+                        "EIN %r is repeated" % (ein.rstrip('\0'),))
+            snapshot.write(_HEADER.pack(MAGIC, len(eins), ein_width))
+            snapshot.write(''.join(eins))
+            del eins
+            snapshot.write(offsets.tostring())
+            data.seek(0)
+            if order is None:
+                shutil.copyfileobj(data, snapshot)
+            else:
+                for i in order:
+                    data.seek(record_offsets[i])
+                    snapshot.write(data.read(
+                        record_offsets[i + 1] - record_offsets[i]))
+
+
+def write_model_snapshot(model, path, using=None, chunk_size=10000):
+    """write a snapshot of every row of model, an
+    IRSNonprofitData-like model, to path, reading the database
+    chunk_size rows at a time.
+    """
+    def rows():
+        queryset = model._default_manager.using(using).order_by('pk')
+        last = None
+        while True:
+            chunk = queryset if last is None else queryset.filter(
+                pk__gt=last)
+            chunk = list(chunk.values_list(
+                'ein', 'name', 'city', 'state', 'country',
+                'deductability_code')[:chunk_size])
+            for row in chunk:
+                yield row
+            if len(chunk) < chunk_size:
+                return
+            last = chunk[-1][0]
+    write_snapshot(path, rows())
+
+
+class Snapshot(object):
+    """a snapshot file, memory-mapped read-only, so that the
+    pages holding it are shared between every process that
+    opens it, answering the same lookups as NonprofitIndex.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, self._ein_width = _HEADER.unpack_from(
+            self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a charitychecker snapshot" % path)
+        self._eins_start = _HEADER.size
+        self._offsets_start = (
+            self._eins_start + self._count * self._ein_width)
+        self._data_start = (
+            self._offsets_start + (self._count + 1) * _OFFSET.size)
+        self._fence = [
+            self._ein(i) for i in range(0, self._count, _FENCE_SPACING)]
+
+    def _ein(self, i):
+        start = self._eins_start + i * self._ein_width
+        return self._map[start:start + self._ein_width]
+
+    def _find(self, ein):
+        # narrow the search down to the EINs between two fence
+        # posts, then binary search those in the file.
+        block = bisect_right(self._fence, ein) - 1
+        if block < 0:
+            return None
+        low = block * _FENCE_SPACING
+        high = min(low + _FENCE_SPACING, self._count)
+        while low < high:
+            middle = (low + high) // 2
+            if self._ein(middle) < ein:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._ein(low) == ein:
+            return low
+        return None
+
+    def get(self, ein):
+        """return a tuple of the name, city, state, country and
+        deductability code of the nonprofit with the given EIN,
+        or None if there is no such nonprofit.
+        """
+        ein = _text(ein)
+        if len(ein) > self._ein_width:
+            return None
+        i = self._find(ein.ljust(self._ein_width, '\0'))
+        if i is None:
+            return None
+        start, end = _OFFSET_PAIR.unpack_from(
+            self._map, self._offsets_start + i * _OFFSET.size)
+        return tuple(
+            self._map[self._data_start + start:self._data_start + end]
+            .decode('utf-8').split(SEPARATOR))
+
+    def __contains__(self, ein):
+        return self.get(ein) is not None
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._map.close()
+
+
+class FileHolder(object):
+    """holds the process's open copy of a file that is
+    replaced atomically from time to time, such as a snapshot,
+    reopening it when the file has been replaced. Whether it
+    has is checked at most every CHECK_INTERVAL seconds, and
+    whenever the data is updated in this process.
+
+    Files are opened by calling load with their path.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._stat = None
+        self._path = None
+        self._checked = None
+        self._generation = None
+
+    def get(self, path):
+        """return the opened file at path, or None if there is
+        no such file.
+        """
+        if (path == self._path and
+            self._generation == get_generation() and
+            time.time() < self._checked + CHECK_INTERVAL):
+            return self._loaded
+        with self._lock:
+            self._generation = get_generation()
+            self._checked = time.time()
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is None:
+                self._loaded = self._stat = None
+            elif (path != self._path or self._stat is None or
+                  (stat.st_ino, stat.st_dev, stat.st_mtime) != (
+                      self._stat.st_ino, self._stat.st_dev,
+                      self._stat.st_mtime)):
+                # the old file is left for the garbage collector
+                # to close, as other threads may still be reading
+                # it.
+                self._loaded = self.load(path)
+                self._stat = stat
+            self._path = path
+            return self._loaded
+
+    def clear(self):
+        """forget the open file."""
+        with self._lock:
+            self._loaded = self._stat = None
+            self._path = None
+
+
+_holder = FileHolder(Snapshot)
+
+
+def get_snapshot_path():
+    """return the path of the snapshot file, or None if the
+    snapshot isn't turned on.
+    """
+    return getattr(
+        settings, 'CHARITYCHECKER_SNAPSHOT_PATH', DEFAULT_SNAPSHOT_PATH)
+
+
+def get_snapshot():
+    """return the Snapshot at CHARITYCHECKER_SNAPSHOT_PATH, or
+    None if the snapshot isn't turned on or hasn't been
+    written yet.
+    """
+    path = get_snapshot_path()
+    if path is None:
+        return None
+    return _holder.get(path)
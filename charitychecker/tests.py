@@ -3,17 +3,62 @@ unit/integration tests for the django-charitychecker package.
 """
                
 import re
+import time
 import datetime
 from StringIO import StringIO
 from itertools import izip
 import os
-from contextlib import contextmanager
+import io
+import hashlib
+import shutil
+import socket
+import tempfile
+import threading
+import zipfile
+import gzip
+import json
+import pstats
+import itertools
+import urllib2
+import BaseHTTPServer
+from collections import namedtuple
+from contextlib import contextmanager, closing
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections, DatabaseError, IntegrityError
+from django.db import close_old_connections as django_close_old_connections
 from django.test import TestCase
+from django.test.utils import override_settings
 from .models import IRSNonprofitData
+from .caching import (LRUCache, lookup_cache,
+                      get_generation, bump_generation,
+                      get_shared_cache)
+from .signals import dataset_updated, dataset_updating, update_measured
+from . import index as index_module
+from .index import NonprofitIndex, _IndexHolder, clear_index
+from .snapshot import (
+    Snapshot, FileHolder, write_snapshot, write_model_snapshot)
+from .bloom import BloomFilter
+from . import search as search_module
+from .search import (has_search_index, normalize_name, name_similarity,
+                     nearby_normalized_names, _next_prefix)
+from .admin import IRSNonprofitDataAdmin
+from .downloader import (
+    Downloader, DownloadError, ChecksumMismatch, DownloadProgress)
+from . import batching
+from .batching import LookupFuture, LookupBatcher, gather
+from .metrics import UpdateMetrics, StatsdSink, current_metrics
+from django.contrib import admin
+from . import utilities
 from .utilities import (ignore_blank_space, _normalize_data,
-                        open_zip_from_url,
+                        Pub78Record, parse_pub78, parse_pub78_line,
+                        parse_pub78_file, _line_ranges,
+                        download_to_file, open_zip_from_url,
+                        ArchiveCache, SourceUnchanged,
                         irs_nonprofit_data_context_manager,
-                        update_database_from_file,
+                        pub78_source_context_manager,
+                        update_database_from_file, _iter_db_rows,
+                        apply_delta, _Pipeline, ENGINES,
                         update_charitychecker_data)
 
 # Global Variables/Mocks
@@ -54,6 +99,113 @@ def irs_mock_data_after():
     with open(MOCK_DATA_LOCATION_AFTER) as mock_data:
         yield mock_data
 
+def make_zip(files):
+    """return the bytes of a zip archive containing files,
+    a dictionary mapping file names to their contents.
+    """
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(
+        zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for file_name, contents in files.items():
+            zip_file.writestr(file_name, contents)
+    return zip_buffer.getvalue()
+
+@contextmanager
+def serve_files(files, requests=None, interrupt=False, failures=0,
+                delay=0):
+    """context manager serving files, a dictionary mapping
+    paths to their contents, over http from localhost, and
+    providing the server's base url.
+
+    The server supports ETags and resuming with range
+    requests. The path and headers of each request are
+    appended to requests, if given, and if interrupt is true
+    the first response is cut off halfway through. The first
+    failures requests are answered with a 503 error, and
+    responses are held back for delay seconds.
+    """
+    interrupted = []
+    failed = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if requests is not None:
+                requests.append((self.path, dict(self.headers)))
+            time.sleep(delay)
+            if len(failed) < failures:
+                failed.append(True)
+                self.send_error(503)
+                return
+            if self.path not in files:
+                self.send_error(404)
+                return
+            data = files[self.path]
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            start = 0
+            if (self.headers.get('Range') and
+                self.headers.get('If-Range') == etag):
+                start = int(re.match(
+                    r'bytes=(\d+)-$', self.headers['Range']).group(1))
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                    start, len(data) - 1, len(data)))
+            else:
+                self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', len(data) - start)
+            self.end_headers()
+            body = data[start:]
+            if interrupt and not interrupted:
+                interrupted.append(True)
+                body = body[:len(body) // 2]
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.01})
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d' % server.server_port
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@contextmanager
+def temporary_directory():
+    """context manager providing a temporary directory which
+    is deleted afterwards.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+
+@contextmanager
+def serve_irs_data(location):
+    """context manager serving the mock IRS data at location,
+    zipped up like the real thing, in place of the IRS
+    website.
+    """
+    with open(location) as mock_data:
+        archive = make_zip({utilities.TXT_FILE_NAME: mock_data.read()})
+    irs_url = utilities.IRS_NONPROFIT_DATA_URL
+    try:
+        with serve_files({'/pub78.zip': archive}) as url:
+            utilities.IRS_NONPROFIT_DATA_URL = url + '/pub78.zip'
+            yield
+    finally:
+        utilities.IRS_NONPROFIT_DATA_URL = irs_url
+
 # End Global Variables
 
 
@@ -112,10 +264,176 @@ class TestNormalizeData(TestCase):
                         before_line == after_line)
                 self.assertTrue(files_are_same)
 
+    def test_removes_foreign_entities_with_extra_codes(self):
+        lines = [
+            '010810866|Zoe Foundation|Kingswood Surrey||'
+            'UNITED KINGDOM|FORGN\n',
+            '010885377|America Gives Back Inc.|London||'
+            'UNITED KINGDOM|FORGN,PC\n',
+            '010407276|FORGN Friends|Portland|ME|United States|PC\n',
+            '\n',
+            '010400845|Pine Tree Camp|Rome|ME|United States|PC,FORGN\n']
+        self.assertEqual(
+            list(_normalize_data(lines)),
+            ['010407276|FORGN Friends|Portland|ME|United States|PC'])
+
+
+class TestParsePub78(TestCase):
+    """test suite for the parse_pub78 function."""
+
+    def test_parses_records(self):
+        lines = [
+            '010407276|Friends of Maine|Portland|ME|United States|PC\n',
+            '010810866|Zoe Foundation|Kingswood Surrey||'
+            'UNITED KINGDOM|FORGN\n',
+            '\n']
+        records = list(parse_pub78(lines))
+        self.assertEqual(
+            records,
+            [('010407276', 'Friends of Maine', 'Portland', 'ME',
+              'United States', 'PC')])
+        self.assertEqual(records[0].ein, '010407276')
+        self.assertEqual(records[0].deductability_code, 'PC')
+
+    def test_rejects_malformed_lines(self):
+        with self.assertRaises(ValueError) as raised:
+            parse_pub78_line('010407276|Friends of Maine|Portland')
+        self.assertIn('010407276|Friends of Maine|Portland',
+                      str(raised.exception))
+
+
+class TestParsePub78File(TestCase):
+    """test suite for the parse_pub78_file function."""
+
+    def test_matches_parse_pub78(self):
+        with open(MOCK_DATA_LOCATION_BEFORE) as irs_data:
+            expected = list(parse_pub78(irs_data))
+        records = list(parse_pub78_file(
+            MOCK_DATA_LOCATION_BEFORE, workers=2, chunk_size=1000))
+        self.assertEqual(records, expected)
+        self.assertTrue(all(
+            isinstance(record, Pub78Record) for record in records))
+
+    def test_counts_skipped_foreign(self):
+        metrics = UpdateMetrics()
+        with open(MOCK_DATA_LOCATION_BEFORE) as irs_data:
+            list(_normalize_data(irs_data, metrics))
+        expected = metrics.counters['skipped_foreign']
+        metrics = UpdateMetrics()
+        list(parse_pub78_file(
+            MOCK_DATA_LOCATION_BEFORE, workers=2, chunk_size=1000,
+            metrics=metrics))
+        self.assertEqual(metrics.counters['skipped_foreign'], expected)
+
+    def test_splits_file_on_line_boundaries(self):
+        ranges = list(_line_ranges(MOCK_DATA_LOCATION_BEFORE, 1000))
+        self.assertTrue(len(ranges) > 1)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(
+            ranges[-1][1], os.path.getsize(MOCK_DATA_LOCATION_BEFORE))
+        with open(MOCK_DATA_LOCATION_BEFORE, 'rb') as irs_data:
+            for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, next_start)
+                irs_data.seek(end - 1)
+                self.assertEqual(irs_data.read(1), '\n')
+
+
+class TestDownloadToFile(TestCase):
+    """test suite for the download_to_file function."""
+
+    def test_downloads_in_chunks(self):
+        """download a file several times larger than the chunk
+        size and check it arrives intact.
+        """
+        data = os.urandom(10000)
+        with serve_files({'/data': data}) as url:
+            f = io.BytesIO()
+            download_to_file(url + '/data', f, chunk_size=1024)
+        self.assertEqual(f.tell(), 0)
+        self.assertEqual(f.read(), data)
+
 
 class TestOpenZipFromURL(TestCase):
     """test suite for the open_zip_from_url context manager."""
-    pass
+
+    def test_opens_file_from_zip(self):
+        with open(MOCK_DATA_LOCATION_BEFORE) as mock_data:
+            contents = mock_data.read()
+        archive = make_zip({
+            'data.txt': contents, 'other.txt': 'other data'})
+        with serve_files({'/data.zip': archive}) as url:
+            with open_zip_from_url(
+                url + '/data.zip', 'data.txt') as zipped_file:
+                self.assertEqual(zipped_file.read(), contents)
+
+    def test_missing_archive_raises_http_error(self):
+        with serve_files({}) as url:
+            with self.assertRaises(urllib2.HTTPError):
+                with open_zip_from_url(url + '/data.zip', 'data.txt'):
+                    pass
+
+
+class TestArchiveCache(TestCase):
+    """test suite for the ArchiveCache class."""
+
+    def setUp(self):
+        self.files = {'/data.zip': os.urandom(10000)}
+        self.requests = []
+
+    def test_fetch_downloads_archive(self):
+        with temporary_directory() as directory:
+            with serve_files(self.files) as url:
+                path, digest = ArchiveCache(directory).fetch(
+                    url + '/data.zip')
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.files['/data.zip'])
+            self.assertEqual(
+                digest, hashlib.sha256(self.files['/data.zip']).hexdigest())
+
+    def test_fetch_revalidates_cached_archive(self):
+        with temporary_directory() as directory:
+            with serve_files(self.files, self.requests) as url:
+                archive_cache = ArchiveCache(directory)
+                first = archive_cache.fetch(url + '/data.zip')
+                second = archive_cache.fetch(url + '/data.zip')
+        self.assertEqual(first, second)
+        self.assertNotIn('if-none-match', self.requests[0][1])
+        self.assertIn('if-none-match', self.requests[1][1])
+
+    def test_fetch_downloads_changed_archive(self):
+        with temporary_directory() as directory:
+            with serve_files(self.files) as url:
+                archive_cache = ArchiveCache(directory)
+                first_path, first_digest = archive_cache.fetch(
+                    url + '/data.zip')
+                self.files['/data.zip'] = os.urandom(10000)
+                path, digest = archive_cache.fetch(url + '/data.zip')
+            self.assertNotEqual(digest, first_digest)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.files['/data.zip'])
+
+    def test_fetch_resumes_interrupted_download(self):
+        with temporary_directory() as directory:
+            with serve_files(
+                self.files, self.requests, interrupt=True) as url:
+                archive_cache = ArchiveCache(directory)
+                with self.assertRaises(IOError):
+                    archive_cache.fetch(url + '/data.zip')
+                path, digest = archive_cache.fetch(url + '/data.zip')
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.files['/data.zip'])
+        self.assertEqual(self.requests[1][1]['range'], 'bytes=5000-')
+
+    def test_remembers_synced_archive(self):
+        with temporary_directory() as directory:
+            with serve_files(self.files) as url:
+                archive_cache = ArchiveCache(directory)
+                path, digest = archive_cache.fetch(url + '/data.zip')
+                self.assertFalse(
+                    archive_cache.is_synced(url + '/data.zip', digest))
+                archive_cache.mark_synced(url + '/data.zip', digest)
+                self.assertTrue(
+                    archive_cache.is_synced(url + '/data.zip', digest))
 
 
 class TestIRSNonprofitDataContextManager(TestCase):
@@ -145,13 +463,617 @@ class TestIRSNonprofitDataContextManager(TestCase):
             self.assertTrue(in_expected_format)
 
 
+class TestPub78SourceContextManager(TestCase):
+    """test suite for pub78_source_context_manager."""
+
+    def setUp(self):
+        with open(MOCK_DATA_LOCATION_BEFORE) as irs_data:
+            self.data = irs_data.read()
+            irs_data.seek(0)
+            self.expected = list(_normalize_data(irs_data))
+
+    def test_reads_text_file(self):
+        with pub78_source_context_manager(
+            MOCK_DATA_LOCATION_BEFORE) as irs_data:
+            self.assertEqual(list(irs_data), self.expected)
+
+    def test_reads_zip_file(self):
+        with temporary_directory() as directory:
+            for name in (utilities.TXT_FILE_NAME, 'pub78.txt'):
+                path = os.path.join(directory, 'pub78.zip')
+                with open(path, 'wb') as f:
+                    f.write(make_zip({name: self.data}))
+                with pub78_source_context_manager(path) as irs_data:
+                    self.assertEqual(list(irs_data), self.expected)
+            with open(path, 'wb') as f:
+                f.write(make_zip({'a.txt': self.data, 'b.txt': ''}))
+            with self.assertRaises(ValueError):
+                with pub78_source_context_manager(path):
+                    pass
+
+    def test_downloads_urls(self):
+        files = {'/pub78.zip': make_zip(
+            {utilities.TXT_FILE_NAME: self.data})}
+        with serve_files(files) as url:
+            with pub78_source_context_manager(
+                url + '/pub78.zip') as irs_data:
+                self.assertEqual(list(irs_data), self.expected)
+
+
 class TestUpdateDatabaseFromFile(TestCase):
     """test suite for the update_database_from_file function."""
-    pass
+
+    def test_skips_update_when_source_unchanged(self):
+        @contextmanager
+        def unchanged_data():
+            raise SourceUnchanged()
+            yield
+
+        updates = []
+        def record_update(sender, **kwargs):
+            updates.append(sender)
+        dataset_updated.connect(record_update)
+        try:
+            with self.assertNumQueries(0):
+                update_database_from_file(
+                    file_manager=unchanged_data,
+                    convert_line=lambda ln: ln,
+                    pk_field='ein',
+                    model=IRSNonprofitData)
+        finally:
+            dataset_updated.disconnect(record_update)
+        self.assertEqual(updates, [])
+
+    def test_returns_counts(self):
+        convert_line = lambda ln: dict(zip(
+            ('ein', 'name', 'city', 'state', 'country',
+             'deductability_code'),
+            ln.rstrip('\n').split('|')))
+        self.assertEqual(
+            update_database_from_file(
+                file_manager=irs_mock_data_before,
+                convert_line=convert_line,
+                pk_field='ein',
+                model=IRSNonprofitData),
+            {'inserted': 1001, 'updated': 0, 'deleted': 0})
+        self.assertEqual(
+            update_database_from_file(
+                file_manager=irs_mock_data_after,
+                convert_line=convert_line,
+                pk_field='ein',
+                model=IRSNonprofitData),
+            {'inserted': 1, 'updated': 1, 'deleted': 1})
+
+    def test_writes_in_batches(self):
+        update_charitychecker_data(
+            file_manager=irs_mock_data_before, batch_size=7)
+        self.assertEqual(
+            update_charitychecker_data(
+                file_manager=irs_mock_data_after, batch_size=7),
+            {'inserted': 1, 'updated': 1, 'deleted': 1})
+        with irs_mock_data_after() as irs_data:
+            expected = sorted(
+                tuple(line.split('|')) for line in irs_data)
+        self.assertEqual(
+            sorted(IRSNonprofitData.objects.values_list(
+                'ein', 'name', 'city', 'state', 'country',
+                'deductability_code')),
+            expected)
+
+    def test_writes_each_batch_in_one_statement(self):
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        with self.assertNumQueries(
+            # the savepoint and its release, one select and the
+            # insert, update and delete batches, then the search
+            # index's rebuild: its savepoint and release, and
+            # dropping, creating and filling the search table
+            2 + 1 + 1 + 1 + 1 + 5):
+            update_charitychecker_data(
+                file_manager=irs_mock_data_after, batch_size=2000)
+
+    def test_merge_engine(self):
+        update_charitychecker_data(
+            file_manager=irs_mock_data_before, engine='merge')
+        self.assertEqual(
+            update_charitychecker_data(
+                file_manager=irs_mock_data_after,
+                batch_size=7, engine='merge'),
+            {'inserted': 1, 'updated': 1, 'deleted': 1})
+        with irs_mock_data_after() as irs_data:
+            expected = sorted(
+                tuple(line.split('|')) for line in irs_data)
+        self.assertEqual(
+            list(IRSNonprofitData.objects.order_by('ein').values_list(
+                'ein', 'name', 'city', 'state', 'country',
+                'deductability_code')),
+            expected)
+
+    def test_merge_engine_falls_back_on_unsorted_data(self):
+        opened = []
+        @contextmanager
+        def irs_mock_data_unsorted():
+            opened.append(True)
+            with irs_mock_data_after() as irs_data:
+                yield reversed(list(irs_data))
+
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        self.assertEqual(
+            update_charitychecker_data(
+                file_manager=irs_mock_data_unsorted, engine='merge'),
+            {'inserted': 1, 'updated': 1, 'deleted': 1})
+        # the fallback reads the data kept from the first try.
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(
+            IRSNonprofitData.objects.get(pk='010400845').city, 'Calais')
+        self.assertFalse(
+            IRSNonprofitData.objects.filter(pk='010407276').exists())
+
+    def test_dry_run(self):
+        """test that a dry run counts the changes each engine
+        would make without making them.
+        """
+        updates = []
+        def record_update(sender, **kwargs):
+            updates.append(sender)
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        expected = list(IRSNonprofitData.objects.order_by('ein').values_list())
+        dataset_updated.connect(record_update)
+        try:
+            with temporary_directory() as directory:
+                for engine in ENGINES:
+                    self.assertEqual(
+                        update_charitychecker_data(
+                            file_manager=irs_mock_data_after, engine=engine,
+                            delta_dir=directory, dry_run=True),
+                        {'inserted': 1, 'updated': 1, 'deleted': 1})
+                self.assertEqual(os.listdir(directory), [])
+        finally:
+            dataset_updated.disconnect(record_update)
+        self.assertEqual(updates, [])
+        self.assertEqual(
+            list(IRSNonprofitData.objects.order_by('ein').values_list()),
+            expected)
+
+    def test_converts_lines_to_namedtuples(self):
+        Row = namedtuple('Row', ['city', 'name', 'ein'])
+        update_database_from_file(
+            file_manager=irs_mock_data_before,
+            convert_line=lambda ln: Row._make(
+                [ln.split('|')[i] for i in (2, 1, 0)]),
+            pk_field='ein',
+            model=IRSNonprofitData)
+        nonprofit = IRSNonprofitData.objects.get(pk='010407276')
+        self.assertEqual(nonprofit.name, 'Sunrise Opportunities')
+        self.assertEqual(nonprofit.city, 'Machias')
+        self.assertEqual(nonprofit.state, '')
+
+    def test_staging_engine(self):
+        update_charitychecker_data(
+            file_manager=irs_mock_data_before, engine='staging')
+        self.assertEqual(IRSNonprofitData.objects.count(), 1001)
+        self.assertEqual(
+            update_charitychecker_data(
+                file_manager=irs_mock_data_after,
+                batch_size=7, engine='staging'),
+            {'inserted': 1, 'updated': 1, 'deleted': 1})
+        with irs_mock_data_after() as irs_data:
+            expected = sorted(
+                tuple(line.split('|')) for line in irs_data)
+        self.assertEqual(
+            list(IRSNonprofitData.objects.order_by('ein').values_list(
+                'ein', 'name', 'city', 'state', 'country',
+                'deductability_code')),
+            expected)
+
+    def test_staging_engine_leaves_unchanged_rows_alone(self):
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        self.assertEqual(
+            update_charitychecker_data(
+                file_manager=irs_mock_data_before, engine='staging'),
+            {'inserted': 0, 'updated': 0, 'deleted': 0})
+
+    def shadow_tables(self):
+        return [name for name in connection.introspection.table_names()
+                if '__shadow_' in name]
+
+    def shadow_update(self, file_manager):
+        """update with the shadow engine from file_manager,
+        returning the counts and the update's counters, and
+        check that file_manager is only opened once.
+        """
+        opened = []
+        @contextmanager
+        def counting_file_manager():
+            opened.append(True)
+            with file_manager() as file_data:
+                yield file_data
+        measured = []
+        def record_metrics(sender, metrics, **kwargs):
+            measured.append(metrics)
+        update_measured.connect(record_metrics)
+        try:
+            counts = update_charitychecker_data(
+                file_manager=counting_file_manager, batch_size=7,
+                engine='shadow')
+        finally:
+            update_measured.disconnect(record_metrics)
+        self.assertEqual(len(opened), 1)
+        return counts, measured[0].summary()['counters']
+
+    def test_shadow_engine(self):
+        update_charitychecker_data(
+            file_manager=irs_mock_data_before, engine='shadow')
+        self.assertEqual(IRSNonprofitData.objects.count(), 1001)
+        counts, counters = self.shadow_update(irs_mock_data_after)
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'deleted': 1})
+        self.assertNotIn('rows_resumed', counters)
+        with irs_mock_data_after() as irs_data:
+            expected = sorted(
+                tuple(line.split('|')) for line in irs_data)
+        self.assertEqual(
+            list(IRSNonprofitData.objects.order_by('ein').values_list(
+                'ein', 'name', 'city', 'state', 'country',
+                'deductability_code')),
+            expected)
+        self.assertEqual(self.shadow_tables(), [])
+
+    @override_settings(CHARITYCHECKER_SYNC_CHUNK_SIZE=100)
+    def test_shadow_engine_resumes(self):
+        """test that the shadow engine leaves the table alone
+        when it dies part way through, and picks up where it
+        left off next time.
+        """
+        @contextmanager
+        def irs_mock_data_duplicated():
+            # the first 550 rows, then the first again, which
+            # the sixth chunk can't be loaded with.
+            with irs_mock_data_after() as irs_data:
+                lines = list(itertools.islice(irs_data, 550))
+                yield lines + lines[:1]
+
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        with self.assertRaises(IntegrityError):
+            update_charitychecker_data(
+                file_manager=irs_mock_data_duplicated, engine='shadow')
+        self.assertEqual(
+            IRSNonprofitData.objects.get(pk='010400845').city, 'N Berwick')
+        self.assertEqual(len(self.shadow_tables()), 2)
+        counts, counters = self.shadow_update(irs_mock_data_after)
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'deleted': 1})
+        self.assertEqual(counters['rows_resumed'], 500)
+        self.assertEqual(
+            IRSNonprofitData.objects.get(pk='010400845').city, 'Calais')
+        self.assertFalse(
+            IRSNonprofitData.objects.filter(pk='010407276').exists())
+        self.assertEqual(self.shadow_tables(), [])
+
+    @override_settings(CHARITYCHECKER_SYNC_CHUNK_SIZE=100)
+    def test_shadow_engine_starts_over_on_different_data(self):
+        @contextmanager
+        def irs_mock_data_duplicated():
+            with irs_mock_data_after() as irs_data:
+                lines = list(reversed(list(irs_data)))
+                yield lines + lines[:1]
+
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        with self.assertRaises(IntegrityError):
+            update_charitychecker_data(
+                file_manager=irs_mock_data_duplicated, engine='shadow')
+        self.assertEqual(len(self.shadow_tables()), 2)
+        counts, counters = self.shadow_update(irs_mock_data_after)
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'deleted': 1})
+        self.assertNotIn('rows_resumed', counters)
+        self.assertEqual(IRSNonprofitData.objects.count(), 1001)
+        self.assertEqual(self.shadow_tables(), [])
+
+    def test_shadow_engine_drops_old_tables(self):
+        """test that the shadow engine drops the old table a
+        swap that died on MySQL leaves behind.
+        """
+        old_table = IRSNonprofitData._meta.db_table + '__old_0123abcd'
+        connection.cursor().execute(
+            'CREATE TABLE %s (ein VARCHAR(9))' %
+            connection.ops.quote_name(old_table))
+        update_charitychecker_data(
+            file_manager=irs_mock_data_before, engine='shadow')
+        self.assertNotIn(old_table, connection.introspection.table_names())
+        self.assertEqual(IRSNonprofitData.objects.count(), 1001)
+
+    def test_unknown_engine_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            update_charitychecker_data(
+                file_manager=irs_mock_data_before, engine='magic')
+
+    def test_reads_the_table_in_chunks(self):
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        with self.assertNumQueries(
+            # a full chunk of 500, a full chunk of 500 and then
+            # the final 1
+            3):
+            rows = list(_iter_db_rows(
+                IRSNonprofitData, ['ein', 'name'], chunk_size=500))
+        self.assertEqual(
+            rows,
+            list(IRSNonprofitData.objects.order_by(
+                'ein').values_list('ein', 'name')))
+
+
+class TestPipeline(TestCase):
+    """test suite for pipelined updates and the _Pipeline
+    class.
+    """
+
+    def test_converts_lines_in_order(self):
+        lines = ['%d' % i for i in range(1000)]
+        pipeline = _Pipeline(lines, int, chunk_size=7, queue_size=2)
+        try:
+            self.assertEqual(list(pipeline), range(1000))
+        finally:
+            pipeline.close()
+        stats = pipeline.stats()
+        self.assertEqual(
+            [stage['stage'] for stage in stats], ['read', 'parse', 'write'])
+        self.assertEqual([stage['rows'] for stage in stats], [1000] * 3)
+
+    def test_passes_exceptions_on(self):
+        def lines():
+            yield '1'
+            raise IOError('the archive is corrupt')
+        pipeline = _Pipeline(lines(), int)
+        try:
+            with self.assertRaises(IOError):
+                list(pipeline)
+        finally:
+            pipeline.close()
+        pipeline = _Pipeline(['1', 'x'], int)
+        try:
+            with self.assertRaises(ValueError):
+                list(pipeline)
+        finally:
+            pipeline.close()
+
+    def test_closing_stops_the_threads(self):
+        pipeline = _Pipeline(
+            ('%d' % i for i in itertools.count()), int,
+            chunk_size=10, queue_size=1)
+        self.assertEqual(next(iter(pipeline)), 0)
+        pipeline.close()
+        self.assertFalse(any(
+            thread.is_alive() for thread in pipeline._threads))
+
+    def test_pipelined_update(self):
+        update_charitychecker_data(
+            file_manager=irs_mock_data_before, pipeline=True)
+        self.assertEqual(IRSNonprofitData.objects.count(), 1001)
+        counts = update_charitychecker_data(
+            file_manager=irs_mock_data_after, batch_size=7, pipeline=True)
+        stages = counts.pop('stages')
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'deleted': 1})
+        self.assertEqual(
+            [stage['rows'] for stage in stages], [1001] * 3)
+        with irs_mock_data_after() as irs_data:
+            expected = sorted(
+                tuple(line.split('|')) for line in irs_data)
+        self.assertEqual(
+            list(IRSNonprofitData.objects.order_by('ein').values_list(
+                'ein', 'name', 'city', 'state', 'country',
+                'deductability_code')),
+            expected)
+
+    def test_pipelined_update_rolls_back_on_errors(self):
+        @contextmanager
+        def irs_mock_data_broken():
+            with irs_mock_data_after() as irs_data:
+                yield itertools.chain(irs_data, ['not|enough|fields'])
+
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        with self.assertRaises(ValueError):
+            update_charitychecker_data(
+                file_manager=irs_mock_data_broken, pipeline=True)
+        self.assertEqual(
+            IRSNonprofitData.objects.get(pk='010400845').city, 'N Berwick')
+
+    @override_settings(CHARITYCHECKER_SYNC_PIPELINE=True)
+    def test_merge_engine_falls_back_on_unsorted_data(self):
+        opened = []
+        @contextmanager
+        def irs_mock_data_unsorted():
+            opened.append(True)
+            with irs_mock_data_after() as irs_data:
+                yield reversed(list(irs_data))
+
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        counts = update_charitychecker_data(
+            file_manager=irs_mock_data_unsorted, engine='merge')
+        self.assertEqual(
+            (counts['inserted'], counts['updated'], counts['deleted']),
+            (1, 1, 1))
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(
+            IRSNonprofitData.objects.get(pk='010400845').city, 'Calais')
+        self.assertEqual(IRSNonprofitData.objects.count(), 1001)
+
+
+class TestDeltas(TestCase):
+    """test suite for recording deltas with
+    update_database_from_file and applying them with
+    apply_delta.
+    """
+
+    def read_delta(self, path):
+        with closing(gzip.open(path, 'rb')) as delta:
+            return [json.loads(line) for line in delta]
+
+    def record_delta(self, directory, **kwargs):
+        """load the before data, then record the delta to the
+        after data in directory, returning its path.
+        """
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        deltas = []
+        def receiver(sender, delta, **kwargs):
+            deltas.append(delta)
+        dataset_updated.connect(receiver)
+        try:
+            with self.settings(CHARITYCHECKER_DELTA_DIR=directory):
+                update_charitychecker_data(
+                    file_manager=irs_mock_data_after, **kwargs)
+        finally:
+            dataset_updated.disconnect(receiver)
+        self.assertEqual(os.listdir(directory),
+                         [os.path.basename(deltas[0])])
+        return deltas[0]
+
+    def assert_delta(self, path):
+        changes = self.read_delta(path)
+        self.assertEqual(changes[0], {
+            'model': 'charitychecker.IRSNonprofitData',
+            'fields': ['ein', 'name', 'city', 'state', 'country',
+                       'deductability_code', 'normalized_name']})
+        changes = sorted(changes[1:])
+        self.assertEqual([change[0] for change in changes],
+                         ['d', 'i', 'u'])
+        self.assertEqual(changes[0][1][0], '010407276')
+        self.assertEqual(changes[2][1][2], 'N Berwick')
+        self.assertEqual(changes[2][2][2], 'Calais')
+
+    def test_records_delta(self):
+        with temporary_directory() as directory:
+            self.assert_delta(self.record_delta(directory))
+
+    def test_staging_engine_records_delta(self):
+        with temporary_directory() as directory:
+            self.assert_delta(
+                self.record_delta(directory, engine='staging'))
+
+    def test_shadow_engine_records_delta(self):
+        with temporary_directory() as directory:
+            self.assert_delta(
+                self.record_delta(directory, engine='shadow'))
+
+    def test_merge_fallback_records_one_delta(self):
+        @contextmanager
+        def irs_mock_data_unsorted():
+            with irs_mock_data_after() as irs_data:
+                yield reversed(list(irs_data))
+
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        with temporary_directory() as directory:
+            update_charitychecker_data(
+                file_manager=irs_mock_data_unsorted, engine='merge',
+                delta_dir=directory)
+            [name] = os.listdir(directory)
+            self.assert_delta(os.path.join(directory, name))
+
+    def test_no_delta_without_changes(self):
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        with temporary_directory() as directory:
+            update_charitychecker_data(
+                file_manager=irs_mock_data_before, delta_dir=directory)
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_no_delta_on_error(self):
+        @contextmanager
+        def broken_irs_data():
+            with irs_mock_data_after() as irs_data:
+                yield itertools.chain(irs_data, ['not|enough|fields'])
+
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        with temporary_directory() as directory:
+            with self.assertRaises(ValueError):
+                update_charitychecker_data(
+                    file_manager=broken_irs_data, delta_dir=directory)
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_apply_delta(self):
+        with temporary_directory() as directory:
+            path = self.record_delta(directory)
+            expected = list(IRSNonprofitData.objects.order_by(
+                'ein').values_list())
+            IRSNonprofitData.objects.all().delete()
+            update_charitychecker_data(file_manager=irs_mock_data_before)
+            self.assertEqual(
+                apply_delta(path),
+                {'inserted': 1, 'updated': 1, 'deleted': 1})
+        self.assertEqual(
+            list(IRSNonprofitData.objects.order_by('ein').values_list()),
+            expected)
+
+    def test_apply_delta_signals_the_database(self):
+        updates = []
+        def record_update(sender, using, **kwargs):
+            updates.append(using)
+        with temporary_directory() as directory:
+            path = self.record_delta(directory)
+            IRSNonprofitData.objects.all().delete()
+            update_charitychecker_data(file_manager=irs_mock_data_before)
+            dataset_updated.connect(record_update)
+            try:
+                apply_delta(path, using='default')
+            finally:
+                dataset_updated.disconnect(record_update)
+        self.assertEqual(updates, ['default'])
+
+    def test_creates_delta_dir(self):
+        with temporary_directory() as directory:
+            delta_dir = os.path.join(directory, 'deltas')
+            update_charitychecker_data(file_manager=irs_mock_data_before)
+            update_charitychecker_data(
+                file_manager=irs_mock_data_after, delta_dir=delta_dir)
+            [name] = os.listdir(delta_dir)
+            self.assert_delta(os.path.join(delta_dir, name))
 
 
 class TestUpdateCharitycheckerData(TestCase):
     """test suite for the update_charitychecker_data function."""
+
+    def test_skips_unchanged_irs_data(self):
+        """test that with an archive cache, downloading the
+        same IRS data twice only updates the database once.
+        """
+        with temporary_directory() as directory:
+            with serve_irs_data(MOCK_DATA_LOCATION_BEFORE):
+                with self.settings(
+                    CHARITYCHECKER_ARCHIVE_CACHE_DIR=directory):
+                    update_charitychecker_data()
+                    self.assertTrue(
+                        IRSNonprofitData.objects.get(pk='010407276'))
+                    IRSNonprofitData.objects.all().delete()
+                    update_charitychecker_data()
+                    self.assertFalse(IRSNonprofitData.objects.exists())
+
+    def test_dry_run_leaves_irs_data_unused(self):
+        """test that with an archive cache, a dry run doesn't
+        keep the next update from using the same IRS data.
+        """
+        with temporary_directory() as directory:
+            with serve_irs_data(MOCK_DATA_LOCATION_BEFORE):
+                with self.settings(
+                    CHARITYCHECKER_ARCHIVE_CACHE_DIR=directory):
+                    counts = update_charitychecker_data(dry_run=True)
+                    self.assertFalse(IRSNonprofitData.objects.exists())
+                    self.assertEqual(
+                        update_charitychecker_data(), counts)
+
+    def test_parses_with_workers(self):
+        """test that parsing the IRS data across worker
+        processes updates the database just the same.
+        """
+        with serve_irs_data(MOCK_DATA_LOCATION_AFTER):
+            update_charitychecker_data()
+            expected = list(IRSNonprofitData.objects.order_by(
+                'ein').values_list())
+            IRSNonprofitData.objects.all().delete()
+            update_charitychecker_data(workers=3)
+        self.assertEqual(
+            list(IRSNonprofitData.objects.order_by('ein').values_list()),
+            expected)
+
+    def test_workers_arent_passed_to_other_file_managers(self):
+        update_charitychecker_data(
+            file_manager=irs_mock_data_before, workers=2,
+            progress=lambda *args: None)
+        self.assertTrue(
+            IRSNonprofitData.objects.filter(pk='010407276').exists())
         
     def test_update_charitychecker_data_populates_db(self):
         """test that when the update_charitychecker_data
@@ -192,7 +1114,8 @@ class TestUpdateCharitycheckerData(TestCase):
             # 900410317|Blank Family Foundation|Long Lake|MN|United States|PF
             IRSNonprofitData.objects.get(pk='900410317')
         self.assertEquals(
-            # 010400845|Bauneg Beg Lake Association Inc.|N Berwick|ME|United States|PC
+            # 010400845|Bauneg Beg Lake Association Inc.|N Berwick|ME|
+            # United States|PC
             IRSNonprofitData.objects.get(pk='010400845').city,
             'N Berwick')
         # update database
@@ -210,17 +1133,133 @@ class TestUpdateCharitycheckerData(TestCase):
             IRSNonprofitData.objects.get(pk='900410317'))
         # check that the nonprofit was updated
         self.assertEquals(
-            # 010400845|Bauneg Beg Lake Association Inc.|Calais|ME|United States|PC
+            # 010400845|Bauneg Beg Lake Association Inc.|Calais|ME|
+            # United States|PC
             IRSNonprofitData.objects.get(pk='010400845').city,
             'Calais')
 
 
+class TestUpdateCharitycheckerDataCommand(TestCase):
+    """test suite for the update_charitychecker_data
+    management command.
+    """
+
+    def test_updates_database(self):
+        stdout = StringIO()
+        with serve_irs_data(MOCK_DATA_LOCATION_BEFORE):
+            call_command('update_charitychecker_data', stdout=stdout)
+        self.assertIn(
+            '%d inserted' % IRSNonprofitData.objects.count(),
+            stdout.getvalue())
+
+    def test_workers_option(self):
+        stdout = StringIO()
+        with serve_irs_data(MOCK_DATA_LOCATION_BEFORE):
+            call_command('update_charitychecker_data', workers=2,
+                         stdout=stdout)
+        self.assertIn(
+            '%d inserted' % IRSNonprofitData.objects.count(),
+            stdout.getvalue())
+        self.assertTrue(IRSNonprofitData.objects.get(pk='010407276'))
+
+    def test_engine_option(self):
+        with serve_irs_data(MOCK_DATA_LOCATION_BEFORE):
+            call_command('update_charitychecker_data', engine='staging',
+                         stdout=StringIO())
+        self.assertTrue(IRSNonprofitData.objects.get(pk='010407276'))
+
+    def test_pipeline_option(self):
+        stdout = StringIO()
+        with serve_irs_data(MOCK_DATA_LOCATION_BEFORE):
+            call_command('update_charitychecker_data', pipeline=True,
+                         stdout=stdout)
+        self.assertIn(
+            'parse stage: %d rows' % IRSNonprofitData.objects.count(),
+            stdout.getvalue())
+
+    def test_reports_download_progress(self):
+        stdout = StringIO()
+        with serve_irs_data(MOCK_DATA_LOCATION_BEFORE):
+            call_command('update_charitychecker_data', stdout=stdout)
+        self.assertTrue(re.search(
+            r'downloaded [0-9.]+ of [0-9.]+ MB', stdout.getvalue()))
+
+    def test_reports_metrics(self):
+        stdout = StringIO()
+        with serve_irs_data(MOCK_DATA_LOCATION_BEFORE):
+            call_command('update_charitychecker_data', stdout=stdout)
+        output = stdout.getvalue()
+        for stage in ('download', 'read', 'load', 'insert', 'total'):
+            self.assertTrue(re.search(
+                r'^%s: [0-9.]+s, [0-9]+ queries\.$' % stage, output, re.M))
+        self.assertIn(
+            'rows read %d' % IRSNonprofitData.objects.count(), output)
+
+    def test_batch_size_option(self):
+        stdout = StringIO()
+        call_command('update_charitychecker_data', batch_size=10,
+                     source=MOCK_DATA_LOCATION_BEFORE, stdout=stdout)
+        self.assertTrue(re.search(
+            r'^insert: [0-9.]+s, %d queries\.$'
+            % ((IRSNonprofitData.objects.count() + 9) // 10),
+            stdout.getvalue(), re.M))
+        with self.assertRaises(CommandError):
+            call_command('update_charitychecker_data', batch_size=0,
+                         stdout=StringIO())
+
+    def test_dry_run_option(self):
+        stdout = StringIO()
+        call_command('update_charitychecker_data', dry_run=True,
+                     source=MOCK_DATA_LOCATION_BEFORE, stdout=stdout)
+        self.assertFalse(IRSNonprofitData.objects.exists())
+        self.assertIn(
+            'dry run: the update would insert 998, update 0 and '
+            'delete 0 rows', stdout.getvalue())
+
+    def test_source_option(self):
+        call_command('update_charitychecker_data',
+                     source=MOCK_DATA_LOCATION_BEFORE, stdout=StringIO())
+        self.assertTrue(IRSNonprofitData.objects.get(pk='010407276'))
+
+    def test_profile_option(self):
+        stdout = StringIO()
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'update.prof')
+            call_command('update_charitychecker_data', profile=path,
+                         source=MOCK_DATA_LOCATION_BEFORE, stdout=stdout)
+            stats = pstats.Stats(path)
+        self.assertTrue(any(
+            function == 'update_charitychecker_data'
+            for filename, line, function in stats.stats))
+        output = stdout.getvalue()
+        self.assertIn('profile written to %s' % path, output)
+        self.assertIn('function calls', output)
+        self.assertTrue(re.search(r'peak memory use: [0-9.]+ MB', output))
+        self.assertTrue(IRSNonprofitData.objects.get(pk='010407276'))
+
+    def test_reports_bloom_filter(self):
+        stdout = StringIO()
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'bloom')
+            with self.settings(CHARITYCHECKER_BLOOM_FILTER_PATH=path):
+                with serve_irs_data(MOCK_DATA_LOCATION_BEFORE):
+                    call_command('update_charitychecker_data',
+                                 stdout=stdout)
+        self.assertIn(
+            'the Bloom filter holds %d EINs' %
+            IRSNonprofitData.objects.count(),
+            stdout.getvalue())
+
+
 # Test models.py
 
+
 class TestIRSNonprofitData(TestCase):
     """test suite for the IRSNonprofitData model."""
 
     def setUp(self):
+        # start each test with an empty lookup cache.
+        lookup_cache.clear()
         # add Red Cross to the database.
         IRSNonprofitData(
             ein='530196605', name='American National Red Cross',
@@ -284,6 +1323,13 @@ class TestIRSNonprofitData(TestCase):
     def test_verify_nonprofit_bad_ein(self):
         self.assertFalse(IRSNonprofitData.verify_nonprofit(ein='4'))
 
+    def test_verify_nonprofit_integer_ein(self):
+        self.assertTrue(IRSNonprofitData.verify_nonprofit(
+            ein=530196605, name='American National Red Cross'))
+        self.assertEqual(
+            IRSNonprofitData.verify_nonprofits([(530196605,), (4,)]),
+            [True, False])
+
     # testing the get_deductability_code method
     def test_get_deductability_code_all_arguments_true(self):
         self.assertEqual(
@@ -358,3 +1404,1308 @@ class TestIRSNonprofitData(TestCase):
                 ein='6'),
             '')
 
+
+    # testing the verify_nonprofits method
+    def test_verify_nonprofits_with_tuples(self):
+        self.assertEqual(
+            IRSNonprofitData.verify_nonprofits([
+                ('530196605', 'American National Red Cross',
+                 'Charlotte', 'NC', 'United States', 'PC'),
+                ('530196605', 'American National Red Cross',
+                 'Boston'), # city is a false argument
+                ('530196605',),
+                ('4',)]),
+            [True, False, True, False])
+
+    def test_verify_nonprofits_with_dicts(self):
+        self.assertEqual(
+            IRSNonprofitData.verify_nonprofits([
+                {'ein': '530196605', 'state': 'NC',
+                 'deductability_code': 'PC'},
+                {'ein': '530196605', 'name': None,
+                 'deductability_code': 'PF'}, # code is a false argument
+                {'ein': '4'}]),
+            [True, False, False])
+
+    def test_verify_nonprofits_keeps_input_order(self):
+        IRSNonprofitData(
+            ein='131788491', name='Save the Children Federation Inc.',
+            city='Fairfield', state='CT', country='United States',
+            deductability_code='PC').save()
+        self.assertEqual(
+            IRSNonprofitData.verify_nonprofits([
+                ('131788491', 'Save the Children Federation Inc.'),
+                ('4',),
+                ('530196605', 'American National Red Cross'),
+                ('131788491', 'American National Red Cross')]),
+            [True, False, True, False])
+
+    def test_verify_nonprofits_queries_in_chunks(self):
+        nonprofits = [('530196605',)] + [
+            (str(ein),) for ein in range(100000000, 100000009)]
+        with self.assertNumQueries(4):
+            verified = IRSNonprofitData.verify_nonprofits(
+                nonprofits, chunk_size=3)
+        self.assertEqual(verified, [True] + [False] * 9)
+
+    def test_verify_nonprofits_with_no_nonprofits(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(IRSNonprofitData.verify_nonprofits([]), [])
+
+    # testing the lookup cache
+    def test_verify_nonprofit_caches_lookups(self):
+        IRSNonprofitData.verify_nonprofit(ein='530196605')
+        with self.assertNumQueries(0):
+            self.assertTrue(IRSNonprofitData.verify_nonprofit(
+                ein='530196605', name='American National Red Cross'))
+            self.assertEqual(
+                IRSNonprofitData.get_deductability_code(
+                    ein='530196605'),
+                'PC')
+
+    def test_verify_nonprofit_caches_unknown_eins(self):
+        IRSNonprofitData.verify_nonprofit(ein='4')
+        with self.assertNumQueries(0):
+            self.assertFalse(IRSNonprofitData.verify_nonprofit(ein='4'))
+            self.assertEqual(
+                IRSNonprofitData.get_deductability_code(ein='4'), '')
+
+    def test_verify_nonprofits_uses_the_lookup_cache(self):
+        IRSNonprofitData.verify_nonprofit(ein='530196605')
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                IRSNonprofitData.verify_nonprofits(
+                    [('530196605',), ('4',)]),
+                [True, False])
+        with self.assertNumQueries(0):
+            self.assertFalse(IRSNonprofitData.verify_nonprofit(ein='4'))
+
+    def test_dataset_updated_invalidates_the_lookup_cache(self):
+        self.assertFalse(IRSNonprofitData.verify_nonprofit(ein='4'))
+        IRSNonprofitData(
+            ein='4', name='Four', city='Boston', state='MA',
+            country='United States', deductability_code='PC').save()
+        self.assertFalse(IRSNonprofitData.verify_nonprofit(ein='4'))
+        dataset_updated.send(sender=IRSNonprofitData)
+        self.assertTrue(IRSNonprofitData.verify_nonprofit(ein='4'))
+
+
+
+@override_settings(
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'charitychecker': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'charitychecker-tests'}},
+    CHARITYCHECKER_SHARED_CACHE='charitychecker')
+class TestIRSNonprofitDataSharedCache(TestCase):
+    """test suite for IRSNonprofitData's lookups through a
+    shared django cache.
+    """
+
+    def setUp(self):
+        lookup_cache.clear()
+        get_shared_cache().cache.clear()
+        IRSNonprofitData(
+            ein='530196605', name='American National Red Cross',
+            city='Charlotte', state='NC', country='United States',
+            deductability_code='PC').save()
+
+    def test_lookups_are_shared(self):
+        IRSNonprofitData.verify_nonprofits([('530196605',), ('4',)])
+        # forget this process's lookups, as if in another process
+        lookup_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertTrue(IRSNonprofitData.verify_nonprofit(
+                ein='530196605', name='American National Red Cross'))
+            self.assertEqual(
+                IRSNonprofitData.get_deductability_code(ein='4'), '')
+
+    def test_lookups_are_fetched_together(self):
+        IRSNonprofitData.verify_nonprofits([('530196605',), ('4',)])
+        lookup_cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                IRSNonprofitData.verify_nonprofits(
+                    [('530196605',), ('4',), ('6',)]),
+                [True, False, False])
+
+    def test_lookups_of_eins_that_arent_text(self):
+        for ein in (530196605, u'53019660\xe9'):
+            IRSNonprofitData.verify_nonprofit(ein=ein)
+        lookup_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertTrue(IRSNonprofitData.verify_nonprofit(ein=530196605))
+            self.assertFalse(
+                IRSNonprofitData.verify_nonprofit(ein=u'53019660\xe9'))
+
+    def test_dataset_updated_publishes_a_new_version(self):
+        shared_cache = get_shared_cache()
+        version = shared_cache.get_version()
+        self.assertFalse(IRSNonprofitData.verify_nonprofit(ein='4'))
+        IRSNonprofitData(
+            ein='4', name='Four', city='Boston', state='MA',
+            country='United States', deductability_code='PC').save()
+        lookup_cache.clear()
+        self.assertFalse(IRSNonprofitData.verify_nonprofit(ein='4'))
+        dataset_updated.send(sender=IRSNonprofitData)
+        lookup_cache.clear()
+        self.assertNotEqual(shared_cache.get_version(), version)
+        self.assertTrue(IRSNonprofitData.verify_nonprofit(ein='4'))
+
+
+# Test caching.py
+
+class TestLRUCache(TestCase):
+    """test suite for the LRUCache class."""
+
+    def test_get_returns_cached_values(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 'missing'), None)
+        self.assertEqual(cache.get('c', 'missing'), 'missing')
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_entries_expire(self):
+        cache = LRUCache(maxsize=2, ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_bump_generation_invalidates_entries(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2, generation=get_generation())
+        bump_generation()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), None)
+
+    def test_values_from_old_generations_are_not_cached(self):
+        cache = LRUCache(maxsize=2)
+        generation = get_generation()
+        bump_generation()
+        cache.set('a', 1, generation)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_maxsize_of_zero_turns_cache_off(self):
+        cache = LRUCache(maxsize=0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_stats(self):
+        cache = LRUCache(maxsize=1)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.set('b', 2)
+        self.assertEqual(cache.stats(), {
+            'hits': 1, 'misses': 1, 'evictions': 1,
+            'size': 1, 'maxsize': 1})
+
+
+# Test index.py
+
+class TestNonprofitIndex(TestCase):
+    """test suite for the NonprofitIndex class."""
+
+    rows = [
+        ('530196605', 'American National Red Cross', 'Charlotte',
+         'NC', 'United States', 'PC'),
+        ('010407276', 'Sunrise Opportunities', 'Machias',
+         'ME', 'United States', 'PC'),
+        ('01-0400845', 'Bauneg Beg Lake Association Inc.', 'N Berwick',
+         'ME', 'United States', 'EO'),
+        ('010400845', 'Bauneg Beg Lake Association Inc.', 'N Berwick',
+         'ME', 'United States', 'PC'),
+        ('010407276', 'Repeated', 'Nowhere', 'ME', 'United States', 'PC')]
+
+    def test_get(self):
+        index = NonprofitIndex(self.rows)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(
+            index.get('010407276'),
+            (u'Sunrise Opportunities', u'Machias', u'ME',
+             u'United States', u'PC'))
+        self.assertEqual(index.get('530196605')[0],
+                         u'American National Red Cross')
+        self.assertEqual(index.get('01-0400845')[-1], u'EO')
+        self.assertEqual(index.get('000000000'), None)
+        self.assertEqual(index.get('999999999'), None)
+        self.assertEqual(index.get('10400845'), None)
+        self.assertFalse('4' in index)
+        self.assertEqual(index.get(530196605)[0],
+                         u'American National Red Cross')
+        self.assertEqual(index.get(10400845), None)
+
+    def test_from_model_matches_database(self):
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        chunk_size = index_module.BUILD_CHUNK_SIZE
+        index_module.BUILD_CHUNK_SIZE = 300
+        try:
+            index = NonprofitIndex.from_model(IRSNonprofitData)
+        finally:
+            index_module.BUILD_CHUNK_SIZE = chunk_size
+        self.assertEqual(len(index), IRSNonprofitData.objects.count())
+        for row in IRSNonprofitData.objects.values_list(
+            'ein', 'name', 'city', 'state', 'country',
+            'deductability_code'):
+            self.assertEqual(index.get(row[0]), row[1:])
+
+    def test_memory_usage(self):
+        index = NonprofitIndex(self.rows)
+        names = len('American National Red Cross' 'Sunrise Opportunities'
+                    'Bauneg Beg Lake Association Inc.')
+        # an EIN, an offset, a city and a tail per nonprofit, and
+        # one more offset.
+        self.assertEqual(index.memory_usage(), names + 3 * 16 + 4)
+
+
+class TestIndexHolder(TestCase):
+    """test suite for the _IndexHolder class."""
+
+    def setUp(self):
+        self.built = []
+        self.holder = _IndexHolder(build=self.build)
+
+    def build(self, model):
+        self.built.append(model)
+        return NonprofitIndex([])
+
+    def test_built_once(self):
+        index = self.holder.get(IRSNonprofitData)
+        self.assertTrue(self.holder.get(IRSNonprofitData) is index)
+        self.assertEqual(self.built, [IRSNonprofitData])
+
+    def test_rebuilt_at_once_when_generation_changes(self):
+        index = self.holder.get(IRSNonprofitData)
+        bump_generation()
+        new_index = self.holder.get(IRSNonprofitData)
+        self.assertFalse(new_index is index)
+        self.assertEqual(len(self.built), 2)
+        self.assertTrue(self.holder._thread is None)
+        self.assertTrue(self.holder.get(IRSNonprofitData) is new_index)
+
+    def test_rebuild_doesnt_replace_a_newer_index(self):
+        self.holder.get(IRSNonprofitData)
+        newer = []
+        def build(model):
+            # the index is cleared and built afresh while the
+            # rebuild is under way.
+            self.holder.build = self.build
+            self.holder.clear()
+            newer.append(self.holder.get(IRSNonprofitData))
+            return NonprofitIndex([])
+        self.holder.build = build
+        self.holder._rebuild(IRSNonprofitData)
+        self.assertTrue(self.holder._index is newer[0])
+
+    @override_settings(CHARITYCHECKER_LOOKUP_CACHE_TTL=0)
+    def test_rebuilt_in_background_when_expired(self):
+        index = self.holder.get(IRSNonprofitData)
+        # the old index is returned while the new one is built.
+        self.assertTrue(self.holder.get(IRSNonprofitData) is index)
+        self.holder._thread.join()
+        self.assertEqual(len(self.built), 2)
+        self.assertFalse(self.holder._index is index)
+
+    @override_settings(CHARITYCHECKER_LOOKUP_CACHE_TTL=0)
+    def test_failed_rebuild_waits_before_trying_again(self):
+        index = self.holder.get(IRSNonprofitData)
+        failed = []
+        def build(model):
+            failed.append(model)
+            raise DatabaseError("the database is down")
+        self.holder.build = build
+        # rebuild on this thread.
+        self.holder._start_rebuild = self.holder._rebuild
+        for i in range(5):
+            self.assertTrue(self.holder.get(IRSNonprofitData) is index)
+        self.assertEqual(failed, [IRSNonprofitData])
+
+
+@override_settings(CHARITYCHECKER_INDEX=True)
+class TestIRSNonprofitDataIndex(TestCase):
+    """test suite for IRSNonprofitData's lookups through the
+    in-memory index.
+    """
+
+    def setUp(self):
+        clear_index()
+        IRSNonprofitData(
+            ein='530196605', name='American National Red Cross',
+            city='Charlotte', state='NC', country='United States',
+            deductability_code='PC').save()
+
+    def tearDown(self):
+        clear_index()
+
+    def test_lookups_use_the_index(self):
+        IRSNonprofitData.verify_nonprofit(ein='530196605')
+        with self.assertNumQueries(0):
+            self.assertTrue(IRSNonprofitData.verify_nonprofit(
+                ein='530196605', name='American National Red Cross'))
+            self.assertFalse(IRSNonprofitData.verify_nonprofit(
+                ein='530196605', name='Red Cross'))
+            self.assertEqual(
+                IRSNonprofitData.get_deductability_code(
+                    ein='530196605', state='NC'), 'PC')
+            self.assertEqual(
+                IRSNonprofitData.get_deductability_code(ein='4'), '')
+            self.assertEqual(
+                IRSNonprofitData.verify_nonprofits(
+                    [('530196605', 'American National Red Cross'),
+                     ('4',)]),
+                [True, False])
+
+    def test_rebuilt_after_update(self):
+        self.assertFalse(IRSNonprofitData.verify_nonprofit(
+            ein='010407276'))
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        # the first lookup after the update sees it.
+        self.assertTrue(IRSNonprofitData.verify_nonprofit(
+            ein='010407276', city='Machias'))
+        self.assertFalse(IRSNonprofitData.verify_nonprofit(
+            ein='530196605'))
+
+    @override_settings(CHARITYCHECKER_INDEX=False)
+    def test_off_by_default(self):
+        with self.assertNumQueries(1):
+            IRSNonprofitData.verify_nonprofit(ein='999999999')
+
+
+# Test snapshot.py
+
+class TestSnapshot(TestCase):
+    """test suite for writing and reading snapshot files."""
+
+    rows = [
+        ('010400845', u'Bauneg Beg Lake Association Inc.', u'N Berwick',
+         u'ME', u'United States', u'PC'),
+        ('010407276', u'Sunrise Opportunities', u'Machias',
+         u'ME', u'United States', u'PC'),
+        ('4', u'Caf\xe9 Society', u'Paris', u'', u'FRANCE', u'FORGN'),
+        ('530196605', u'American National Red Cross', u'Charlotte',
+         u'NC', u'United States', u'PC')]
+
+    def test_round_trip(self):
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'snapshot')
+            write_snapshot(path, self.rows)
+            snapshot = Snapshot(path)
+            self.assertEqual(len(snapshot), 4)
+            for row in self.rows:
+                self.assertEqual(snapshot.get(row[0]), row[1:])
+            self.assertEqual(snapshot.get(u'530196605')[0],
+                             u'American National Red Cross')
+            self.assertEqual(snapshot.get(530196605)[0],
+                             u'American National Red Cross')
+            self.assertEqual(snapshot.get(4)[0], u'Caf\xe9 Society')
+            for ein in ['', '0', '01040084', '010400846', '999999999',
+                        '4 ', '0104072761']:
+                self.assertEqual(snapshot.get(ein), None)
+            snapshot.close()
+
+    def test_many_rows(self):
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'snapshot')
+            write_model_snapshot(IRSNonprofitData, path, chunk_size=300)
+            snapshot = Snapshot(path)
+            rows = IRSNonprofitData.objects.values_list(
+                'ein', 'name', 'city', 'state', 'country',
+                'deductability_code')
+            self.assertEqual(len(snapshot), len(rows))
+            for row in rows:
+                self.assertEqual(snapshot.get(row[0]), row[1:])
+            snapshot.close()
+
+    def test_unsorted_rows(self):
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'snapshot')
+            write_snapshot(path, list(reversed(self.rows)))
+            snapshot = Snapshot(path)
+            self.assertEqual(len(snapshot), 4)
+            for row in self.rows:
+                self.assertEqual(snapshot.get(row[0]), row[1:])
+            snapshot.close()
+            with open(path, 'rb') as f:
+                unsorted = f.read()
+            write_snapshot(path, self.rows)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), unsorted)
+
+    def test_repeated_eins_leave_old_snapshot(self):
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'snapshot')
+            write_snapshot(path, self.rows)
+            with self.assertRaises(ValueError):
+                write_snapshot(path, self.rows[1:] + self.rows[:2])
+            self.assertEqual(os.listdir(directory), ['snapshot'])
+            self.assertEqual(len(Snapshot(path)), 4)
+
+
+class TestIRSNonprofitDataSnapshot(TestCase):
+    """test suite for IRSNonprofitData's lookups through a
+    snapshot file.
+    """
+
+    def test_lookups_use_the_snapshot(self):
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'snapshot')
+            with self.settings(CHARITYCHECKER_SNAPSHOT_PATH=path):
+                # without a snapshot, the database is used.
+                with self.assertNumQueries(1):
+                    IRSNonprofitData.verify_nonprofit(ein='010407276')
+                update_charitychecker_data(
+                    file_manager=irs_mock_data_before)
+                self.assertTrue(os.path.exists(path))
+                code = IRSNonprofitData.objects.get(
+                    ein='010400845').deductability_code
+                with self.assertNumQueries(0):
+                    self.assertTrue(IRSNonprofitData.verify_nonprofit(
+                        ein='010407276', city='Machias'))
+                    self.assertEqual(
+                        IRSNonprofitData.get_deductability_code(
+                            ein='010400845', city='N Berwick'), code)
+                    self.assertEqual(
+                        IRSNonprofitData.verify_nonprofits(
+                            [('010407276',), ('4',)]),
+                        [True, False])
+                update_charitychecker_data(
+                    file_manager=irs_mock_data_after)
+                with self.assertNumQueries(0):
+                    self.assertFalse(IRSNonprofitData.verify_nonprofit(
+                        ein='010407276'))
+                    self.assertTrue(IRSNonprofitData.verify_nonprofit(
+                        ein='010400845', city='Calais'))
+
+
+class TestFileHolder(TestCase):
+    """test suite for FileHolder."""
+
+    def test_reloads_replaced_files(self):
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'file')
+            holder = FileHolder(lambda path: open(path).read())
+            self.assertEqual(holder.get(path), None)
+            with open(path, 'w') as f:
+                f.write('old')
+            # a missing file is noticed at the next check.
+            holder._checked = 0
+            self.assertEqual(holder.get(path), 'old')
+            with open(path + '.new', 'w') as f:
+                f.write('new')
+            os.rename(path + '.new', path)
+            self.assertEqual(holder.get(path), 'old')
+            bump_generation()
+            self.assertEqual(holder.get(path), 'new')
+
+
+# Test bloom.py
+
+class TestBloomFilter(TestCase):
+    """test suite for BloomFilter."""
+
+    def setUp(self):
+        self.eins = ['%09d' % (i * 7919) for i in range(2000)]
+        self.others = ['%09d' % (i * 7919 + 1) for i in range(20000)]
+        self.bloom_filter = BloomFilter(len(self.eins), 0.01)
+        for ein in self.eins:
+            self.bloom_filter.add(ein)
+
+    def test_no_false_negatives(self):
+        for ein in self.eins:
+            self.assertIn(ein, self.bloom_filter)
+        self.assertIn(unicode(self.eins[0]), self.bloom_filter)
+
+    def test_error_rate(self):
+        false_positives = sum(
+            1 for ein in self.others if ein in self.bloom_filter)
+        self.assertLess(float(false_positives) / len(self.others), 0.02)
+        self.assertLess(self.bloom_filter.estimated_error_rate(), 0.02)
+
+    def test_write_and_load(self):
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'bloom')
+            self.bloom_filter.write(path)
+            loaded = BloomFilter.load(path)
+        self.assertEqual(loaded.count, 2000)
+        self.assertEqual(loaded.error_rate, 0.01)
+        self.assertEqual(
+            [ein in loaded for ein in self.eins + self.others],
+            [ein in self.bloom_filter for ein in self.eins + self.others])
+
+    def test_bad_error_rate(self):
+        with self.assertRaises(ValueError):
+            BloomFilter(10, 1)
+
+
+class TestIRSNonprofitDataBloomFilter(TestCase):
+    """test suite for IRSNonprofitData's lookups through a
+    Bloom filter.
+    """
+
+    def test_unknown_eins_skip_the_database(self):
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'bloom')
+            with self.settings(CHARITYCHECKER_BLOOM_FILTER_PATH=path,
+                               CHARITYCHECKER_BLOOM_FILTER_ERROR_RATE=1e-6):
+                update_charitychecker_data(
+                    file_manager=irs_mock_data_before)
+                self.assertTrue(os.path.exists(path))
+                with self.assertNumQueries(0):
+                    self.assertFalse(IRSNonprofitData.verify_nonprofit(
+                        ein='999999999'))
+                    self.assertEqual(
+                        IRSNonprofitData.verify_nonprofits(
+                            [('999999998',), ('999999997',)]),
+                        [False, False])
+                with self.assertNumQueries(1):
+                    self.assertTrue(IRSNonprofitData.verify_nonprofit(
+                        ein='010407276'))
+
+    def test_filter_holds_new_eins_before_the_commit(self):
+        """test that the filter an update writes before it
+        commits rules out neither the EINs it inserts nor the
+        ones it deletes.
+        """
+        class Watcher(object):
+            def add(self, ein):
+                pass
+
+            def prepare(self):
+                # prepared after the Bloom filter's watcher.
+                bloom_filter = BloomFilter.load(path)
+                prepared.append(
+                    ('900410317' in bloom_filter,
+                     '010407276' in bloom_filter,
+                     IRSNonprofitData.objects.filter(
+                         pk='900410317').exists()))
+
+        def watch(sender, **kwargs):
+            return Watcher()
+        prepared = []
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'bloom')
+            with self.settings(CHARITYCHECKER_BLOOM_FILTER_PATH=path,
+                               CHARITYCHECKER_BLOOM_FILTER_ERROR_RATE=1e-6):
+                update_charitychecker_data(
+                    file_manager=irs_mock_data_before)
+                self.assertFalse('900410317' in BloomFilter.load(path))
+                dataset_updating.connect(watch)
+                try:
+                    update_charitychecker_data(
+                        file_manager=irs_mock_data_after)
+                finally:
+                    dataset_updating.disconnect(watch)
+                self.assertFalse('010407276' in BloomFilter.load(path))
+        self.assertEqual(prepared, [(True, True, True)])
+
+    def test_errors_writing_files_dont_fail_the_update(self):
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'missing', 'bloom')
+            with self.settings(CHARITYCHECKER_BLOOM_FILTER_PATH=path):
+                update_charitychecker_data(
+                    file_manager=irs_mock_data_before)
+        self.assertTrue(
+            IRSNonprofitData.objects.filter(pk='010407276').exists())
+
+
+# Test search.py
+
+class TestSearch(TestCase):
+    """test suite for searching the nonprofits by name."""
+
+    def setUp(self):
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+
+    def expected(self, name, state=None):
+        # the EINs of the nonprofits with a word beginning with
+        # each word of name.
+        words = name.lower().split()
+        return set(
+            nonprofit.ein for nonprofit in IRSNonprofitData.objects.all()
+            if (state is None or nonprofit.state == state) and all(
+                any(name_word.startswith(word) for name_word in
+                    re.findall(r'\w+', nonprofit.name.lower()))
+                for word in words))
+
+    def test_has_search_index(self):
+        self.assertTrue(has_search_index(IRSNonprofitData))
+
+    def test_search(self):
+        for name in ['hist soc', 'Geological', 'society of maine', 'xyz']:
+            self.assertEqual(
+                set(nonprofit.ein for nonprofit in
+                    IRSNonprofitData.search(name, limit=1000)),
+                self.expected(name))
+        self.assertEqual(
+            IRSNonprofitData.search('GEOLOGICAL SOCIETY')[0].name,
+            'Geological Society of Maine Inc. the')
+
+    def test_state(self):
+        nonprofits = IRSNonprofitData.search('hist soc', state='MA')
+        self.assertEqual(
+            set(nonprofit.ein for nonprofit in nonprofits),
+            self.expected('hist soc', state='MA'))
+        self.assertIn('010359121', [nonprofit.ein for nonprofit in nonprofits])
+
+    def test_limit(self):
+        self.assertEqual(len(IRSNonprofitData.search('society', limit=5)), 5)
+
+    def test_no_words(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(IRSNonprofitData.search(' & '), [])
+
+    def test_sees_updates(self):
+        self.assertEqual(IRSNonprofitData.search('Blank Family'), [])
+        update_charitychecker_data(file_manager=irs_mock_data_after)
+        self.assertEqual(
+            [nonprofit.ein for nonprofit in
+             IRSNonprofitData.search('Blank Family')],
+            ['900410317'])
+        self.assertEqual(IRSNonprofitData.search('Sunrise Opp'), [])
+
+    def test_ranked_by_the_index_before_the_limit(self):
+        """test that, when more names match than are ranked,
+        the ones ranked are among the best, rather than the
+        first found.
+        """
+        rank_candidates = search_module.RANK_CANDIDATES
+        search_module.RANK_CANDIDATES = 3
+        try:
+            nonprofits = IRSNonprofitData.search('society', limit=3)
+        finally:
+            search_module.RANK_CANDIDATES = rank_candidates
+        self.assertEqual(
+            [len(nonprofit.name.split()) for nonprofit in nonprofits],
+            [3, 3, 3])
+
+    def test_without_search_index(self):
+        search_module._has_search_index['default'] = False
+        try:
+            self.assertEqual(
+                [nonprofit.ein for nonprofit in
+                 IRSNonprofitData.search('geological soc')],
+                ['010353848'])
+        finally:
+            del search_module._has_search_index['default']
+
+
+class TestIRSNonprofitDataAdmin(TestCase):
+    """test suite for searches in IRSNonprofitData's admin."""
+
+    def setUp(self):
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+        self.admin = IRSNonprofitDataAdmin(IRSNonprofitData, admin.site)
+
+    def search(self, search_term):
+        queryset, use_distinct = self.admin.get_search_results(
+            None, IRSNonprofitData.objects.all(), search_term)
+        self.assertFalse(use_distinct)
+        return set(queryset.values_list('ein', flat=True))
+
+    def test_ein_search(self):
+        self.assertEqual(self.search('010353848'), set(['010353848']))
+        self.assertEqual(
+            self.search('01-0353'),
+            set(IRSNonprofitData.objects.filter(
+                ein__startswith='010353').values_list('ein', flat=True)))
+
+    def test_name_search(self):
+        self.assertEqual(self.search('geological society'),
+                         set(['010353848']))
+
+    def test_digits_search_names_too(self):
+        self.assertEqual(self.search('176'), set(['010332201']))
+        self.assertEqual(
+            self.search('0103322'),
+            set(IRSNonprofitData.objects.filter(
+                ein__startswith='0103322').values_list('ein', flat=True)))
+
+    def test_empty_search(self):
+        self.assertEqual(len(self.search('')),
+                         IRSNonprofitData.objects.count())
+
+
+class TestNormalizeName(TestCase):
+    """test suite for normalize_name and name_similarity."""
+
+    def test_normalize_name(self):
+        self.assertEqual(
+            normalize_name(
+                'The Society of St. Vincent De Paul of Memphis Inc.'),
+            'society of saint vincent de paul of memphis')
+        self.assertEqual(normalize_name('Natl Assn. of B&B Owners'),
+                         'national association of b and b owners')
+        self.assertEqual(normalize_name(u'Caf\xe9 Soci\xe9t\xe9'),
+                         'cafe societe')
+        self.assertEqual(normalize_name('Caf\xc3\xa9'), 'cafe')
+        self.assertEqual(normalize_name(' - '), '')
+        self.assertEqual(len(normalize_name('Foundation ' * 20)), 100)
+
+    def test_name_similarity(self):
+        self.assertEqual(name_similarity('red cross', 'red cross'), 1.0)
+        self.assertGreaterEqual(
+            name_similarity('american red cross',
+                            'american national red cross'), 0.8)
+        self.assertGreater(
+            name_similarity('saint vincent de paul society',
+                            'society of saint vincent de paul'), 0.9)
+        self.assertLess(name_similarity('red cross', 'blue shield'), 0.5)
+
+
+class TestIRSNonprofitDataFuzzyMatch(TestCase):
+    """test suite for verify_nonprofit's fuzzy matching."""
+
+    def setUp(self):
+        lookup_cache.clear()
+        update_charitychecker_data(file_manager=irs_mock_data_before)
+
+    def test_sync_fills_normalized_name(self):
+        self.assertEqual(
+            IRSNonprofitData.objects.get(pk='000262650').normalized_name,
+            'society of saint vincent de paul of memphis')
+
+    def test_save_fills_normalized_name(self):
+        IRSNonprofitData(
+            ein='999999999', name='The Natl Assn. of B&B Owners',
+            city='Portland', state='ME', country='United States',
+            deductability_code='PC').save()
+        self.assertEqual(
+            IRSNonprofitData.objects.get(pk='999999999').normalized_name,
+            'national association of b and b owners')
+        self.assertEqual(IRSNonprofitData.verify_nonprofit(
+            None, name='National Association of B and B Owners',
+            match='fuzzy'), 1.0)
+
+    def test_with_ein(self):
+        name = 'St Vincent de Paul Society, Memphis'
+        with self.assertNumQueries(1):
+            self.assertGreater(IRSNonprofitData.verify_nonprofit(
+                '000262650', name=name, match='fuzzy'), 0.9)
+        self.assertFalse(IRSNonprofitData.verify_nonprofit(
+            '000262650', name=name))
+        self.assertLess(IRSNonprofitData.verify_nonprofit(
+            '000262650', name='Iglesia Bethesda',
+            match='fuzzy'), 0.5)
+        self.assertEqual(IRSNonprofitData.verify_nonprofit(
+            '000262650', name=name, city='Portland', match='fuzzy'), 0.0)
+        self.assertEqual(IRSNonprofitData.verify_nonprofit(
+            '999999999', name=name, match='fuzzy'), 0.0)
+        self.assertEqual(IRSNonprofitData.verify_nonprofit(
+            '000262650', match='fuzzy'), 1.0)
+
+    def test_without_ein(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(IRSNonprofitData.verify_nonprofit(
+                None, name='Society of Saint Vincent de Paul of Memphis',
+                match='fuzzy'), 1.0)
+        self.assertGreater(IRSNonprofitData.verify_nonprofit(
+            None, name='Society of St Vincent de Pual, Memphis',
+            state='TN', match='fuzzy'), 0.9)
+        self.assertEqual(IRSNonprofitData.verify_nonprofit(
+            None, name='Society of St Vincent de Paul, Memphis',
+            state='ME', match='fuzzy'), 0.0)
+        self.assertEqual(IRSNonprofitData.verify_nonprofit(
+            None, name='Sociedad San Vicente', match='fuzzy'), 0.0)
+
+    def test_next_prefix(self):
+        self.assertEqual(_next_prefix('saint'), 'sainu')
+        self.assertEqual(_next_prefix('4h9'), '4ha')
+        self.assertEqual(_next_prefix('jazz'), 'jb')
+        self.assertEqual(_next_prefix('zz'), None)
+
+    def test_nearby_names_start_with_the_first_word(self):
+        for i, name in enumerate(['zz top fans', 'zz']):
+            IRSNonprofitData(
+                ein='99999999%d' % i, name=name, city='Portland',
+                state='ME', country='United States',
+                deductability_code='PC').save()
+        names = nearby_normalized_names(IRSNonprofitData, 'society of')
+        self.assertTrue(names)
+        self.assertTrue(all(name.split()[0].startswith('society')
+                            for name in names))
+        self.assertEqual(
+            sorted(nearby_normalized_names(IRSNonprofitData, 'zz top')),
+            ['zz', 'zz top fans'])
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            IRSNonprofitData.verify_nonprofit('000262650', match='close')
+        with self.assertRaises(ValueError):
+            IRSNonprofitData.verify_nonprofit(None, match='fuzzy')
+
+
+# Test batching.py
+
+class TestLookupFuture(TestCase):
+    """test suite for the LookupFuture class."""
+
+    def test_result(self):
+        future = LookupFuture()
+        self.assertFalse(future.done())
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=0)
+        future.set_result(4)
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), 4)
+        self.assertEqual(future.exception(), None)
+
+    def test_exception(self):
+        future = LookupFuture()
+        future.set_exception(ValueError('bad'))
+        self.assertTrue(isinstance(future.exception(), ValueError))
+        with self.assertRaises(ValueError):
+            future.result()
+
+    def test_then(self):
+        future = LookupFuture()
+        doubled = future.then(lambda result: result * 2)
+        halved = LookupFuture.resolved(4).then(lambda result: result / 2)
+        failed = LookupFuture.resolved(4).then(lambda result: result / 0)
+        future.set_result(4)
+        self.assertEqual(doubled.result(), 8)
+        self.assertEqual(halved.result(), 2)
+        with self.assertRaises(ZeroDivisionError):
+            failed.result()
+
+    def test_gather(self):
+        futures = [LookupFuture() for i in range(3)]
+        gathered = gather(futures)
+        for i, future in reversed(list(enumerate(futures))):
+            self.assertFalse(gathered.done())
+            future.set_result(i)
+        self.assertEqual(gathered.result(), [0, 1, 2])
+        self.assertEqual(gather([]).result(), [])
+        futures[0] = LookupFuture()
+        gathered = gather(futures)
+        futures[0].set_exception(KeyError('0'))
+        with self.assertRaises(KeyError):
+            gathered.result()
+
+
+class TestLookupBatcher(TestCase):
+    """test suite for the LookupBatcher class."""
+
+    def setUp(self):
+        self.batches = []
+        self.release = threading.Event()
+
+    def load(self, eins):
+        self.batches.append(sorted(eins))
+        self.release.wait(1)
+        if 'bad' in eins:
+            raise ValueError('bad EIN')
+        return dict((ein, (ein,)) for ein in eins if ein != '4')
+
+    def test_lookups_are_batched(self):
+        batcher = LookupBatcher(self.load, window=0.05)
+        self.release.set()
+        futures = [batcher.submit(ein) for ein in ('1', '2', '3', '4')]
+        self.assertEqual(
+            [future.result(1) for future in futures],
+            [('1',), ('2',), ('3',), None])
+        self.assertEqual(self.batches, [['1', '2', '3', '4']])
+        self.assertEqual(batcher.batches, 1)
+
+    def test_lookups_are_coalesced(self):
+        batcher = LookupBatcher(self.load, window=0)
+        futures = []
+        threads = [
+            threading.Thread(
+                target=lambda: futures.append(batcher.submit('1')))
+            for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the EIN is looked up once, even if some threads submitted
+        # it while the first lookup was already being made.
+        self.release.set()
+        self.assertEqual(
+            set(future.result(1) for future in futures), set([('1',)]))
+        self.assertEqual(self.batches, [['1']])
+
+    def test_batches_are_split(self):
+        batcher = LookupBatcher(self.load, window=0.05, max_batch_size=2)
+        self.release.set()
+        futures = [batcher.submit(ein) for ein in ('1', '2', '3')]
+        for future in futures:
+            future.result(1)
+        self.assertEqual(self.batches, [['1', '2'], ['3']])
+
+    def test_errors_are_passed_on(self):
+        batcher = LookupBatcher(self.load, window=0.05)
+        self.release.set()
+        futures = [batcher.submit(ein) for ein in ('1', 'bad')]
+        for future in futures:
+            with self.assertRaises(ValueError):
+                future.result(1)
+        # later lookups are made as usual.
+        self.assertEqual(batcher.submit('2').result(1), ('2',))
+
+
+class TestIRSNonprofitDataAsync(TestCase):
+    """test suite for IRSNonprofitData's asynchronous lookup
+    methods.
+    """
+
+    def setUp(self):
+        lookup_cache.clear()
+        self.data = {
+            '530196605': (
+                u'American National Red Cross', u'Charlotte', u'NC',
+                u'United States', u'PC')}
+        self.batches = []
+        self.batchers = batching._batchers.copy()
+        # the test database isn't visible to the batcher's thread,
+        # so it looks nonprofits up in self.data instead.
+        batching._batchers[IRSNonprofitData] = LookupBatcher(
+            self.load, window=0.05)
+
+    def tearDown(self):
+        batching._batchers.clear()
+        batching._batchers.update(self.batchers)
+
+    def load(self, eins):
+        self.batches.append(sorted(eins))
+        return dict(
+            (ein, self.data[ein]) for ein in eins if ein in self.data)
+
+    def test_lookups_through_the_database(self):
+        """test lookups with the batcher's own loader, on its
+        thread, which shares the test's connection to the test
+        database.
+        """
+        test_connection = connections['default']
+        closed = []
+        def close_old_connections():
+            closed.append(True)
+            django_close_old_connections()
+        class SharingBatcher(LookupBatcher):
+            def _run(self):
+                connections['default'] = test_connection
+                LookupBatcher._run(self)
+        IRSNonprofitData(
+            ein='530196605', name='American National Red Cross',
+            city='Charlotte', state='NC', country='United States',
+            deductability_code='PC').save()
+        batching._batchers[IRSNonprofitData] = SharingBatcher(
+            IRSNonprofitData._get_many_nonprofit_data, window=0.05)
+        batching.close_old_connections = close_old_connections
+        test_connection.allow_thread_sharing = True
+        try:
+            verified = IRSNonprofitData.averify_nonprofit(
+                '530196605', name='American National Red Cross')
+            missing = IRSNonprofitData.averify_nonprofit('4')
+            self.assertTrue(verified.result(1))
+            self.assertFalse(missing.result(1))
+        finally:
+            test_connection.allow_thread_sharing = False
+            batching.close_old_connections = django_close_old_connections
+        self.assertEqual(closed, [True])
+
+    def test_lookups(self):
+        verified = IRSNonprofitData.averify_nonprofit(
+            '530196605', name='American National Red Cross')
+        wrong_name = IRSNonprofitData.averify_nonprofit(
+            '530196605', name='Red Cross')
+        code = IRSNonprofitData.aget_deductability_code(
+            '530196605', state='NC')
+        missing_code = IRSNonprofitData.aget_deductability_code('4')
+        self.assertTrue(verified.result(1))
+        self.assertFalse(wrong_name.result(1))
+        self.assertEqual(code.result(1), 'PC')
+        self.assertEqual(missing_code.result(1), '')
+        self.assertEqual(self.batches, [['4', '530196605']])
+
+    def test_averify_nonprofits(self):
+        verified = IRSNonprofitData.averify_nonprofits(
+            [('530196605', 'American National Red Cross'),
+             {'ein': '530196605', 'state': 'MA'},
+             ('4',)])
+        self.assertEqual(verified.result(1), [True, False, False])
+        self.assertEqual(self.batches, [['4', '530196605']])
+        self.assertEqual(
+            IRSNonprofitData.averify_nonprofits([]).result(1), [])
+
+    def test_cached_lookups_are_answered_straight_away(self):
+        IRSNonprofitData(
+            ein='4', name='Four', city='Boston', state='MA',
+            country='United States', deductability_code='PC').save()
+        IRSNonprofitData.verify_nonprofit(ein='4')
+        with self.assertNumQueries(0):
+            verified = IRSNonprofitData.averify_nonprofit(
+                '4', city='Boston')
+        self.assertTrue(verified.done())
+        self.assertTrue(verified.result())
+        self.assertEqual(self.batches, [])
+
+    @override_settings(CHARITYCHECKER_INDEX=True)
+    def test_index_lookups_are_answered_straight_away(self):
+        clear_index()
+        IRSNonprofitData(
+            ein='4', name='Four', city='Boston', state='MA',
+            country='United States', deductability_code='PC').save()
+        try:
+            code = IRSNonprofitData.aget_deductability_code('4')
+            self.assertTrue(code.done())
+            self.assertEqual(code.result(), 'PC')
+            self.assertEqual(self.batches, [])
+        finally:
+            clear_index()
+
+
+
+# Test downloader.py
+
+class TestDownloader(TestCase):
+    """test suite for the Downloader class."""
+
+    def setUp(self):
+        self.data = os.urandom(10000)
+        self.requests = []
+        self.sleeps = []
+        self.reports = []
+
+    def downloader(self, **kwargs):
+        kwargs.setdefault('backoff', 1)
+        return Downloader(
+            sleep=self.sleeps.append, progress=self.reports.append,
+            chunk_size=1024, **kwargs)
+
+    def test_download(self):
+        with serve_files({'/data': self.data}) as url:
+            f = io.BytesIO()
+            digest = self.downloader().download(url + '/data', f)
+        self.assertEqual(f.read(), self.data)
+        self.assertEqual(digest, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(len(self.reports), 10)
+        self.assertEqual(
+            self.reports[-1][:3], (url + '/data', 10000, 10000))
+        self.assertGreater(self.reports[-1].rate, 0)
+
+    def test_retries_with_backoff(self):
+        with serve_files({'/data': self.data}, self.requests,
+                         failures=2) as url:
+            f = io.BytesIO()
+            self.downloader(retries=2).download(url + '/data', f)
+        self.assertEqual(f.read(), self.data)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(self.sleeps, [1, 2])
+
+    def test_gives_up_after_retries(self):
+        with serve_files({'/data': self.data}, self.requests,
+                         failures=3) as url:
+            with self.assertRaises(urllib2.HTTPError):
+                self.downloader(retries=2).download(
+                    url + '/data', io.BytesIO())
+        self.assertEqual(len(self.requests), 3)
+
+    def test_does_not_retry_missing_files(self):
+        with serve_files({}, self.requests) as url:
+            with self.assertRaises(urllib2.HTTPError):
+                self.downloader().download(url + '/data', io.BytesIO())
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.sleeps, [])
+
+    def test_retries_interrupted_downloads(self):
+        with serve_files({'/data': self.data}, interrupt=True) as url:
+            with self.assertRaises(DownloadError):
+                self.downloader(retries=0).download(
+                    url + '/data', io.BytesIO())
+            f = io.BytesIO('left over from an earlier download')
+            self.downloader().download(url + '/data', f)
+        self.assertEqual(f.read(), self.data)
+
+    def test_times_out(self):
+        with serve_files({'/data': self.data}, delay=0.5) as url:
+            with self.assertRaises(socket.timeout):
+                self.downloader(timeout=0.1, retries=0).download(
+                    url + '/data', io.BytesIO())
+
+    def test_verifies_checksum(self):
+        digest = hashlib.sha256(self.data).hexdigest()
+        with serve_files({'/data': self.data}, self.requests) as url:
+            f = io.BytesIO()
+            self.downloader().download(url + '/data', f, digest.upper())
+            with self.assertRaises(ChecksumMismatch):
+                self.downloader().download(
+                    url + '/data', io.BytesIO(), '0' * 64)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_download_many(self):
+        files = dict(('/%d' % i, os.urandom(5000)) for i in range(5))
+        with serve_files(files) as url:
+            downloads = [
+                (url + path, io.BytesIO()) for path in sorted(files)]
+            digests = self.downloader().download_many(downloads)
+            with self.assertRaises(urllib2.HTTPError):
+                self.downloader().download_many(
+                    downloads + [(url + '/missing', io.BytesIO())])
+        for (path, data), (_, f), digest in zip(
+            sorted(files.items()), downloads, digests):
+            self.assertEqual(f.getvalue(), data)
+            self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+
+    def test_progress_rate(self):
+        self.assertEqual(
+            DownloadProgress('url', 1000, None, 0.5).rate, 2000.0)
+        self.assertEqual(DownloadProgress('url', 0, None, 0).rate, 0.0)
+
+
+# Test metrics.py
+
+class RecordingSink(object):
+    """a metrics sink that keeps every metric sent to it."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def timing(self, name, seconds):
+        self.metrics[name] = seconds
+
+    def incr(self, name, value=1):
+        self.metrics[name] = self.metrics.get(name, 0) + value
+
+
+class TestUpdateMetrics(TestCase):
+    """test suite for UpdateMetrics."""
+
+    def test_timers_add_up(self):
+        metrics = UpdateMetrics()
+        with metrics.timer('read'):
+            time.sleep(0.01)
+        with metrics.timer('read'):
+            time.sleep(0.01)
+        self.assertGreaterEqual(metrics.timer('read').seconds, 0.02)
+        self.assertEqual(
+            [stats['stage'] for stats in metrics.summary()['stages']],
+            ['read'])
+
+    def test_timed(self):
+        metrics = UpdateMetrics()
+        self.assertEqual(
+            list(metrics.timed('read', xrange(2500), 'rows')),
+            range(2500))
+        self.assertEqual(metrics.counters, {'rows': 2500})
+        self.assertIn('read', metrics.timers)
+
+    def test_counts_queries_of_running_timers(self):
+        metrics = UpdateMetrics()
+        with metrics.measure_queries('default'):
+            with metrics.timer('total'):
+                IRSNonprofitData.objects.count()
+                with metrics.timer('load'):
+                    list(IRSNonprofitData.objects.all())
+                    list(IRSNonprofitData.objects.all())
+        IRSNonprofitData.objects.count()
+        self.assertEqual(metrics.timer('total').queries, 3)
+        self.assertEqual(metrics.timer('load').queries, 2)
+
+    def test_current_metrics(self):
+        metrics = UpdateMetrics()
+        self.assertIsNot(current_metrics(), metrics)
+        with metrics.activate():
+            self.assertIs(current_metrics(), metrics)
+        self.assertIsNot(current_metrics(), metrics)
+
+    def test_report(self):
+        metrics = UpdateMetrics()
+        with metrics.timer('read'):
+            pass
+        metrics.incr('inserted', 5)
+        sink = RecordingSink()
+        metrics.report(sink)
+        self.assertEqual(
+            sorted(sink.metrics), ['inserted', 'read.queries', 'read.seconds'])
+        self.assertEqual(sink.metrics['inserted'], 5)
+
+    def test_statsd_sink(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            sink = StatsdSink('127.0.0.1', server.getsockname()[1])
+            sink.timing('read.seconds', 1.5)
+            sink.incr('inserted', 3)
+            self.assertEqual(
+                server.recv(1024),
+                'charitychecker.update.read.seconds:1500|ms')
+            self.assertEqual(
+                server.recv(1024), 'charitychecker.update.inserted:3|c')
+        finally:
+            server.close()
+
+    def test_update_is_measured(self):
+        """test that an update sends its metrics with the
+        update_measured signal and to the configured sink.
+        """
+        measured = []
+        def record_metrics(sender, metrics, **kwargs):
+            measured.append(metrics)
+        update_measured.connect(record_metrics)
+        try:
+            with self.settings(
+                CHARITYCHECKER_METRICS_SINK=__name__ + '.RecordingSink'):
+                with serve_irs_data(MOCK_DATA_LOCATION_BEFORE):
+                    update_charitychecker_data()
+                with serve_irs_data(MOCK_DATA_LOCATION_AFTER):
+                    update_charitychecker_data(engine='staging')
+        finally:
+            update_measured.disconnect(record_metrics)
+        first, second = [metrics.summary() for metrics in measured]
+        self.assertEqual(
+            [stats['stage'] for stats in first['stages']],
+            ['total', 'download', 'read', 'load', 'insert',
+             'dataset_updated'])
+        self.assertGreater(first['counters']['inserted'], 0)
+        self.assertEqual(
+            first['counters']['rows_read'], first['counters']['inserted'])
+        self.assertGreater(first['counters']['skipped_foreign'], 0)
+        self.assertGreater(first['counters']['archive_bytes'], 0)
+        self.assertGreater(
+            first['counters']['unzipped_bytes'],
+            first['counters']['archive_bytes'])
+        self.assertTrue(set(['stage', 'insert', 'update', 'delete']) <=
+                        set(stats['stage'] for stats in second['stages']))
+        stages = dict((stats['stage'], stats) for stats in first['stages'])
+        self.assertEqual(stages['download']['queries'], 0)
+        self.assertGreater(stages['insert']['queries'], 0)
+        self.assertGreaterEqual(
+            stages['total']['queries'],
+            sum(stats['queries'] for name, stats in stages.items()
+                if name != 'total'))
+
+    def test_receiver_errors_dont_hide_the_updates_own(self):
+        def broken_receiver(sender, **kwargs):
+            raise RuntimeError("broken receiver")
+
+        @contextmanager
+        def broken_irs_data():
+            with irs_mock_data_after() as irs_data:
+                yield itertools.chain(irs_data, ['not|enough|fields'])
+
+        update_measured.connect(broken_receiver)
+        try:
+            with self.assertRaises(ValueError):
+                update_charitychecker_data(file_manager=broken_irs_data)
+            self.assertEqual(
+                update_charitychecker_data(
+                    file_manager=irs_mock_data_before)['inserted'], 1001)
+        finally:
+            update_measured.disconnect(broken_receiver)
@@ -5,12 +5,40 @@ for the operation of the django-charitychecker module.
 
 import re
 import os
+import sys
+import time
+import logging
+import threading
+import Queue
 import urllib2
+import urlparse
 import io
+import hashlib
+import itertools
+import functools
+import operator
+import multiprocessing
+import marshal
+import cPickle
+import gzip
+import datetime
+import json
+import shutil
+import tempfile
 import zipfile
-from contextlib import contextmanager
-from django.db import transaction
+import uuid
+from collections import namedtuple, deque
+from contextlib import contextmanager, closing
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router, transaction
+from django.core.management.color import no_style
+from django.db.models import get_model
 from .models import IRSNonprofitData
+from .downloader import DOWNLOAD_CHUNK_SIZE, Downloader, DownloadError
+from .metrics import UpdateMetrics, current_metrics, get_metrics_sink
+from .search import index_shadow_table, normalize_name
+from .signals import dataset_updated, dataset_updating, update_measured
 
 # Global Variables
 #
@@ -29,8 +57,56 @@ IRS_NONPROFIT_DATA_URL=(
 # zip file download
 TXT_FILE_NAME="data-download-pub78.txt"
 
+# the default number of rows written to the database at a
+# time when updating it, set CHARITYCHECKER_SYNC_BATCH_SIZE
+# in settings.py to change it.
+DEFAULT_SYNC_BATCH_SIZE = 1000
+
+# the default number of rows the shadow sync engine loads
+# into its shadow table in each transaction, set
+# CHARITYCHECKER_SYNC_CHUNK_SIZE in settings.py to change it.
+DEFAULT_SYNC_CHUNK_SIZE = 50000
+
+# the default engine used to find the changes to make when
+# updating the database, set CHARITYCHECKER_SYNC_ENGINE in
+# settings.py to change it.
+DEFAULT_SYNC_ENGINE = 'hash'
+
+# the default directory update_database_from_file records a
+# delta file of the changes it makes in, set
+# CHARITYCHECKER_DELTA_DIR in settings.py to turn recording
+# deltas on.
+DEFAULT_DELTA_DIR = None
+
+# the default number of worker processes that parse the IRS
+# data during an update, set CHARITYCHECKER_PARSE_WORKERS in
+# settings.py to change it.
+DEFAULT_PARSE_WORKERS = 1
+
+# the number of bytes of the IRS data each worker process
+# parses at a time.
+PARSE_CHUNK_SIZE = 1024 * 1024
+
+# whether updates read, parse and write the data on separate
+# threads at once by default, set CHARITYCHECKER_SYNC_PIPELINE
+# in settings.py to True to turn it on.
+DEFAULT_SYNC_PIPELINE = False
+
+# the number of lines passed between the stages of a
+# pipelined update at a time, and the most of those chunks
+# each stage can get ahead of the next.
+PIPELINE_CHUNK_SIZE = 1000
+PIPELINE_QUEUE_SIZE = 16
+
+# the number of lines at a time an update that may have to
+# start over writes to the temporary file it keeps them in,
+# so that it can start over without opening the data again.
+REPLAY_CHUNK_SIZE = 1000
+
 # End Global Variables
 
+logger = logging.getLogger(__name__)
+
 
 def ignore_blank_space(f):
     """given a text file, return a generator which skips
@@ -43,51 +119,427 @@ def ignore_blank_space(f):
             yield output_line
 
 
-def _normalize_data(f):
+# matches the deductability code of foreign nonprofits, FORGN
+# optionally followed by further codes, at the end of a line.
+_FORGN_RE = re.compile(r'FORGN(?:,[A-Z]{2,5})*$')
+
+
+def _is_foreign(nonprofit_string):
+    """return True if nonprofit_string, a line of IRS
+    Publication 78, is a FORGN nonprofit.
+    """
+    # most lines don't mention FORGN at all, so a substring
+    # check rules them out before the regex is needed, and
+    # the regex only has to look at the last field.
+    return ('FORGN' in nonprofit_string and
+            _FORGN_RE.search(
+                nonprofit_string,
+                nonprofit_string.rfind('|') + 1) is not None)
+
+
+def _normalize_data(f, metrics=None):
     """given the IRS Publication 78, normalize the quirks
     out of the data by wrapping it in this generator. The
     data format for FORGN nonprofits is heinously inconsistent
-    and poorly defined, so we just filter then out.
+    and poorly defined, so we just filter then out, counting
+    them on the 'skipped_foreign' counter of metrics, an
+    UpdateMetrics, if given.
     """
     for nonprofit_string in ignore_blank_space(f):
-        if not re.match(
-            # if it is not a foreign nonprofit, return it.
-            r'.*FORGN(?:,[A-Z]{2,5})*$',
-            nonprofit_string):
+        # if it is not a foreign nonprofit, return it.
+        if not _is_foreign(nonprofit_string):
             yield nonprofit_string
+        elif metrics is not None:
+            metrics.incr('skipped_foreign')
+
+
+# a nonprofit from IRS Publication 78, its fields in the order
+# they appear in each line.
+Pub78Record = namedtuple(
+    'Pub78Record',
+    ['ein', 'name', 'city', 'state', 'country', 'deductability_code'])
+
+
+def parse_pub78_line(nonprofit_string):
+    """return the Pub78Record for nonprofit_string, a line
+    of IRS Publication 78, raising ValueError if it doesn't
+    have a value for every field.
+    """
+    values = nonprofit_string.split('|')
+    if len(values) != len(Pub78Record._fields):
+        raise _malformed_line_error(nonprofit_string)
+    return Pub78Record._make(values)
+
+
+def _malformed_line_error(nonprofit_string):
+    """return the ValueError raised for nonprofit_string, a
+    line of IRS Publication 78 with the wrong number of
+    fields.
+    """
+    return ValueError(
+        "malformed line of IRS Publication 78, which should have "
+        "%d fields separated by '|': %r" % (
+            len(Pub78Record._fields), nonprofit_string))
+
+
+def parse_pub78(f):
+    """given the IRS Publication 78, return a generator of a
+    Pub78Record for each of its nonprofits, leaving out blank
+    lines and FORGN nonprofits like _normalize_data.
+    """
+    for nonprofit_string in _normalize_data(f):
+        yield parse_pub78_line(nonprofit_string)
+
+
+def _as_pub78_record(nonprofit):
+    """return nonprofit, a line of IRS Publication 78 or an
+    already parsed Pub78Record, as a Pub78Record.
+    """
+    if isinstance(nonprofit, Pub78Record):
+        return nonprofit
+    return parse_pub78_line(nonprofit)
+
+
+# the values IRSNonprofitData is updated with: a Pub78Record
+# followed by the nonprofit's name normalized by
+# normalize_name.
+_NonprofitRecord = namedtuple(
+    '_NonprofitRecord', Pub78Record._fields + ('normalized_name',))
+_make_nonprofit_record = functools.partial(tuple.__new__, _NonprofitRecord)
+
+
+def _as_nonprofit_record(nonprofit):
+    """return nonprofit, a line of IRS Publication 78 or an
+    already parsed Pub78Record, as a _NonprofitRecord.
+    """
+    record = _as_pub78_record(nonprofit)
+    return _make_nonprofit_record(record + (normalize_name(record.name),))
+
+
+def _line_ranges(path, chunk_size):
+    """return a generator of (start, end) byte ranges covering
+    the file at path, each about chunk_size bytes and ending on
+    a line boundary.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(start + chunk_size)
+            # run on to the end of the line the chunk ends in
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def _parse_pub78_range(args):
+    """parse the nonprofits between the byte offsets start and
+    end of the IRS Publication 78 text file at path, returning
+    them as lists of values serialized with marshal, which is
+    several times faster than sending them back from a worker
+    process pickled.
+    """
+    path, start, end = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = list(ignore_blank_space(f.read(end - start).splitlines()))
+    records = [line.split('|') for line in _normalize_data(lines)]
+    for record in records:
+        if len(record) != len(Pub78Record._fields):
+            # fail like parse_pub78_line would.
+            raise _malformed_line_error('|'.join(record))
+    # the FORGN nonprofits left out, for the consumer to count.
+    skipped_foreign = len(lines) - len(records)
+    return marshal.dumps((records, skipped_foreign))
+
+
+# builds a Pub78Record from a sequence of its values, without
+# the overhead of Pub78Record._make.
+_make_pub78_record = functools.partial(tuple.__new__, Pub78Record)
+
+
+def _load_pub78_records(data, metrics=None):
+    """return an iterator of the Pub78Records in data, as
+    returned by _parse_pub78_range, counting the FORGN
+    nonprofits left out of them on the 'skipped_foreign'
+    counter of metrics, if given.
+    """
+    records, skipped_foreign = marshal.loads(data)
+    if metrics is not None and skipped_foreign:
+        metrics.incr('skipped_foreign', skipped_foreign)
+    return itertools.imap(_make_pub78_record, records)
+
+
+def parse_pub78_file(path, workers=None, chunk_size=PARSE_CHUNK_SIZE,
+                     metrics=None):
+    """return a generator of a Pub78Record for each nonprofit
+    in the IRS Publication 78 text file at path, like
+    parse_pub78, but parsed chunk_size bytes at a time across
+    a pool of workers processes (default: one per CPU). The
+    FORGN nonprofits left out are counted like
+    _normalize_data does, on metrics, if given.
+
+    The records come out in the same order as in the file, so
+    sorted data stays sorted. Only a couple of chunks per
+    worker are parsed ahead of the records consumed, so the
+    workers parse while the consumer writes to the database
+    without the whole file ever being held in memory.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    ranges = ((path, start, end)
+              for start, end in _line_ranges(path, chunk_size))
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        for args in ranges:
+            pending.append(pool.apply_async(_parse_pub78_range, (args,)))
+            if len(pending) > 2 * workers:
+                for record in _load_pub78_records(
+                        pending.popleft().get(), metrics):
+                    yield record
+        while pending:
+            for record in _load_pub78_records(
+                    pending.popleft().get(), metrics):
+                yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def download_to_file(url, f, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                     downloader=None):
+    """download the data at url into the file object f,
+    chunk_size bytes at a time, so that the download never
+    has to fit in memory. Leaves f at its beginning.
+
+    The download is made by downloader, a Downloader, which
+    times out and retries as the CHARITYCHECKER_DOWNLOAD_*
+    settings say by default.
+    """
+    if downloader is None:
+        downloader = Downloader(chunk_size=chunk_size)
+    metrics = current_metrics()
+    with metrics.timer('download'):
+        downloader.download(url, f)
+    f.seek(0, os.SEEK_END)
+    metrics.incr('archive_bytes', f.tell())
+    f.seek(0)
+
+
+@contextmanager
+def _open_zip_member(zip_data, file_name):
+    """a context manager for opening the file file_name
+    from the zip archive in the file object zip_data.
+    """
+    with zipfile.ZipFile(zip_data) as zip_file:
+        current_metrics().incr(
+            'unzipped_bytes', zip_file.getinfo(file_name).file_size)
+        with closing(zip_file.open(file_name)) as return_file:
+            yield return_file
 
 
 @contextmanager
-def open_zip_from_url(zip_url, file_name):
+def open_zip_from_url(zip_url, file_name, downloader=None):
     """a context manager for opening a file from a zip
     archive stored at some url location. Will download,
     unzip, and return the file from the archive.
+
+    The archive is streamed to a temporary file rather than
+    held in memory, and the file is decompressed as it is
+    read, so memory use doesn't grow with the archive's size.
+    downloader is passed on to download_to_file.
     """
-    try:
-        # download zip data
-        zip_data = urllib2.urlopen(zip_url)
+    with tempfile.TemporaryFile() as zip_data:
+        download_to_file(zip_url, zip_data, downloader=downloader)
+        with _open_zip_member(zip_data, file_name) as return_file:
+            yield return_file
+
+
+class SourceUnchanged(Exception):
+    """raised by a file manager, instead of providing its
+    data, when the data is unchanged since it was last used
+    to update the database, so the update can be skipped.
+    """
+    pass
+
+
+class ArchiveCache(object):
+    """an on-disk cache of the archives downloaded from
+    some urls, kept in directory.
+
+    Fetching an archive that's already cached sends the
+    server the validators (ETag and Last-Modified) it was
+    served with, so it's only downloaded again if it has
+    changed. An interrupted download is resumed with a range
+    request the next time the archive is fetched. The cache
+    also remembers the SHA-256 digest of the last archive
+    used to update the database, so that updating from an
+    unchanged archive can be skipped.
+
+    Archives are downloaded with downloader, a Downloader,
+    whose timeout and progress apply to each fetch. Fetches
+    aren't retried, so wrap them in the downloader's
+    retrying to resume interrupted downloads straight away.
+    """
+
+    def __init__(self, directory, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 downloader=None):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        if downloader is None:
+            downloader = Downloader(chunk_size=chunk_size)
+        self.downloader = downloader
+
+    def _path(self, url):
+        return os.path.join(
+            self.directory, hashlib.sha1(url).hexdigest()[:16]
+            + '-' + os.path.basename(urlparse.urlsplit(url).path))
+
+    def _read_metadata(self, url):
         try:
-            # convert zip data to proper format
-            zip_data_buffer = io.BytesIO(zip_data.read())
-            try:
-                # create a ZipFile instance from data
-                zip_file = zipfile.ZipFile(zip_data_buffer)
-                try:
-                    # open the desired file from zip archive
-                    return_file = zip_file.open(file_name)
-                    yield return_file
-                finally:
-                    return_file.close()
-            finally:
-                zip_file.close()
-        finally:
-            zip_data_buffer.close()
-    finally:
-        zip_data.close()
+            with open(self._path(url) + '.json') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_metadata(self, url, metadata):
+        # write then rename, so that the metadata is never
+        # left half written.
+        path = self._path(url) + '.json'
+        with open(path + '.tmp', 'w') as f:
+            json.dump(metadata, f)
+        os.rename(path + '.tmp', path)
+
+    def fetch(self, url):
+        """return the path of an up-to-date copy of the
+        archive at url and that archive's SHA-256 digest,
+        downloading it only if it's new or has changed.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(url)
+        metadata = self._read_metadata(url)
+        if os.path.exists(path + '.part'):
+            headers = self._resume_headers(path, metadata.get('partial'))
+        elif os.path.exists(path) and metadata.get('sha256'):
+            headers = self._conditional_headers(metadata)
+        else:
+            headers = {}
+        try:
+            response = self.downloader.open(
+                urllib2.Request(url, headers=headers))
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                # the cached archive is still current.
+                return path, metadata['sha256']
+            if e.code == 416:
+                # the partial download's range is no longer
+                # valid, so start over.
+                os.remove(path + '.part')
+                return self.fetch(url)
+            raise
+        with closing(response):
+            validators = {
+                'etag': response.info().getheader('ETag'),
+                'last_modified': response.info().getheader('Last-Modified')}
+            if response.getcode() != 206:
+                mode, downloaded = 'wb', 0
+            elif self._continues(response, os.path.getsize(path + '.part')):
+                mode, downloaded = 'ab', os.path.getsize(path + '.part')
+            else:
+                # the server sent some other range, so start over.
+                os.remove(path + '.part')
+                return self.fetch(url)
+            metadata['partial'] = validators
+            self._write_metadata(url, metadata)
+            expected_size = self._expected_size(response)
+            with open(path + '.part', mode) as f:
+                self.downloader.copy(
+                    url, response, f, downloaded, expected_size)
+        size = os.path.getsize(path + '.part')
+        if expected_size is not None and size != expected_size:
+            # keep the partial download to resume next time.
+            raise DownloadError(
+                "download of %s was interrupted after %d of %d bytes"
+                % (url, size, expected_size))
+        os.rename(path + '.part', path)
+        metadata.pop('partial')
+        metadata.update(validators, sha256=self._digest(path))
+        self._write_metadata(url, metadata)
+        return path, metadata['sha256']
+
+    def _conditional_headers(self, metadata):
+        headers = {}
+        if metadata.get('etag'):
+            headers['If-None-Match'] = metadata['etag']
+        if metadata.get('last_modified'):
+            headers['If-Modified-Since'] = metadata['last_modified']
+        return headers
+
+    def _resume_headers(self, path, validators):
+        # only resume if the server will tell us whether the
+        # archive changed since the partial download started.
+        validator = validators and (
+            validators.get('etag') or validators.get('last_modified'))
+        if not validator:
+            return {}
+        return {
+            'Range': 'bytes=%d-' % os.path.getsize(path + '.part'),
+            'If-Range': validator}
+
+    def _continues(self, response, size):
+        content_range = response.info().getheader('Content-Range') or ''
+        return content_range.startswith('bytes %d-' % size)
+
+    def _expected_size(self, response):
+        # the size the whole archive should be, if the
+        # server said.
+        if response.getcode() == 206:
+            total = response.info().getheader(
+                'Content-Range', '').rpartition('/')[2]
+            return int(total) if total.isdigit() else None
+        length = response.info().getheader('Content-Length')
+        return int(length) if length and length.isdigit() else None
+
+    def _digest(self, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def is_synced(self, url, digest):
+        """return true if the archive with the given digest
+        was the last one from url used to update the database.
+        """
+        return self._read_metadata(url).get('synced_sha256') == digest
+
+    def mark_synced(self, url, digest):
+        """remember that the archive with the given digest
+        has been used to update the database.
+        """
+        metadata = self._read_metadata(url)
+        metadata['synced_sha256'] = digest
+        self._write_metadata(url, metadata)
+
+
+def get_archive_cache(downloader=None):
+    """return the ArchiveCache, downloading with downloader,
+    for the directory named by CHARITYCHECKER_ARCHIVE_CACHE_DIR,
+    or None if downloaded archives aren't cached.
+    """
+    directory = getattr(
+        settings, 'CHARITYCHECKER_ARCHIVE_CACHE_DIR', None)
+    if directory is None:
+        return None
+    return ArchiveCache(directory, downloader=downloader)
 
 
 @contextmanager
-def irs_nonprofit_data_context_manager():
+def irs_nonprofit_data_context_manager(workers=None, progress=None,
+                                       url=None):
     """context manager for the nonprofit data
     contained in IRS Publication 78.
 
@@ -98,15 +550,557 @@ def irs_nonprofit_data_context_manager():
     FORGN nonprofits. The context manager downloads
     and unzips a new copy of the data every time so
     as to be up-to-date.
+
+    If CHARITYCHECKER_ARCHIVE_CACHE_DIR is set, the
+    download goes through an ArchiveCache in that
+    directory instead, and SourceUnchanged is raised if
+    the data already went into the database.
+
+    With more than one worker (default: the
+    CHARITYCHECKER_PARSE_WORKERS setting), the data is
+    unzipped to a temporary file and parsed by that many
+    processes with parse_pub78_file, and the generator
+    returns Pub78Records instead of lines.
+
+    The download times out and is retried as described in
+    Downloader, and progress, if given, is called with a
+    DownloadProgress as it goes. The data is downloaded from
+    url, which defaults to IRS_NONPROFIT_DATA_URL.
+    """
+    if workers is None:
+        workers = getattr(
+            settings, 'CHARITYCHECKER_PARSE_WORKERS',
+            DEFAULT_PARSE_WORKERS)
+    if url is None:
+        url = IRS_NONPROFIT_DATA_URL
+    downloader = Downloader(progress=progress)
+    archive_cache = get_archive_cache(downloader)
+    if archive_cache is None:
+        with open_zip_from_url(
+            zip_url=url,
+            file_name=TXT_FILE_NAME,
+            downloader=downloader) as zipped_file:
+            with _pub78_data(zipped_file, workers) as data:
+                yield data
+        return
+    metrics = current_metrics()
+    with metrics.timer('download'):
+        # retrying a fetch resumes the interrupted download.
+        path, digest = downloader.retrying(archive_cache.fetch, url)
+    metrics.incr('archive_bytes', os.path.getsize(path))
+    if archive_cache.is_synced(url, digest):
+        raise SourceUnchanged(url)
+    with open(path, 'rb') as zip_data:
+        with _open_zip_member(zip_data, TXT_FILE_NAME) as zipped_file:
+            with _pub78_data(zipped_file, workers) as data:
+                yield data
+    # only reached if the data was used without errors.
+    archive_cache.mark_synced(url, digest)
+
+
+# the url schemes pub78_source_context_manager downloads
+# sources with, rather than opening them as local files.
+URL_SCHEMES = ('http', 'https', 'ftp', 'file')
+
+
+@contextmanager
+def pub78_source_context_manager(source, workers=None, progress=None):
+    """context manager for the nonprofit data in source, like
+    irs_nonprofit_data_context_manager, so that an update can
+    use a copy of IRS Publication 78 other than the IRS's own.
+
+    source is either a url, which is downloaded as described
+    in irs_nonprofit_data_context_manager, or the path of a
+    local copy of the data, zipped like the IRS's or as plain
+    text. A zip archive should hold the data in a file named
+    TXT_FILE_NAME, or in its only file.
+    """
+    if urlparse.urlparse(source).scheme in URL_SCHEMES:
+        with irs_nonprofit_data_context_manager(
+            workers, progress, url=source) as data:
+            yield data
+        return
+    if workers is None:
+        workers = getattr(
+            settings, 'CHARITYCHECKER_PARSE_WORKERS',
+            DEFAULT_PARSE_WORKERS)
+    current_metrics().incr('archive_bytes', os.path.getsize(source))
+    with open(source, 'rb') as f:
+        if not zipfile.is_zipfile(f):
+            f.seek(0)
+            with _pub78_data(f, workers) as data:
+                yield data
+            return
+        with zipfile.ZipFile(f) as zip_file:
+            names = zip_file.namelist()
+        if TXT_FILE_NAME not in names and len(names) != 1:
+            raise ValueError(
+                "%s holds neither %s nor a single file"
+                % (source, TXT_FILE_NAME))
+        file_name = TXT_FILE_NAME if TXT_FILE_NAME in names else names[0]
+        with _open_zip_member(f, file_name) as zipped_file:
+            with _pub78_data(zipped_file, workers) as data:
+                yield data
+
+
+@contextmanager
+def _pub78_data(zipped_file, workers):
+    """a context manager for the nonprofits in zipped_file,
+    the IRS Publication 78 text file, as normalized lines, or
+    as Pub78Records parsed by workers processes if there are
+    more than one.
+    """
+    if workers <= 1:
+        yield _normalize_data(zipped_file, current_metrics())
+        return
+    # the workers each read their own part of the file, so it
+    # has to be on disk rather than streamed from the archive.
+    with tempfile.NamedTemporaryFile() as text_file:
+        shutil.copyfileobj(zipped_file, text_file, DOWNLOAD_CHUNK_SIZE)
+        text_file.flush()
+        with closing(parse_pub78_file(
+                text_file.name, workers,
+                metrics=current_metrics())) as records:
+            yield records
+
+
+class _PipelineStage(object):
+    """the timings of one stage of a _Pipeline: the number of
+    rows it handled and the seconds it spent busy, waiting
+    for the stage before it and blocked on the stage after
+    it because the queue between them was full.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.blocked = 0.0
+
+    def stats(self):
+        return {
+            'stage': self.name, 'rows': self.rows, 'busy': self.busy,
+            'waiting': self.waiting, 'blocked': self.blocked}
+
+
+# marks the end of the data in a _Pipeline's queues.
+_END = object()
+
+
+class _Pipeline(object):
+    """reads lines from file_data on one thread and converts
+    them with convert_line on another, passing them on in
+    chunks through bounded queues, so that reading (which
+    includes unzipping), converting and the caller's writing
+    of the rows all happen at once.
+
+    Iterating over the pipeline returns the converted rows.
+    An exception in either thread is raised there instead.
+    Close the pipeline, which stops its threads, before
+    closing file_data. The time from the start of the
+    iteration to closing the pipeline, less the time spent
+    waiting for rows, counts as the writing stage's busy time.
+    """
+
+    def __init__(self, file_data, convert_line,
+                 chunk_size=PIPELINE_CHUNK_SIZE,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+        self.chunk_size = chunk_size
+        self.stages = [
+            _PipelineStage('read'), _PipelineStage('parse'),
+            _PipelineStage('write')]
+        self._lines = Queue.Queue(queue_size)
+        self._rows = Queue.Queue(queue_size)
+        self._stopped = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._run, args=(
+                self._read, self.stages[0], iter(file_data),
+                self._lines)),
+            threading.Thread(target=self._run, args=(
+                self._parse, self.stages[1], convert_line, self._rows))]
+        self._started = None
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _put(self, stage, queue, item):
+        # wait for room in the queue, unless the pipeline is
+        # closed in the meantime.
+        start = time.time()
+        while not self._stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                break
+            except Queue.Full:
+                pass
+        stage.blocked += time.time() - start
+
+    def _get(self, stage, queue):
+        start = time.time()
+        item = queue.get()
+        stage.waiting += time.time() - start
+        if isinstance(item, tuple):
+            # an exception passed on from an earlier stage
+            raise item[0], item[1], item[2]
+        return item
+
+    def _run(self, target, stage, source, queue):
+        try:
+            target(stage, source, queue)
+        except Exception:
+            self._put(stage, queue, sys.exc_info())
+        else:
+            self._put(stage, queue, _END)
+
+    def _read(self, stage, lines, queue):
+        while not self._stopped.is_set():
+            start = time.time()
+            chunk = list(itertools.islice(lines, self.chunk_size))
+            stage.busy += time.time() - start
+            if not chunk:
+                return
+            stage.rows += len(chunk)
+            self._put(stage, queue, chunk)
+
+    def _parse(self, stage, convert_line, queue):
+        while not self._stopped.is_set():
+            chunk = self._get(stage, self._lines)
+            if chunk is _END:
+                return
+            start = time.time()
+            rows = [convert_line(line) for line in chunk]
+            stage.busy += time.time() - start
+            stage.rows += len(rows)
+            self._put(stage, queue, rows)
+
+    def __iter__(self):
+        stage = self.stages[2]
+        self._started = time.time()
+        while True:
+            chunk = self._get(stage, self._rows)
+            if chunk is _END:
+                return
+            stage.rows += len(chunk)
+            for row in chunk:
+                yield row
+
+    def close(self):
+        """stop the pipeline's threads and wait for them to
+        finish.
+        """
+        self._stopped.set()
+        for queue in (self._lines, self._rows):
+            # unblock a thread waiting on an empty queue.
+            try:
+                queue.put_nowait(_END)
+            except Queue.Full:
+                pass
+        for thread in self._threads:
+            thread.join()
+        if self._started is not None:
+            stage = self.stages[2]
+            stage.busy = time.time() - self._started - stage.waiting
+
+    def stats(self):
+        """return a list of each stage's timings, as
+        dictionaries.
+        """
+        return [stage.stats() for stage in self.stages]
+
+
+class _BatchWriter(object):
+    """collects the rows a sync inserts, updates and deletes,
+    writing each kind to the database batch_size rows at a
+    time rather than one statement per row.
+
+    Rows are tuples of values for fields, a sequence of field
+    names on model starting with its primary key. If delta, a
+    _DeltaRecorder, is given, every change is also recorded in
+    it, along with the values of the rows changed beforehand.
+    If dry_run is true, the changes are only counted.
+    """
+
+    def __init__(self, model, fields, batch_size, delta=None,
+                 using=None, dry_run=False):
+        self.model = model
+        self.fields = tuple(fields)
+        self.batch_size = batch_size
+        self.delta = delta
+        self.dry_run = dry_run
+        self.using = using or router.db_for_write(model)
+        self._model_fields = [
+            model._meta.get_field(field) for field in self.fields]
+        self._to_insert = []
+        self._to_update = []
+        self._to_delete = []
+        self._metrics = current_metrics()
+        self.inserted = 0
+        self.updated = 0
+        self.deleted = 0
+
+    def insert(self, values):
+        if self.dry_run:
+            self.inserted += 1
+            return
+        self._to_insert.append(values)
+        if len(self._to_insert) >= self.batch_size:
+            self._write_inserts()
+
+    def update(self, values):
+        if self.dry_run:
+            self.updated += 1
+            return
+        self._to_update.append(values)
+        if len(self._to_update) >= self.batch_size:
+            self._write_updates()
+
+    def delete(self, pk):
+        if self.dry_run:
+            self.deleted += 1
+            return
+        self._to_delete.append(pk)
+        if len(self._to_delete) >= self.batch_size:
+            self._write_deletes()
+
+    def flush(self):
+        """write every row still waiting to be written."""
+        self._write_inserts()
+        self._write_updates()
+        self._write_deletes()
+
+    def counts(self):
+        """return a dictionary of the number of rows inserted,
+        updated and deleted so far.
+        """
+        return {
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'deleted': self.deleted}
+
+    def _fetch_rows(self, pks):
+        """return a dictionary mapping each of pks to the tuple
+        of its row's current values for fields.
+        """
+        connection = connections[self.using]
+        chunk_size = connection.ops.bulk_batch_size(['pk'], pks)
+        rows = {}
+        for i in range(0, len(pks), chunk_size):
+            rows.update(
+                (values[0], values) for values in
+                self.model._default_manager.using(self.using).filter(
+                    pk__in=pks[i:i + chunk_size]).values_list(*self.fields))
+        return rows
+
+    def _write_inserts(self):
+        if self._to_insert:
+            if self.delta is not None:
+                for values in self._to_insert:
+                    self.delta.insert(values)
+            with self._metrics.timer('insert'):
+                self.model._default_manager.using(self.using).bulk_create(
+                    [self.model(**dict(zip(self.fields, values)))
+                     for values in self._to_insert])
+            self.inserted += len(self._to_insert)
+            self._to_insert = []
+
+    def _write_updates(self):
+        if not self._to_update:
+            return
+        if self.delta is not None:
+            old_rows = self._fetch_rows(
+                [values[0] for values in self._to_update])
+            for values in self._to_update:
+                self.delta.update(old_rows[values[0]], values)
+        connection = connections[self.using]
+        rows = [
+            [field.get_db_prep_save(value, connection=connection)
+             for field, value in zip(self._model_fields, values)]
+            for values in self._to_update]
+        with self._metrics.timer('update'):
+            if connection.vendor == 'postgresql':
+                self._write_updates_from_values(connection, rows)
+            else:
+                self._write_updates_with_executemany(connection, rows)
+        self.updated += len(self._to_update)
+        self._to_update = []
+
+    def _write_updates_with_executemany(self, connection, rows):
+        # one parameterized UPDATE, executed for every row.
+        qn = connection.ops.quote_name
+        pk_field = self._model_fields[0]
+        sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+            qn(self.model._meta.db_table),
+            ', '.join('%s = %%s' % qn(field.column)
+                      for field in self._model_fields[1:]),
+            qn(pk_field.column))
+        connection.cursor().executemany(
+            sql, [row[1:] + row[:1] for row in rows])
+
+    def _write_updates_from_values(self, connection, rows):
+        # a single UPDATE ... FROM (VALUES ...) statement for
+        # the whole batch, casting the values to the columns'
+        # types since postgres can't infer them.
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        columns = [qn(field.column) for field in self._model_fields]
+        placeholder = '(%s)' % ', '.join(
+            '%%s::%s' % field.db_type(connection)
+            for field in self._model_fields)
+        sql = ('UPDATE %s SET %s FROM (VALUES %s) AS v (%s) '
+               'WHERE %s.%s = v.%s' % (
+                   table,
+                   ', '.join('%s = v.%s' % (column, column)
+                             for column in columns[1:]),
+                   ', '.join([placeholder] * len(rows)),
+                   ', '.join(columns),
+                   table, columns[0], columns[0]))
+        connection.cursor().execute(
+            sql, [value for row in rows for value in row])
+
+    def _write_deletes(self):
+        if not self._to_delete:
+            return
+        if self.delta is not None:
+            old_rows = self._fetch_rows(self._to_delete)
+            for pk in self._to_delete:
+                self.delta.delete(old_rows[pk])
+        connection = connections[self.using]
+        chunk_size = connection.ops.bulk_batch_size(
+            ['pk'], self._to_delete)
+        with self._metrics.timer('delete'):
+            for i in range(0, len(self._to_delete), chunk_size):
+                self.model._default_manager.using(self.using).filter(
+                    pk__in=self._to_delete[i:i + chunk_size]).delete()
+        self.deleted += len(self._to_delete)
+        self._to_delete = []
+
+
+class _DeltaRecorder(object):
+    """records the changes a sync makes in a delta file in
+    directory: a gzipped file of JSON lines, the first a
+    header naming the model and its fields, and every other
+    line one change, ["i", new values] for an inserted row,
+    ["u", old values, new values] for an updated row or
+    ["d", old values] for a deleted row.
+
+    The file is written under a temporary name and only moved
+    into place by commit, so a delta file in directory is
+    always complete. Deltas are named after the time they
+    were recorded, so they sort in the order to apply them.
     """
-    with open_zip_from_url(
-        zip_url=IRS_NONPROFIT_DATA_URL,
-        file_name=TXT_FILE_NAME) as zipped_file:
-        yield _normalize_data(zipped_file)
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.changes = 0
+        self._temporary_path = None
+        self._file = None
+
+    def start(self, model, fields):
+        """start recording, from scratch, changes to fields
+        of model.
+        """
+        if self._temporary_path is None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, self._temporary_path = tempfile.mkstemp(
+                prefix='.delta-', suffix='.part', dir=self.directory)
+            os.close(fd)
+        if self._file is not None:
+            self._file.close()
+        self._file = gzip.open(self._temporary_path, 'wb')
+        self.changes = 0
+        self._write({
+            'model': '%s.%s' % (
+                model._meta.app_label, model._meta.object_name),
+            'fields': list(fields)})
+
+    def insert(self, values):
+        self._write(['i', values])
+
+    def update(self, old_values, values):
+        self._write(['u', old_values, values])
+
+    def delete(self, old_values):
+        self._write(['d', old_values])
+
+    def _write(self, data):
+        self._file.write(json.dumps(data, cls=DjangoJSONEncoder))
+        self._file.write('\n')
+        if isinstance(data, list):
+            self.changes += 1
+
+    def commit(self):
+        """finish recording, returning the path to the delta
+        file, or None if there were no changes to record.
+        """
+        if self._file is None:
+            return None
+        self._file.close()
+        self._file = None
+        if not self.changes:
+            self.discard()
+            return None
+        path = os.path.join(
+            self.directory,
+            'delta-%s.jsonl.gz' % datetime.datetime.utcnow().strftime(
+                '%Y%m%dT%H%M%S%fZ'))
+        os.rename(self._temporary_path, path)
+        self._temporary_path = None
+        return path
+
+    def discard(self):
+        """stop recording and throw away the delta file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._temporary_path is not None:
+            os.remove(self._temporary_path)
+            self._temporary_path = None
+
+
+def apply_delta(path, using=None, batch_size=None):
+    """apply the changes recorded in the delta file at path,
+    as recorded by update_database_from_file, to the database
+    using (default: the database the model is written to), in
+    a single transaction and without reading the full data.
+
+    The database should hold the same data the delta was
+    recorded against, so apply deltas in order. Returns a
+    dictionary of the number of rows inserted, updated and
+    deleted, and sends the dataset_updated signal.
+    """
+    if batch_size is None:
+        batch_size = getattr(
+            settings, 'CHARITYCHECKER_SYNC_BATCH_SIZE',
+            DEFAULT_SYNC_BATCH_SIZE)
+    with closing(gzip.open(path, 'rb')) as f:
+        header = json.loads(f.readline())
+        model = get_model(*header['model'].split('.'))
+        writer = _BatchWriter(
+            model, header['fields'], batch_size, using=using)
+        watchers = _get_watchers(model, writer.using)
+        with transaction.atomic(using=writer.using):
+            for line in f:
+                change = json.loads(line)
+                if change[0] == 'i':
+                    writer.insert(change[1])
+                    for watcher in watchers:
+                        watcher.add(change[1][0])
+                elif change[0] == 'u':
+                    writer.update(change[2])
+                else:
+                    writer.delete(change[1][0])
+            writer.flush()
+            _prepare_watchers(watchers)
+    dataset_updated.send(sender=model, delta=path, using=writer.using)
+    return writer.counts()
 
 
 def update_database_from_file(file_manager, convert_line,
-                              pk_field, model):
+                              pk_field, model, batch_size=None,
+                              engine=None, delta_dir=None,
+                              pipeline=None, dry_run=False):
     """update the database in bulk using data from a file.
     Inputs:
         file_manager: a context manager that yields an
@@ -115,50 +1109,1034 @@ def update_database_from_file(file_manager, convert_line,
 
         convert_line: a function converting each line returned
             by the iterator into a dictionary mapping fields to
-            values.
+            values, or into a namedtuple of the values, which
+            skips building a dictionary for every line.
 
         pk_field: the name of the field which is the primary key
             of the data stored in the database.
 
         model: the model to be updated.
+
+        batch_size: the number of rows inserted, updated or
+            deleted at a time. Defaults to the
+            CHARITYCHECKER_SYNC_BATCH_SIZE setting.
+
+        engine: the name of the engine that finds the changes
+            to make, 'hash', 'merge', 'staging' or 'shadow'.
+            'hash' works on data in any order, while 'merge' needs
+            data sorted by primary key but uses far less memory,
+            and falls back to 'hash' when the data turns out not
+            to be sorted.
+            'staging' bulk loads the data into a temporary table
+            and leaves the diff to the database. 'shadow' loads
+            the data into a copy of the table, committing every
+            CHARITYCHECKER_SYNC_CHUNK_SIZE rows, and swaps it for
+            the table once it's complete, so readers are never
+            locked out for long, and an update that dies part
+            way through picks up where it left off next time.
+            Defaults to the CHARITYCHECKER_SYNC_ENGINE setting.
+
+        delta_dir: a directory to record a delta file of the
+            changes made in, which apply_delta can apply to
+            another database. Defaults to the
+            CHARITYCHECKER_DELTA_DIR setting, and no delta is
+            recorded if it is None.
+
+        pipeline: whether to read, convert and write the data
+            at the same time, on separate threads, rather than
+            one line after another. Defaults to the
+            CHARITYCHECKER_SYNC_PIPELINE setting.
+
+        dry_run: if true, find the changes the update would
+            make, and time it, without making them. The counts
+            are returned as usual, but no delta is recorded, the
+            dataset_updated signal isn't sent, an archive cache
+            doesn't take the data as used, and the metrics go to
+            the update_measured signal only. A dry run of the
+            shadow engine uses the staging engine, which finds
+            the changes the same way.
+
+    Returns a dictionary of the number of rows inserted,
+    updated and deleted. With pipeline, it also holds
+    'stages', a list of dictionaries of the timings of the
+    'read', 'parse' and 'write' stages, described in
+    _PipelineStage. Sends the dataset_updated signal, with
+    model as the sender, the path to the delta file, or
+    None, as delta, and the database updated as using, once
+    the update has been committed. If file_manager raises
+    SourceUnchanged the update is skipped and None is
+    returned.
+
+    The update's stages are timed, and its rows, bytes and
+    queries counted, in an UpdateMetrics, which is reported to
+    the sink named by the CHARITYCHECKER_METRICS_SINK setting
+    and sent with the update_measured signal once the update
+    is over, however it ends.
+    """
+    if batch_size is None:
+        batch_size = getattr(
+            settings, 'CHARITYCHECKER_SYNC_BATCH_SIZE',
+            DEFAULT_SYNC_BATCH_SIZE)
+    if engine is None:
+        engine = getattr(
+            settings, 'CHARITYCHECKER_SYNC_ENGINE', DEFAULT_SYNC_ENGINE)
+    if delta_dir is None:
+        delta_dir = getattr(
+            settings, 'CHARITYCHECKER_DELTA_DIR', DEFAULT_DELTA_DIR)
+    if pipeline is None:
+        pipeline = getattr(
+            settings, 'CHARITYCHECKER_SYNC_PIPELINE', DEFAULT_SYNC_PIPELINE)
+    delta = None
+    if delta_dir is not None and not dry_run:
+        delta = _DeltaRecorder(delta_dir)
+    with _measuring(model, dry_run) as metrics:
+        try:
+            counts = _update_database_from_file(
+                file_manager, convert_line, pk_field, model,
+                batch_size, engine, delta, pipeline, dry_run)
+        except SourceUnchanged:
+            if delta is not None:
+                delta.discard()
+            return None
+        except Exception:
+            if delta is not None:
+                delta.discard()
+            raise
+        if dry_run:
+            return counts
+        delta_path = None if delta is None else delta.commit()
+        with metrics.timer('dataset_updated'):
+            dataset_updated.send(
+                sender=model, delta=delta_path,
+                using=router.db_for_write(model))
+        return counts
+
+
+@contextmanager
+def _measuring(model, dry_run=False):
+    """a context manager for the UpdateMetrics of an update
+    of model, which times the whole update and counts its
+    queries, and reports the metrics once it's over, to the
+    sink only if it isn't a dry run.
+    """
+    metrics = UpdateMetrics()
+    try:
+        with metrics.activate():
+            with metrics.measure_queries(router.db_for_write(model)):
+                with metrics.timer('total'):
+                    yield metrics
+    finally:
+        sink = None if dry_run else get_metrics_sink()
+        if sink is not None:
+            try:
+                metrics.report(sink)
+            except Exception:
+                # losing the metrics shouldn't lose the update.
+                logger.exception("couldn't report the update's metrics")
+        # a receiver's error mustn't replace the update's own.
+        for receiver, response in update_measured.send_robust(
+                sender=model, metrics=metrics, dry_run=dry_run):
+            if isinstance(response, Exception):
+                logger.error(
+                    "%r couldn't receive the update's metrics: %r",
+                    receiver, response)
+
+
+def _update_database_from_file(file_manager, convert_line,
+                               pk_field, model, batch_size, engine,
+                               delta=None, pipeline=False,
+                               dry_run=False):
+    """update the database from the file, as described in
+    update_database_from_file, without sending any signals.
+    """
+    if engine not in ENGINES:
+        raise ValueError("unknown sync engine: %r" % (engine,))
+    if engine == 'merge':
+        # everything the merge wrote is rolled back if the data
+        # isn't sorted, so start over with an engine that
+        # doesn't care.
+        return _sync_with_engine(
+            _writing_with(_merge_sync, dry_run), file_manager,
+            convert_line, pk_field, model, batch_size, delta,
+            pipeline, dry_run, fallback=(
+                _UnsortedData, _writing_with(_hash_sync, dry_run),
+                "falling back to the hash sync engine"))
+    elif engine == SHADOW_ENGINE and dry_run:
+        # the shadow table would only be thrown away, so load
+        # the data into the staging engine's temporary table
+        # instead, which is compared with the table the same way.
+        engine = 'staging'
+    elif engine == SHADOW_ENGINE:
+        # the stale shadow table has been dropped, so starting
+        # over loads the data from scratch.
+        return _sync_with_engine(
+            _shadow_sync, file_manager, convert_line, pk_field,
+            model, batch_size, delta, pipeline, fallback=(
+                _StaleShadow, _shadow_sync, "starting the update over"))
+    return _sync_with_engine(
+        _writing_with(SYNC_ENGINES[engine], dry_run), file_manager,
+        convert_line, pk_field, model, batch_size, delta, pipeline,
+        dry_run)
+
+
+def _writing_with(sync, dry_run=False):
+    """return a function that writes the changes the engine
+    function sync finds, as described in _sync_rows, in a
+    single transaction, which is rolled back if dry_run is
+    true.
+    """
+    return functools.partial(_sync_atomically, sync, dry_run=dry_run)
+
+
+class _DryRun(Exception):
+    """raised to undo everything a dry run did, with the
+    counts of the changes it found.
+    """
+
+    def __init__(self, counts):
+        Exception.__init__(self, "dry run")
+        self.counts = counts
+
+
+def _sync_with_engine(apply, file_manager, convert_line,
+                      pk_field, model, batch_size, delta=None,
+                      pipeline=False, dry_run=False, fallback=None):
+    """update model from the data provided by file_manager
+    with the function apply, as described in _sync_rows, and
+    return the counts of rows inserted, updated and deleted,
+    through a _Pipeline if pipeline is true, or only count
+    them if dry_run is true.
+
+    fallback, if given, is an exception class, a function
+    like apply and a message. The data is then kept in a
+    temporary file as it's read, and if apply raises the
+    exception, the message is logged and the update starts
+    over with the function, on the data kept, rather than
+    opening file_manager, and perhaps downloading the data,
+    again.
+    """
+    try:
+        with file_manager() as file_data:
+            if fallback is None:
+                counts = _sync_file_data(
+                    apply, file_data, convert_line, pk_field, model,
+                    batch_size, delta, pipeline, dry_run)
+            else:
+                counts = _sync_with_fallback(
+                    apply, fallback, file_data, convert_line,
+                    pk_field, model, batch_size, delta, pipeline,
+                    dry_run)
+            if dry_run:
+                # leave file_manager with an exception, so that
+                # it doesn't take the data as used.
+                raise _DryRun(counts)
+            return counts
+    except _DryRun as e:
+        return e.counts
+
+
+def _sync_with_fallback(apply, fallback, file_data, convert_line,
+                        pk_field, model, batch_size, delta, pipeline,
+                        dry_run):
+    """update model from file_data, the data provided by a
+    file manager, falling back as described in
+    _sync_with_engine.
+    """
+    exception_class, fallback_apply, message = fallback
+    with closing(_ReplayableData(file_data)) as data:
+        try:
+            return _sync_file_data(
+                apply, data, convert_line, pk_field, model,
+                batch_size, delta, pipeline, dry_run)
+        except exception_class as e:
+            logger.warning("%s; %s", e, message)
+        return _sync_file_data(
+            fallback_apply, data.replay(), convert_line, pk_field,
+            model, batch_size, delta, pipeline, dry_run)
+
+
+class _ReplayableData(object):
+    """the lines of file_data, the data provided by a file
+    manager, which are written to a temporary file,
+    REPLAY_CHUNK_SIZE at a time, as they're read, so that
+    replay can return them all again without reading
+    file_data a second time.
+    """
+
+    def __init__(self, file_data):
+        self._lines = iter(file_data)
+        self._file = tempfile.TemporaryFile()
+
+    def __iter__(self):
+        while True:
+            chunk = list(itertools.islice(self._lines, REPLAY_CHUNK_SIZE))
+            if not chunk:
+                return
+            # lines may be Pub78Records, which marshal can't
+            # write.
+            cPickle.dump(chunk, self._file, cPickle.HIGHEST_PROTOCOL)
+            for line in chunk:
+                yield line
+
+    def replay(self):
+        """return a generator of every line of file_data, from
+        the start, reading the rest of file_data first.
+        """
+        for line in self:
+            pass
+        self._file.seek(0)
+        while True:
+            try:
+                chunk = cPickle.load(self._file)
+            except EOFError:
+                return
+            for line in chunk:
+                yield line
+
+    def close(self):
+        self._file.close()
+
+
+def _sync_file_data(apply, file_data, convert_line, pk_field, model,
+                    batch_size, delta, pipeline, dry_run):
+    """update model from file_data, the data provided by a
+    file manager, as described in _sync_with_engine.
+    """
+    metrics = current_metrics()
+    if not pipeline:
+        return _sync_rows(
+            apply, metrics.timed(
+                'read', (convert_line(line) for line in file_data),
+                'rows_read'),
+            pk_field, model, batch_size, delta, dry_run)
+    pipeline = _Pipeline(file_data, convert_line)
+    try:
+        counts = _sync_rows(
+            apply, metrics.timed('read', pipeline, 'rows_read'),
+            pk_field, model, batch_size, delta, dry_run)
+    finally:
+        pipeline.close()
+    counts['stages'] = pipeline.stats()
+    for stats in counts['stages']:
+        logger.info(
+            "%(stage)s stage: %(rows)d rows, %(busy).1fs busy, "
+            "%(waiting).1fs waiting for input, %(blocked).1fs "
+            "blocked on output", stats)
+    return counts
+
+
+def _sync_rows(apply, rows, pk_field, model, batch_size, delta=None,
+               dry_run=False):
+    """update model from rows, the converted lines of data, as
+    described in _sync_with_engine, by calling apply with
+    model, the rows as tuples of values for the fields to
+    write, the fields, batch_size, delta and the watchers to
+    prepare before the changes are committed, which returns
+    the counts.
     """
-    with file_manager() as file_data:
+    data = next(rows, None)
+    # the fields to write, primary key first
+    fields = [pk_field]
+    if data is not None:
+        names = getattr(data, '_fields', data)
+        fields.extend(
+            field.name for field in model._meta.fields
+            if field.name in names and field.name != pk_field)
+        rows = itertools.chain([data], rows)
+    rows = _as_value_tuples(rows, data, fields)
+    if delta is not None:
+        delta.start(model, fields)
+    watchers = ([] if dry_run else
+                _get_watchers(model, router.db_for_write(model)))
+    if watchers:
+        rows = _watched(rows, watchers)
+    counts = apply(model, rows, fields, batch_size, delta, watchers)
+    metrics = current_metrics()
+    for name, count in counts.items():
+        metrics.incr(name, count)
+    return counts
+
+
+def _sync_atomically(sync, model, rows, fields, batch_size, delta,
+                     watchers=(), dry_run=False):
+    """pass the engine function sync a _BatchWriter for the
+    changes needed to make model's table match rows, tuples of
+    values for fields, in a single transaction, which is
+    rolled back if dry_run is true, and return the counts.
+    watchers are prepared before the transaction commits.
+    """
+    try:
         with transaction.atomic():
-            db_data_map = {row.pk: row for row in model.objects.all()}
-            to_create = []
-            progress = 0
-            for line in file_data:
-                data = convert_line(line)
-                row = db_data_map.pop(data[pk_field], None)
-                if row:
-                    if reduce(
-                        lambda acc, (attr_name, attr_value):
-                            (getattr(row, attr_name) != attr_value) or acc,
-                        data.items(),
-                        False):
-                        for attr, value in data.items():
-                            setattr(row, attr, value)
-                        row.save()
-                else:
-                    to_create.append(model(**data))
-            model.objects.bulk_create(to_create)
-            model.objects.filter(pk__in=db_data_map).delete()
+            writer = _BatchWriter(
+                model, fields, batch_size, delta, dry_run=dry_run)
+            sync(model, rows, writer)
+            writer.flush()
+            if dry_run:
+                # roll back whatever the engine wrote, such as the
+                # staging engine's table.
+                raise _DryRun(writer.counts())
+            _prepare_watchers(watchers)
+            return writer.counts()
+    except _DryRun as e:
+        return e.counts
+
+
+def _get_watchers(model, using):
+    """return the watchers the receivers of the
+    dataset_updating signal return for an update of model in
+    the database using.
+    """
+    return [watcher for receiver, watcher in
+            dataset_updating.send(sender=model, using=using)
+            if watcher is not None]
+
+
+def _watched(rows, watchers):
+    """return a generator of rows, tuples of values starting
+    with the primary key, passing each primary key to every
+    one of watchers.
+    """
+    for values in rows:
+        for watcher in watchers:
+            watcher.add(values[0])
+        yield values
+
+
+def _prepare_watchers(watchers):
+    """prepare watchers for the update to be committed."""
+    if watchers:
+        with current_metrics().timer('dataset_updating'):
+            for watcher in watchers:
+                watcher.prepare()
+
+
+def _as_value_tuples(rows, data, fields):
+    """return rows, the dictionaries or namedtuples returned
+    by convert_line, as tuples of the values for fields. data
+    is the first of the rows.
+    """
+    if not hasattr(data, '_fields'):
+        return (tuple(data[field] for field in fields) for data in rows)
+    if tuple(fields) == data._fields:
+        # already tuples of the right values in the right order.
+        return rows
+    get_values = operator.itemgetter(
+        *[data._fields.index(field) for field in fields])
+    if len(fields) == 1:
+        return ((get_values(data),) for data in rows)
+    return itertools.imap(get_values, rows)
+
+
+def _hash_sync(model, rows, writer):
+    """the hash sync engine. Pass the writer the changes
+    needed to make model's table match rows, tuples of values
+    for writer.fields, which may come in any order.
+
+    Rather than loading the whole table as model instances,
+    the table is read writer.batch_size rows at a time as
+    tuples and only a hash of each row's values is kept, so
+    memory use is a small fraction of the table's size.
+    """
+    db_hashes = dict(
+        (values[0], hash(values[1:]))
+        for values in _iter_db_rows(
+            model, writer.fields, writer.batch_size))
+    for values in rows:
+        db_hash = db_hashes.pop(values[0], None)
+        if db_hash is None:
+            writer.insert(values)
+        elif db_hash != hash(values[1:]):
+            writer.update(values)
+    for pk in db_hashes:
+        writer.delete(pk)
+
+
+class _UnsortedData(Exception):
+    """raised by the merge sync engine when the data isn't
+    sorted by primary key.
+    """
+    pass
+
+
+def _merge_sync(model, rows, writer):
+    """the merge sync engine. Pass the writer the changes
+    needed to make model's table match rows, tuples of values
+    for writer.fields, which must be sorted by primary key.
+
+    The rows are merged with the table, read in primary key
+    order, the way a sorted merge join works, so memory use
+    doesn't depend on the size of the data at all. Raises
+    _UnsortedData on finding rows out of order, in the data
+    or in the order the database sorts the primary keys in.
+    """
+    db_rows = _iter_db_rows(model, writer.fields, writer.batch_size)
+
+    def next_db_row(previous=None):
+        db_values = next(db_rows, None)
+        if (previous is not None and db_values is not None and
+            db_values[0] <= previous[0]):
+            raise _UnsortedData(
+                "the database doesn't sort primary keys the way "
+                "python does")
+        return db_values
+
+    db_values = next_db_row()
+    previous_pk = None
+    for values in rows:
+        pk = values[0]
+        if previous_pk is not None and pk <= previous_pk:
+            raise _UnsortedData(
+                "the data isn't sorted by primary key: %r came after %r"
+                % (pk, previous_pk))
+        previous_pk = pk
+        while db_values is not None and db_values[0] < pk:
+            writer.delete(db_values[0])
+            db_values = next_db_row(db_values)
+        if db_values is not None and db_values[0] == pk:
+            if db_values[1:] != values[1:]:
+                writer.update(values)
+            db_values = next_db_row(db_values)
+        else:
+            writer.insert(values)
+    while db_values is not None:
+        writer.delete(db_values[0])
+        db_values = next_db_row(db_values)
+
+
+def _staging_sync(model, rows, writer):
+    """the staging sync engine. Make model's table match rows,
+    tuples of values for writer.fields in any order, adding the
+    number of rows inserted, updated and deleted to writer's
+    counts.
+
+    The rows are bulk loaded into a temporary staging table,
+    with COPY on PostgreSQL and executemany elsewhere, and the
+    table is then brought up-to-date with three set-based
+    statements, leaving the database to do the diff. If the
+    writer records a delta, the changes are first read out
+    with three matching queries.
+    """
+    connection = connections[writer.using]
+    qn = connection.ops.quote_name
+    model_fields = [model._meta.get_field(field) for field in writer.fields]
+    table = qn(model._meta.db_table)
+    staging_table = qn(model._meta.db_table + '_staging')
+    columns = [qn(field.column) for field in model_fields]
+    pk, data_columns = columns[0], columns[1:]
+    cursor = connection.cursor()
+    cursor.execute('CREATE TEMPORARY TABLE %s (%s, PRIMARY KEY (%s))' % (
+        staging_table,
+        ', '.join('%s %s' % (column, field.db_type(connection))
+                  for column, field in zip(columns, model_fields)),
+        pk))
+    load = (_copy_rows if connection.vendor == 'postgresql'
+            else _insert_rows)
+    metrics = current_metrics()
+    batch = []
+    for values in rows:
+        batch.append(
+            [field.get_db_prep_save(value, connection=connection)
+             for field, value in zip(model_fields, values)])
+        if len(batch) >= writer.batch_size:
+            with metrics.timer('stage'):
+                load(cursor, staging_table, columns, batch)
+            batch = []
+    with metrics.timer('stage'):
+        load(cursor, staging_table, columns, batch)
+    in_staging, not_in_table, changed = _staged_changes(
+        table, staging_table, columns)
+    if writer.dry_run:
+        # count the changes instead of making them.
+        for count, value in _count_staged_changes(
+            cursor, table, staging_table, columns).items():
+            setattr(writer, count, value)
+        cursor.execute('DROP TABLE %s' % staging_table)
+        return
+    if writer.delta is not None:
+        # read the changes before making them, while the old
+        # values are still there to read.
+        _record_staged_changes(
+            cursor, writer.delta, table, staging_table, columns)
+    with metrics.timer('delete'):
+        cursor.execute('DELETE FROM %s WHERE NOT EXISTS (%s)' % (
+            table, in_staging))
+    writer.deleted += cursor.rowcount
+    if data_columns:
+        with metrics.timer('update'):
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'UPDATE %s SET %s FROM %s s WHERE s.%s = %s.%s AND (%s)'
+                    % (table,
+                       ', '.join('%s = s.%s' % (column, column)
+                                 for column in data_columns),
+                       staging_table, pk, table, pk, changed))
+            else:
+                cursor.execute(
+                    'UPDATE %s SET %s WHERE EXISTS (%s AND (%s))' % (
+                        table,
+                        ', '.join(
+                            '%s = (SELECT s.%s FROM %s s WHERE s.%s = %s.%s)'
+                            % (column, column, staging_table,
+                               pk, table, pk)
+                            for column in data_columns),
+                        in_staging, changed))
+        writer.updated += cursor.rowcount
+    with metrics.timer('insert'):
+        cursor.execute(
+            'INSERT INTO %s (%s) SELECT %s FROM %s s WHERE NOT EXISTS (%s)'
+            % (table, ', '.join(columns),
+               ', '.join('s.%s' % column for column in columns),
+               staging_table, not_in_table))
+    writer.inserted += cursor.rowcount
+    cursor.execute('DROP TABLE %s' % staging_table)
+
+
+def _staged_changes(table, staging_table, columns):
+    """return the conditions, on a row of staging_table
+    aliased as s or a row of table, that find the changes
+    needed to make table, whose quoted columns start with its
+    primary key, match staging_table: whether the row is in
+    the staging table, isn't in the table, and has changed.
+    """
+    pk, data_columns = columns[0], columns[1:]
+    in_staging = 'SELECT 1 FROM %s s WHERE s.%s = %s.%s' % (
+        staging_table, pk, table, pk)
+    not_in_table = 'SELECT 1 FROM %s WHERE %s.%s = s.%s' % (
+        table, table, pk, pk)
+    changed = ' OR '.join(
+        'NOT (s.%s = %s.%s OR (s.%s IS NULL AND %s.%s IS NULL))' % (
+            column, table, column, column, table, column)
+        for column in data_columns) or '0 = 1'
+    return in_staging, not_in_table, changed
+
+
+def _count_staged_changes(cursor, table, staging_table, columns):
+    """return the number of rows that would be inserted,
+    updated and deleted to make table match staging_table, as
+    described in _staged_changes.
+    """
+    pk = columns[0]
+    in_staging, not_in_table, changed = _staged_changes(
+        table, staging_table, columns)
+    counts = {}
+    for count, sql in (
+        ('deleted', 'SELECT COUNT(*) FROM %s WHERE NOT EXISTS (%s)'
+         % (table, in_staging)),
+        ('updated', 'SELECT COUNT(*) FROM %s JOIN %s s '
+         'ON s.%s = %s.%s WHERE %s'
+         % (table, staging_table, pk, table, pk, changed)),
+        ('inserted', 'SELECT COUNT(*) FROM %s s WHERE NOT EXISTS (%s)'
+         % (staging_table, not_in_table))):
+        cursor.execute(sql)
+        counts[count] = cursor.fetchone()[0]
+    return counts
+
+
+def _record_staged_changes(cursor, delta, table, staging_table, columns):
+    """record the changes needed to make table match
+    staging_table, as described in _staged_changes, in delta,
+    a _DeltaRecorder.
+    """
+    pk = columns[0]
+    in_staging, not_in_table, changed = _staged_changes(
+        table, staging_table, columns)
+    table_columns = ', '.join(
+        '%s.%s' % (table, column) for column in columns)
+    staging_columns = ', '.join('s.%s' % column for column in columns)
+    cursor.execute('SELECT %s FROM %s WHERE NOT EXISTS (%s)' % (
+        table_columns, table, in_staging))
+    for row in _fetch_all(cursor):
+        delta.delete(row)
+    cursor.execute(
+        'SELECT %s, %s FROM %s JOIN %s s ON s.%s = %s.%s WHERE %s' % (
+            table_columns, staging_columns, table, staging_table,
+            pk, table, pk, changed))
+    for row in _fetch_all(cursor):
+        delta.update(row[:len(columns)], row[len(columns):])
+    cursor.execute('SELECT %s FROM %s s WHERE NOT EXISTS (%s)' % (
+        staging_columns, staging_table, not_in_table))
+    for row in _fetch_all(cursor):
+        delta.insert(row)
+
+
+class _StaleShadow(Exception):
+    """raised by the shadow sync engine, once it has dropped
+    it, when the shadow table an earlier update left behind
+    holds different data than the update is loading.
+    """
+
+
+class _ShadowTable(object):
+    """a copy of model's table in the database using, named
+    name, that the shadow sync engine loads the data into
+    before swapping it for model's table, with a table beside
+    it, named name + '_progress', of how far loading it has
+    got: the fields being loaded, the number of rows loaded
+    and a SHA-1 digest of their values.
+    """
+
+    def __init__(self, model, using, name):
+        self.model = model
+        self.using = using
+        self.name = name
+        self.progress_name = name + '_progress'
+
+    @classmethod
+    def prefix(cls, model):
+        """return the prefix of the names of model's shadow
+        tables.
+        """
+        return model._meta.db_table + '__shadow_'
+
+    @classmethod
+    def old_prefix(cls, model):
+        """return the prefix of the names model's table is
+        given while it is swapped for a shadow table.
+        """
+        return model._meta.db_table + '__old_'
+
+    @classmethod
+    def find(cls, model, using):
+        """return the shadow tables of model earlier updates
+        left in the database using, dropping any of model's old
+        tables a swap that died on MySQL left behind.
+        """
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        names = sorted(connection.introspection.table_names())
+        old_tables = [name for name in names
+                      if name.startswith(cls.old_prefix(model))]
+        if old_tables:
+            with transaction.atomic(using=using):
+                cursor = connection.cursor()
+                for name in old_tables:
+                    cursor.execute('DROP TABLE %s' % qn(name))
+        prefix = cls.prefix(model)
+        return [cls(model, using, name) for name in names
+                if name.startswith(prefix) and
+                not name.endswith('_progress')]
+
+    @classmethod
+    def create(cls, model, using, fields):
+        """create a new, empty shadow table of model in the
+        database using, for loading fields into, and return it.
+        Its indexes, other than its primary key, are left for
+        swap to create, once the data is loaded.
+        """
+        shadow = cls(model, using, cls.prefix(model) + uuid.uuid4().hex[:8])
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        with transaction.atomic(using=using):
+            cursor = connection.cursor()
+            output, references = connection.creation.sql_create_model(
+                model, no_style())
+            for sql in shadow._rename(output):
+                cursor.execute(sql)
+            cursor.execute(
+                'CREATE TABLE %s (%s TEXT, %s INTEGER, %s VARCHAR(40))' % (
+                    qn(shadow.progress_name), qn('fields'),
+                    qn('row_count'), qn('digest')))
+            cursor.execute(
+                'INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)' % (
+                    qn(shadow.progress_name), qn('fields'),
+                    qn('row_count'), qn('digest')),
+                [','.join(fields), 0, hashlib.sha1().hexdigest()])
+        return shadow
+
+    def _rename(self, statements):
+        # the statements django creates model's table and
+        # indexes with, creating the shadow table's instead.
+        return [sql.replace(self.model._meta.db_table, self.name)
+                for sql in statements]
+
+    def progress(self):
+        """return the fields being loaded, the number of rows
+        loaded and the digest of their values, or None if the
+        progress table is missing.
+        """
+        connection = connections[self.using]
+        if self.progress_name not in connection.introspection.table_names():
+            return None
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s, %s, %s FROM %s' % (
+            qn('fields'), qn('row_count'), qn('digest'),
+            qn(self.progress_name)))
+        fields, row_count, digest = cursor.fetchone()
+        return fields.split(','), row_count, digest
+
+    def save_progress(self, row_count, digest):
+        """record that row_count rows, whose values have the
+        digest digest, have been loaded, in the transaction
+        that loaded them.
+        """
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        connection.cursor().execute(
+            'UPDATE %s SET %s = %%s, %s = %%s' % (
+                qn(self.progress_name), qn('row_count'), qn('digest')),
+            [row_count, digest])
+
+    def swap(self):
+        """index the shadow table and swap it for model's
+        table, in a single transaction, dropping model's table
+        and the progress table. Readers only wait for the
+        renames and the drop.
+        """
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        table = self.model._meta.db_table
+        old_table = (self.old_prefix(self.model) +
+                     self.name[len(self.prefix(self.model)):])
+        with transaction.atomic(using=self.using):
+            cursor = connection.cursor()
+            for sql in self._rename(connection.creation.sql_indexes_for_model(
+                    self.model, no_style())):
+                cursor.execute(sql)
+            renames = index_shadow_table(self.model, self.name, self.using)
+            if connection.vendor == 'mysql':
+                # MySQL commits before every ALTER TABLE, but
+                # renames several tables at once atomically.
+                cursor.execute('RENAME TABLE %s TO %s, %s TO %s' % (
+                    qn(table), qn(old_table), qn(self.name), qn(table)))
+            else:
+                cursor.execute('ALTER TABLE %s RENAME TO %s' % (
+                    qn(table), qn(old_table)))
+                cursor.execute('ALTER TABLE %s RENAME TO %s' % (
+                    qn(self.name), qn(table)))
+            cursor.execute('DROP TABLE %s' % qn(old_table))
+            for sql in renames:
+                cursor.execute(sql)
+            cursor.execute('DROP TABLE %s' % qn(self.progress_name))
+
+    def drop(self):
+        """drop the shadow table and its progress table."""
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        tables = connection.introspection.table_names()
+        with transaction.atomic(using=self.using):
+            cursor = connection.cursor()
+            for name in (self.name, self.progress_name):
+                if name in tables:
+                    cursor.execute('DROP TABLE %s' % qn(name))
+
+
+def _shadow_sync(model, rows, fields, batch_size, delta=None,
+                 watchers=()):
+    """the shadow sync engine. Make model's table match rows,
+    tuples of values for fields, which must start with the
+    primary key, in any order, recording the changes in delta,
+    a _DeltaRecorder, if given, and return the counts of rows
+    inserted, updated and deleted. watchers are prepared
+    before the shadow table is swapped in.
+
+    Rather than changing model's table in one long
+    transaction, the rows are bulk loaded into a shadow copy
+    of it, committing every CHARITYCHECKER_SYNC_CHUNK_SIZE
+    rows, which is compared with the table like the staging
+    engine's table and then swapped for it, in the same
+    transaction, so the counts and delta are of the changes
+    the swap makes. Columns of model
+    missing from fields are given their defaults. If an
+    earlier update died part way through loading the same
+    data, the rows it loaded are checked against rows and
+    kept, or, if they don't match, the update is started over
+    by raising _StaleShadow.
+    """
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    chunk_size = getattr(
+        settings, 'CHARITYCHECKER_SYNC_CHUNK_SIZE', DEFAULT_SYNC_CHUNK_SIZE)
+    metrics = current_metrics()
+    digest = hashlib.sha1()
+    row_count = 0
+    shadow = None
+    for found in _ShadowTable.find(model, using):
+        progress = found.progress()
+        if shadow is None and progress is not None and progress[0] == fields:
+            shadow, (_, row_count, loaded_digest) = found, progress
+        else:
+            found.drop()
+    if shadow is None:
+        shadow = _ShadowTable.create(model, using, fields)
+    elif row_count:
+        resumed = 0
+        for values in itertools.islice(rows, row_count):
+            digest.update(repr(values))
+            resumed += 1
+        if resumed != row_count or digest.hexdigest() != loaded_digest:
+            shadow.drop()
+            raise _StaleShadow(
+                "the shadow table %s holds different data" % shadow.name)
+        metrics.incr('rows_resumed', row_count)
+    model_fields = [model._meta.get_field(field) for field in fields]
+    # the columns the rows don't have values for
+    defaults = [field for field in model._meta.fields
+                if field.name not in fields]
+    columns = [qn(field.column) for field in model_fields + defaults]
+    default_values = [
+        field.get_db_prep_save(field.get_default(), connection=connection)
+        for field in defaults]
+    load = (_copy_rows if connection.vendor == 'postgresql'
+            else _insert_rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        with metrics.timer('stage'):
+            with transaction.atomic(using=using):
+                cursor = connection.cursor()
+                for start in xrange(0, len(chunk), batch_size):
+                    load(cursor, qn(shadow.name), columns, [
+                        [field.get_db_prep_save(value, connection=connection)
+                         for field, value in zip(model_fields, values)]
+                        + default_values
+                        for values in chunk[start:start + batch_size]])
+                for values in chunk:
+                    digest.update(repr(values))
+                row_count += len(chunk)
+                shadow.save_progress(row_count, digest.hexdigest())
+    table = qn(model._meta.db_table)
+    shadow_table = qn(shadow.name)
+    # only compare the columns the rows have values for
+    columns = columns[:len(fields)]
+    with transaction.atomic(using=using):
+        cursor = connection.cursor()
+        with metrics.timer('diff'):
+            counts = _count_staged_changes(
+                cursor, table, shadow_table, columns)
+            if delta is not None:
+                _record_staged_changes(
+                    cursor, delta, table, shadow_table, columns)
+        _prepare_watchers(watchers)
+        with metrics.timer('swap'):
+            shadow.swap()
+    return counts
+
+
+def _fetch_all(cursor, size=1000):
+    """return a generator of the rows from the query cursor
+    last executed, fetched size rows at a time.
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def _insert_rows(cursor, table, columns, rows):
+    """insert rows, lists of values for columns, into table
+    with executemany.
+    """
+    if rows:
+        cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns))),
+            rows)
+
+
+def _copy_rows(cursor, table, columns, rows):
+    """insert rows, lists of values for columns, into table
+    with PostgreSQL's COPY.
+    """
+    if rows:
+        data = io.BytesIO()
+        for row in rows:
+            data.write('\t'.join(_copy_value(value) for value in row))
+            data.write('\n')
+        data.seek(0)
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (
+            table, ', '.join(columns)), data)
+
+
+def _copy_value(value):
+    """format value for COPY's text format."""
+    if value is None:
+        return '\\N'
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+# the engines update_database_from_file can find the changes
+# to make to the database with, by name. Each is passed a
+# _BatchWriter to write them with.
+SYNC_ENGINES = {
+    'hash': _hash_sync,
+    'merge': _merge_sync,
+    'staging': _staging_sync,
+}
+
+# the name of the engine that, rather than writing the
+# changes with a _BatchWriter, loads the data into a table of
+# its own and swaps it for the table; see _shadow_sync.
+SHADOW_ENGINE = 'shadow'
+
+# the names of all the engines update_database_from_file
+# accepts.
+ENGINES = sorted(list(SYNC_ENGINES) + [SHADOW_ENGINE])
+
+
+def _iter_db_rows(model, fields, chunk_size):
+    """yield a tuple of the values of fields, which must
+    start with the primary key, for every row of model in
+    primary key order. Rows are queried chunk_size at a time,
+    each query picking up after the last primary key seen, so
+    no more than chunk_size rows are ever in memory.
+    """
+    queryset = model.objects.order_by('pk').values_list(*fields)
+    timer = current_metrics().timer('load')
+    with timer:
+        rows = list(queryset[:chunk_size])
+    while rows:
+        for values in rows:
+            yield values
+        if len(rows) < chunk_size:
+            break
+        with timer:
+            rows = list(queryset.filter(pk__gt=rows[-1][0])[:chunk_size])
 
 
 def update_charitychecker_data(
     # use default value for file manager, allowing mocks to
     # be passed in for testing.
-    file_manager=irs_nonprofit_data_context_manager):
+    file_manager=irs_nonprofit_data_context_manager,
+    batch_size=None, engine=None, workers=None, delta_dir=None,
+    progress=None, pipeline=None, source=None, dry_run=False):
     """update the charitychecker database with data from
     IRS Publication 78, downloading a fresh copy of the
-    data from the IRS website.
+    data from the IRS website, or reading it from source, a
+    url or local path, with pub78_source_context_manager if
+    given. batch_size, engine, delta_dir, pipeline and
+    dry_run are passed on to update_database_from_file, and
+    the counts it returns are returned. file_manager may
+    provide lines or Pub78Records. workers and progress, if
+    given, are passed on to the built-in file managers,
+    irs_nonprofit_data_context_manager and
+    pub78_source_context_manager, and ignored by any other.
     """
-    update_database_from_file(
+    options = {}
+    if workers is not None:
+        options['workers'] = workers
+    if progress is not None:
+        options['progress'] = progress
+    if source is not None:
+        file_manager = functools.partial(
+            pub78_source_context_manager, source, **options)
+    elif file_manager is irs_nonprofit_data_context_manager:
+        file_manager = functools.partial(file_manager, **options)
+    return update_database_from_file(
         file_manager=file_manager,
-        convert_line=(
-            lambda ln: dict(zip(
-                ('ein', 'name', 'city', 'state', 'country', 'deductability_code'),
-                ln.split('|')))),
+        convert_line=_as_nonprofit_record,
         pk_field='ein',
-        model=IRSNonprofitData)
-
+        model=IRSNonprofitData,
+        batch_size=batch_size,
+        engine=engine,
+        delta_dir=delta_dir,
+        pipeline=pipeline,
+        dry_run=dry_run)
@@ -1,7 +1,15 @@
 from .models import IRSNonprofitData
 from .utilities import (
     ignore_blank_space,
+    Pub78Record,
+    parse_pub78_line,
+    parse_pub78,
+    parse_pub78_file,
+    download_to_file,
     open_zip_from_url,
+    SourceUnchanged,
+    ArchiveCache,
     irs_nonprofit_data_context_manager,
     update_database_from_file,
+    apply_delta,
     update_charitychecker_data)
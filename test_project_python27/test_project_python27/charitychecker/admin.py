@@ -1,5 +1,15 @@
+import re
 from django.contrib import admin
+from django.db.models import Q
 from .models import IRSNonprofitData
+from .search import search_eins
+
+# the most nonprofits a search by name shows in the admin.
+ADMIN_SEARCH_LIMIT = 500
+
+# searches that can be for EINs, or the start of one, as well
+# as names.
+_EIN_SEARCH_RE = re.compile(r'[0-9]+(-[0-9]*)?\Z')
 
 class IRSNonprofitDataAdmin(admin.ModelAdmin):
     readonly_fields = (
@@ -12,4 +22,22 @@ class IRSNonprofitDataAdmin(admin.ModelAdmin):
     search_fields = (
         'ein',
         'name')
+
+    def get_search_results(self, request, queryset, search_term):
+        """search by name through the search index, and by EIN
+        too if the search looks like one, rather than scanning
+        the whole table.
+        """
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        matches = Q(pk__in=search_eins(
+            IRSNonprofitData, search_term, limit=ADMIN_SEARCH_LIMIT))
+        if _EIN_SEARCH_RE.match(search_term):
+            ein = search_term.replace('-', '')
+            # EINs starting with ein sort between ein and the
+            # next EIN prefix of the same length.
+            matches |= Q(pk__gte=ein,
+                         pk__lt=ein[:-1] + chr(ord(ein[-1]) + 1))
+        return queryset.filter(matches), False
 admin.site.register(IRSNonprofitData, IRSNonprofitDataAdmin)
@@ -0,0 +1,246 @@
+"""
+downloading the IRS data, with timeouts, retries, progress
+reports and checksums.
+"""
+
+import time
+import socket
+import hashlib
+import httplib
+import logging
+import threading
+import urllib2
+from collections import namedtuple
+from django.conf import settings
+
+# Global Variables
+#
+# these can be overridden in settings.py
+
+# the default number of seconds to wait for the server to
+# accept a connection or send more data before giving up on
+# a download attempt, set CHARITYCHECKER_DOWNLOAD_TIMEOUT to
+# change it.
+DEFAULT_DOWNLOAD_TIMEOUT = 60
+
+# the default number of times a download that failed in a way
+# that may not happen again, such as a timeout, a dropped
+# connection or a 5xx response, is retried, set
+# CHARITYCHECKER_DOWNLOAD_RETRIES to change it.
+DEFAULT_DOWNLOAD_RETRIES = 3
+
+# the default number of seconds to wait before the first
+# retry, doubled before each one after, set
+# CHARITYCHECKER_DOWNLOAD_BACKOFF to change it.
+DEFAULT_DOWNLOAD_BACKOFF = 2
+
+# End Global Variables
+
+logger = logging.getLogger(__name__)
+
+# the number of bytes read at a time when downloading
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# the HTTP status codes worth retrying a download after,
+# besides 5xx server errors.
+RETRY_STATUS_CODES = frozenset([408, 429])
+
+
+class DownloadError(IOError):
+    """raised when a download ends before all of the data the
+    server said it would send has arrived.
+    """
+    pass
+
+
+class ChecksumMismatch(DownloadError):
+    """raised when downloaded data doesn't have the SHA-256
+    digest it was expected to have.
+    """
+    pass
+
+
+class DownloadProgress(namedtuple(
+    'DownloadProgress', ['url', 'downloaded', 'total', 'elapsed'])):
+    """how far a download has got: the number of bytes of url
+    downloaded so far, the number there are in all, or None if
+    the server didn't say, and the number of seconds the
+    download has taken so far.
+    """
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """the average number of bytes downloaded per second."""
+        if not self.elapsed:
+            return 0.0
+        return self.downloaded / self.elapsed
+
+
+def _is_retryable(error):
+    """return true if a download that failed with error might
+    succeed if it's tried again.
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code in RETRY_STATUS_CODES
+    if isinstance(error, ChecksumMismatch):
+        return False
+    return isinstance(error, (
+        urllib2.URLError, httplib.HTTPException, socket.error,
+        socket.timeout, DownloadError))
+
+
+class Downloader(object):
+    """downloads files over HTTP.
+
+    Every connection and read times out after timeout seconds,
+    downloads that fail in a way that may not happen again are
+    retried up to retries times, waiting backoff seconds
+    before the first retry and twice as long before each one
+    after, and progress, if given, is called with a
+    DownloadProgress after every chunk_size bytes downloaded.
+    timeout, retries and backoff default to the
+    CHARITYCHECKER_DOWNLOAD_TIMEOUT, CHARITYCHECKER_DOWNLOAD_RETRIES
+    and CHARITYCHECKER_DOWNLOAD_BACKOFF settings.
+    """
+
+    def __init__(self, timeout=None, retries=None, backoff=None,
+                 progress=None, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 sleep=time.sleep):
+        if timeout is None:
+            timeout = getattr(settings, 'CHARITYCHECKER_DOWNLOAD_TIMEOUT',
+                              DEFAULT_DOWNLOAD_TIMEOUT)
+        if retries is None:
+            retries = getattr(settings, 'CHARITYCHECKER_DOWNLOAD_RETRIES',
+                              DEFAULT_DOWNLOAD_RETRIES)
+        if backoff is None:
+            backoff = getattr(settings, 'CHARITYCHECKER_DOWNLOAD_BACKOFF',
+                              DEFAULT_DOWNLOAD_BACKOFF)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.sleep = sleep
+
+    def open(self, request):
+        """return the response to request, a url or
+        urllib2.Request, which times out like every download.
+        """
+        return urllib2.urlopen(request, timeout=self.timeout)
+
+    def copy(self, url, response, f, downloaded=0, total=None, digest=None):
+        """copy response, the response from url, into the file
+        object f, reporting progress with downloaded bytes
+        already downloaded before response started and total
+        bytes in all, and updating digest, a hashlib object, if
+        given, with the data. Returns the number of bytes
+        copied.
+        """
+        start = time.time()
+        copied = 0
+        while True:
+            chunk = response.read(self.chunk_size)
+            if not chunk:
+                return copied
+            f.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            copied += len(chunk)
+            if self.progress is not None:
+                self.progress(DownloadProgress(
+                    url, downloaded + copied, total, time.time() - start))
+
+    def retrying(self, function, *args, **kwargs):
+        """return function called with args and kwargs,
+        calling it again, up to retries more times, when it
+        raises an exception that might not happen again.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or not _is_retryable(e):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.warning(
+                    "download failed (%s), retrying in %g seconds", e, delay)
+                self.sleep(delay)
+
+    def download(self, url, f, sha256=None):
+        """download the data at url into the file object f,
+        which has to be seekable, retrying as described above,
+        and return its SHA-256 digest in hex. If sha256 is
+        given and the data's digest doesn't match it,
+        ChecksumMismatch is raised. Leaves f at its beginning.
+        """
+        return self.retrying(self._download, url, f, sha256)
+
+    def _download(self, url, f, sha256):
+        # start over, in case an earlier attempt wrote part of
+        # the data.
+        f.seek(0)
+        f.truncate()
+        digest = hashlib.sha256()
+        response = self.open(url)
+        try:
+            total = _content_length(response)
+            downloaded = self.copy(url, response, f, total=total,
+                                   digest=digest)
+        finally:
+            response.close()
+        if total is not None and downloaded != total:
+            raise DownloadError(
+                "download of %s was interrupted after %d of %d bytes"
+                % (url, downloaded, total))
+        if sha256 is not None and digest.hexdigest() != sha256.lower():
+            raise ChecksumMismatch(
+                "%s has SHA-256 digest %s, not %s"
+                % (url, digest.hexdigest(), sha256))
+        f.seek(0)
+        return digest.hexdigest()
+
+    def download_many(self, downloads, workers=4):
+        """download several files at once, with up to workers
+        threads. downloads is a list of tuples of the form
+        (url, f) or (url, f, sha256), the arguments to
+        download, and a list of the downloads' digests is
+        returned in the same order. If any download fails, the
+        others are still finished before its exception is
+        raised.
+        """
+        downloads = list(downloads)
+        digests = [None] * len(downloads)
+        errors = []
+        pending = list(enumerate(downloads))
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    i, arguments = pending.pop(0)
+                try:
+                    digests[i] = self.download(*arguments)
+                except Exception as e:
+                    errors.append((i, e))
+        threads = [
+            threading.Thread(target=work)
+            for i in range(min(workers, len(downloads)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise min(errors)[1]
+        return digests
+
+
+def _content_length(response):
+    """return the length of response's body, if the server
+    said.
+    """
+    length = response.info().getheader('Content-Length')
+    return int(length) if length and length.isdigit() else None
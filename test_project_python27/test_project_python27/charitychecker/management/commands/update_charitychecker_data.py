@@ -1,16 +1,181 @@
+import sys
+import time
+import pstats
+import cProfile
+import resource
+from StringIO import StringIO
+from optparse import make_option
 from django.core.management.base import BaseCommand, CommandError
-from ...utilities import update_charitychecker_data
+from ...bloom import get_bloom_filter
+from ...models import IRSNonprofitData
+from ...signals import update_measured
+from ...utilities import ENGINES, update_charitychecker_data
+
+# the least number of seconds between reports of the
+# download's progress.
+PROGRESS_INTERVAL = 5
+
+# the number of functions listed when profiling.
+PROFILE_LIMIT = 20
 
 class Command(BaseCommand):
     help = ("Downloads new data and makes sure"
             "charitychecker's database is up-to-date.")
 
+    option_list = BaseCommand.option_list + (
+        make_option('--engine', choices=ENGINES,
+                    default=None,
+                    help=("the engine used to find the changes to "
+                          "make: %s. Defaults to the "
+                          "CHARITYCHECKER_SYNC_ENGINE setting."
+                          % ', '.join(ENGINES))),
+        make_option('--batch-size', type='int', default=None,
+                    help=("the number of rows inserted, updated or "
+                          "deleted at a time. Defaults to the "
+                          "CHARITYCHECKER_SYNC_BATCH_SIZE setting.")),
+        make_option('--workers', type='int', default=None,
+                    help=("the number of processes that parse the "
+                          "IRS data. Defaults to the "
+                          "CHARITYCHECKER_PARSE_WORKERS setting.")),
+        make_option('--pipeline', action='store_true', default=None,
+                    help=("read, parse and write the IRS data at "
+                          "the same time, on separate threads. "
+                          "Defaults to the CHARITYCHECKER_SYNC_PIPELINE "
+                          "setting.")),
+        make_option('--source', default=None,
+                    help=("a url, or the path of a local copy, zipped "
+                          "or not, to read the IRS data from instead "
+                          "of the IRS website.")),
+        make_option('--profile', metavar='FILE', default=None,
+                    help=("run the update under cProfile, writing its "
+                          "stats to FILE, and print the functions it "
+                          "spent the most time in and its peak memory "
+                          "use. Only the main thread is profiled.")),
+        make_option('--dry-run', action='store_true', default=False,
+                    help=("find and count the changes the update "
+                          "would make, and time it, without making "
+                          "them.")),
+    )
+
     def handle(self, *args, **kwargs):
         """download data and update the charitychecker
         database."""
+        if kwargs.get('batch_size') is not None and kwargs['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
         self.stdout.write(
             "beginning to download data and update database\n"
             "This could take several minutes.")
-        update_charitychecker_data()
+        self._reported = None
+        progress = None
+        if int(kwargs.get('verbosity', 1)) >= 1:
+            progress = self._report_progress
+        self._metrics = None
+        update_measured.connect(
+            self._record_metrics, sender=IRSNonprofitData)
+        dry_run = kwargs.get('dry_run', False)
+        update = dict(
+            batch_size=kwargs.get('batch_size'),
+            engine=kwargs.get('engine'), workers=kwargs.get('workers'),
+            progress=progress, pipeline=kwargs.get('pipeline'),
+            source=kwargs.get('source'), dry_run=dry_run)
+        try:
+            if kwargs.get('profile') is None:
+                counts = update_charitychecker_data(**update)
+            else:
+                counts = self._profile(kwargs['profile'], update)
+        finally:
+            update_measured.disconnect(
+                self._record_metrics, sender=IRSNonprofitData)
+        if counts is None:
+            self.stdout.write(
+                "the IRS data hasn't changed since the last update.")
+        elif dry_run:
+            self.stdout.write(
+                "dry run: the update would insert %(inserted)d, update "
+                "%(updated)d and delete %(deleted)d rows. Nothing was "
+                "changed." % counts)
+        else:
+            self.stdout.write(
+                "%(inserted)d inserted, %(updated)d updated, "
+                "%(deleted)d deleted." % counts)
+            for stats in counts.get('stages', []):
+                self.stdout.write(
+                    "%(stage)s stage: %(rows)d rows, %(busy).1fs busy, "
+                    "%(waiting).1fs waiting for input, %(blocked).1fs "
+                    "blocked on output." % stats)
+        if self._metrics is not None:
+            self._write_metrics(self._metrics.summary())
+        if dry_run:
+            return
+        bloom_filter = get_bloom_filter()
+        if bloom_filter is not None:
+            self.stdout.write(
+                "the Bloom filter holds %d EINs with an estimated "
+                "false positive rate of %.2f%%." % (
+                    bloom_filter.count,
+                    bloom_filter.estimated_error_rate() * 100))
         self.stdout.write(
             "finished updating the charitychecker database.")
+
+    def _profile(self, path, update):
+        """run update_charitychecker_data with the arguments in
+        update under cProfile, write its stats to path, print
+        the PROFILE_LIMIT functions it spent the most time in
+        and its peak memory use, and return its counts.
+        """
+        memory = _peak_memory()
+        profiler = cProfile.Profile()
+        counts = profiler.runcall(update_charitychecker_data, **update)
+        profiler.dump_stats(path)
+        self.stdout.write("profile written to %s, the top %d functions "
+                          "by time spent in them:" % (path, PROFILE_LIMIT))
+        # pstats writes its lines a piece at a time, which the
+        # command's stdout would end each with a newline.
+        output = StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats('tottime').print_stats(PROFILE_LIMIT)
+        self.stdout.write(output.getvalue())
+        self.stdout.write(
+            "peak memory use: %.1f MB, %.1f MB more than before "
+            "the update." % (_peak_memory(), _peak_memory() - memory))
+        return counts
+
+    def _record_metrics(self, sender, metrics, **kwargs):
+        self._metrics = metrics
+
+    def _write_metrics(self, summary):
+        """write how long each stage of the update took, and
+        what it counted.
+        """
+        for stats in summary['stages']:
+            self.stdout.write(
+                "%(stage)s: %(seconds).1fs, %(queries)d queries." % stats)
+        self.stdout.write(', '.join(
+            '%s %d' % (name.replace('_', ' '), value)
+            for name, value in sorted(summary['counters'].items())) + '.')
+
+    def _report_progress(self, progress):
+        """write how far the download has got, at most every
+        PROGRESS_INTERVAL seconds and once it's finished.
+        """
+        finished = progress.downloaded == progress.total
+        if (not finished and self._reported is not None and
+            time.time() < self._reported + PROGRESS_INTERVAL):
+            return
+        self._reported = time.time()
+        if progress.total is None:
+            downloaded = "%.1f MB" % (progress.downloaded / 1e6)
+        else:
+            downloaded = "%.1f of %.1f MB" % (
+                progress.downloaded / 1e6, progress.total / 1e6)
+        self.stdout.write("downloaded %s (%.1f MB/s)" % (
+            downloaded, progress.rate / 1e6))
+
+
+def _peak_memory():
+    """return the peak resident memory of this process, in
+    megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes.
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)